@@ -0,0 +1,455 @@
+"""
+Submit categorisation and segmentation requests through the OpenAI Batch API.
+
+Batches are cheaper and have a higher throughput ceiling than synchronous requests but may take up to 24 hours to
+complete, so they suit non-urgent catalogue sweeps. Requests have the same shape as those sent synchronously and results
+are mapped back to image IDs.
+"""
+import base64
+import json
+import time
+from pathlib import Path
+from typing import Collection, Iterable, Iterator
+
+from openai import OpenAI
+from openai.types import Batch
+from pydantic_ai import BinaryContent
+from pydantic_ai.messages import UserContent
+
+from aggregator_agent import segmentation
+from aggregator_agent.cache import ResultCache
+from aggregator_agent.image_agent import SYSTEM_PROMPT, _cache_key, _model_name, _prompt
+from aggregator_agent.preprocessing import Preprocessing
+from aggregator_agent.schema import LensFitAnalysis
+
+CATEGORISE_ENDPOINT = "/v1/chat/completions"
+SEGMENT_ENDPOINT = "/v1/responses"
+
+# Limits on a single batch input file imposed by the Batch API, with some headroom on size
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+# The name of the tool used for structured output, matching the agent used synchronously
+OUTPUT_TOOL_NAME = "final_result"
+
+FINISHED_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _content_part(part: UserContent) -> dict:
+    """
+    Convert part of a prompt to chat completion message content.
+    """
+    if isinstance(part, BinaryContent):
+        b64_image = base64.b64encode(part.data).decode("utf-8")
+        return {
+            "type": "image_url",
+            "image_url": {"url": f"data:{part.media_type};base64,{b64_image}"},
+        }
+    return {"type": "text", "text": part}
+
+
+def categorise_request(prompt: list[UserContent]) -> dict:
+    """
+    A chat completion request categorising an image, in the same shape as those sent by the categorisation agent.
+    """
+    return {
+        "model": _model_name(None),
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [_content_part(part) for part in prompt],
+            },
+        ],
+        "tools": [
+            {
+                "type": "function",
+                "function": {
+                    "name": OUTPUT_TOOL_NAME,
+                    "description": "The final response which ends this conversation",
+                    "parameters": LensFitAnalysis.model_json_schema(),
+                },
+            }
+        ],
+        "tool_choice": "required",
+    }
+
+
+def parse_categorisation(body: dict) -> LensFitAnalysis:
+    """
+    Extract the analysis from the body of a chat completion response.
+    """
+    tool_calls = body["choices"][0]["message"].get("tool_calls") or []
+    for tool_call in tool_calls:
+        if tool_call["function"]["name"] == OUTPUT_TOOL_NAME:
+            return LensFitAnalysis.model_validate_json(tool_call["function"]["arguments"])
+    raise RuntimeError("No analysis returned in chat completion response.")
+
+
+def parse_mask(body: dict) -> str:
+    """
+    Extract the base64 encoded mask from the body of a Responses API response.
+    """
+    for output in body["output"]:
+        if output["type"] == "image_generation_call":
+            return output["result"]
+    raise RuntimeError("No image returned from OpenAI image generation tool.")
+
+
+def write_requests(
+        requests: Iterable[tuple[str, dict]],
+        endpoint: str,
+        work_directory: Path,
+) -> list[Path]:
+    """
+    Write requests to one or more JSONL input files, starting a new file whenever the Batch API limits are reached.
+
+    Parameters
+    ----------
+    requests
+        Pairs of custom ID (the image ID) and request body
+    endpoint
+        The API endpoint each request is sent to
+    work_directory
+        The directory in which input files are written
+
+    Returns
+    -------
+    The paths of the input files
+    """
+    work_directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    f = None
+    count = 0
+
+    try:
+        for custom_id, body in requests:
+            line = json.dumps({"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}) + "\n"
+            encoded = line.encode("utf-8")
+            if f is None or count >= MAX_BATCH_REQUESTS or f.tell() + len(encoded) > MAX_BATCH_BYTES:
+                if f is not None:
+                    f.close()
+                paths.append(work_directory / f"batch_input_{len(paths)}.jsonl")
+                f = paths[-1].open("wb")
+                count = 0
+            f.write(encoded)
+            count += 1
+    finally:
+        if f is not None:
+            f.close()
+
+    return paths
+
+
+def submit(client: OpenAI, input_path: Path, endpoint: str) -> Batch:
+    """
+    Upload an input file and create a batch from it.
+    """
+    with input_path.open("rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=endpoint,
+        completion_window="24h",
+    )
+
+
+def wait(client: OpenAI, batch_id: str, poll_interval: float = 60.0) -> Batch:
+    """
+    Poll a batch until it has finished.
+    """
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in FINISHED_STATUSES:
+            return batch
+        counts = batch.request_counts
+        if counts is not None:
+            print(f"Batch {batch_id} {batch.status}: {counts.completed}/{counts.total} complete, {counts.failed} failed")
+        else:
+            print(f"Batch {batch_id} {batch.status}")
+        time.sleep(poll_interval)
+
+
+def read_results(client: OpenAI, batch: Batch) -> Iterator[tuple[str, dict | Exception]]:
+    """
+    Read the results of a finished batch.
+
+    Yields
+    ------
+    Each custom ID paired with the body of its response, or an exception describing why it failed
+    """
+    if batch.output_file_id is not None:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                yield result["custom_id"], RuntimeError(result.get("error") or response.get("body"))
+            else:
+                yield result["custom_id"], response["body"]
+
+    if batch.error_file_id is not None:
+        for line in client.files.content(batch.error_file_id).text.splitlines():
+            result = json.loads(line)
+            response = result.get("response") or {}
+            yield result["custom_id"], RuntimeError(result.get("error") or response.get("body"))
+
+
+def _custom_ids(input_path: Path) -> list[str]:
+    """
+    The custom ID of every request in an input file.
+    """
+    with input_path.open("rb") as f:
+        return [json.loads(line)["custom_id"] for line in f]
+
+
+def _recording(requests: Iterable[tuple[str, dict]], custom_ids: list[str]) -> Iterator[tuple[str, dict]]:
+    """
+    Pass requests through, appending the custom ID of each to a list.
+    """
+    for custom_id, body in requests:
+        custom_ids.append(custom_id)
+        yield custom_id, body
+
+
+def _is_recorded(work_directory: Path) -> bool:
+    """
+    Whether a work directory records batches from an earlier run, which are resumed rather than written again.
+    """
+    return (work_directory / "batches.json").exists()
+
+
+def _write_batches(
+        requests: Iterable[tuple[str, dict]],
+        endpoint: str,
+        work_directory: Path,
+        ids: Collection[str],
+) -> list[Path]:
+    """
+    Write requests to input files, recording their custom IDs in the work directory, or if the work directory already
+    records batches check they cover the IDs and return their input files. See `run_batches`.
+    """
+    state_path = work_directory / "batches.json"
+    ids_path = work_directory / "ids.json"
+    if _is_recorded(work_directory):
+        submitted = json.loads(state_path.read_text())
+        input_paths = sorted(work_directory.glob("batch_input_*.jsonl"))
+        if ids_path.exists():
+            recorded = set(json.loads(ids_path.read_text()))
+        else:
+            recorded = {custom_id for input_path in input_paths for custom_id in _custom_ids(input_path)}
+        if unrecorded := set(ids) - recorded:
+            raise ValueError(
+                f"{work_directory} holds batches for a different set of requests, {len(unrecorded)} requests are "
+                f"not among them (e.g. {min(unrecorded)}). Use another work directory."
+            )
+        print(f"Resuming {len(submitted)} batches recorded in {state_path}")
+        return input_paths
+
+    written = []
+    input_paths = write_requests(_recording(requests, written), endpoint, work_directory)
+    ids_path.write_text(json.dumps(written))
+    state_path.write_text(json.dumps({}))
+    return input_paths
+
+
+def _wait_batches(
+        client: OpenAI,
+        input_paths: list[Path],
+        endpoint: str,
+        work_directory: Path,
+        ids: Collection[str],
+        poll_interval: float = 60.0,
+) -> Iterator[tuple[str, dict | Exception]]:
+    """
+    Submit the input files not yet submitted, then wait for every batch, yielding results as each finishes. See
+    `run_batches`.
+    """
+    state_path = work_directory / "batches.json"
+    submitted = json.loads(state_path.read_text())
+    ids = set(ids)
+
+    for input_path in input_paths:
+        if input_path.name not in submitted:
+            submitted[input_path.name] = submit(client, input_path, endpoint).id
+            state_path.write_text(json.dumps(submitted))
+
+    for input_name, batch_id in submitted.items():
+        batch = wait(client, batch_id, poll_interval=poll_interval)
+        if batch.status != "completed":
+            print(f"Batch {batch_id} finished with status {batch.status}")
+        returned = set()
+        for custom_id, result in read_results(client, batch):
+            returned.add(custom_id)
+            if custom_id in ids:
+                yield custom_id, result
+        for custom_id in _custom_ids(work_directory / input_name):
+            if custom_id in ids and custom_id not in returned:
+                yield custom_id, RuntimeError(f"No result in batch {batch_id}, which finished {batch.status}")
+
+
+def run_batches(
+        client: OpenAI,
+        requests: Iterable[tuple[str, dict]],
+        endpoint: str,
+        work_directory: Path,
+        ids: Collection[str],
+        poll_interval: float = 60.0,
+) -> Iterator[tuple[str, dict | Exception]]:
+    """
+    Write, submit and wait for batches of requests, yielding results as each batch finishes.
+
+    The ID of each submitted batch, and the custom IDs of the requests written, are recorded in the work directory. If
+    the work directory already records batches then the existing input files are used rather than writing the requests
+    again, and only those not yet submitted are submitted, so an interrupted run can pick up where it left off.
+
+    Every request gets a result. Those missing from a batch's output, e.g. because the whole batch failed validation,
+    are given an exception.
+
+    Parameters
+    ----------
+    requests
+        Pairs of custom ID and request body. Only consumed if the requests have not already been written.
+    ids
+        The custom IDs of the requests, used to check a resumed run is for the same requests. Results are only
+        yielded for these IDs, so requests recorded earlier whose results are now known elsewhere, e.g. in a cache,
+        are skipped. Only read once the requests have been written, so may be filled in as they are consumed.
+
+    Raises
+    ------
+    ValueError
+        If resuming and some IDs are not among the requests recorded in the work directory
+    """
+    input_paths = _write_batches(requests, endpoint, work_directory, ids)
+    yield from _wait_batches(client, input_paths, endpoint, work_directory, ids, poll_interval)
+
+
+def categorise_via_batch(
+        image_paths: Iterable[Path],
+        work_directory: Path,
+        client: OpenAI | None = None,
+        cache: ResultCache | None = None,
+        preprocessing: Preprocessing | None = None,
+        poll_interval: float = 60.0,
+) -> Iterator[tuple[str, LensFitAnalysis | Exception]]:
+    """
+    Categorise images through the Batch API.
+
+    Each image is read and preprocessed once, both to look it up in the cache and to write its request. Cached
+    analyses are yielded once the requests are written, before any batch is waited on.
+
+    Parameters
+    ----------
+    image_paths
+        The images to categorise. Each is identified by its filename without suffix.
+    work_directory
+        A directory to hold batch input files and the IDs of submitted batches
+    client
+        The OpenAI client, e.g. pointed at a local fake batch endpoint. A default client is created if not given.
+    cache
+        If given cached analyses are yielded without being submitted and new analyses are stored
+    preprocessing
+        If given each image is transformed before it is sent
+    poll_interval
+        Seconds between checks on the status of a batch
+
+    Yields
+    ------
+    Each image ID paired with its analysis, or with an exception if it could not be categorised
+    """
+    client = client or OpenAI()
+    resuming = _is_recorded(work_directory)
+    keys = {}
+    cached = []
+    uncached = []
+
+    def prompts() -> Iterator[tuple[str, list[UserContent] | None]]:
+        # When resuming the requests are already written, so images are only read to look them up in the cache
+        for image_path in image_paths:
+            prompt = _prompt(image_path, preprocessing) if cache is not None or not resuming else None
+            if cache is not None:
+                key = _cache_key(prompt, None)
+                if (analysis := cache.get(key)) is not None:
+                    cached.append((image_path.stem, analysis))
+                    continue
+                keys[image_path.stem] = key
+            uncached.append(image_path.stem)
+            yield image_path.stem, prompt
+
+    pending = prompts()
+    if resuming:
+        for _ in pending:
+            pass
+    requests = ((image_id, categorise_request(prompt)) for image_id, prompt in pending)
+    input_paths = _write_batches(requests, CATEGORISE_ENDPOINT, work_directory, uncached)
+    yield from cached
+
+    for image_id, body in _wait_batches(
+            client,
+            input_paths,
+            CATEGORISE_ENDPOINT,
+            work_directory,
+            uncached,
+            poll_interval=poll_interval,
+    ):
+        if isinstance(body, Exception):
+            yield image_id, body
+            continue
+        try:
+            analysis = parse_categorisation(body)
+        except Exception as e:
+            yield image_id, e
+            continue
+        if image_id in keys:
+            cache.put(keys[image_id], analysis)
+        yield image_id, analysis
+
+
+def segment_via_batch(
+        image_paths: Iterable[Path],
+        work_directory: Path,
+        client: OpenAI | None = None,
+        poll_interval: float = 60.0,
+) -> Iterator[tuple[str, Path | Exception]]:
+    """
+    Generate segmentation masks through the Batch API, saving them next to each input image as `process_image` does.
+
+    Parameters
+    ----------
+    image_paths
+        The images to segment. Each is identified by the name of the directory containing it.
+    work_directory
+        A directory to hold batch input files and the IDs of submitted batches
+    client
+        The OpenAI client, e.g. pointed at a local fake batch endpoint. A default client is created if not given.
+    poll_interval
+        Seconds between checks on the status of a batch
+
+    Yields
+    ------
+    Each image ID paired with the path of its saved mask, or with an exception if it could not be segmented
+    """
+    client = client or OpenAI()
+    image_paths = {image_path.parent.name: image_path for image_path in image_paths}
+
+    requests = (
+        (image_id, segmentation.request_body(segmentation.load_image(image_path)))
+        for image_id, image_path in image_paths.items()
+    )
+    for image_id, body in run_batches(
+            client,
+            requests,
+            SEGMENT_ENDPOINT,
+            work_directory,
+            ids=image_paths.keys(),
+            poll_interval=poll_interval,
+    ):
+        if isinstance(body, Exception):
+            yield image_id, body
+            continue
+        image_path = image_paths[image_id]
+        try:
+            segmentation.save_mask(parse_mask(body), segmentation.load_image(image_path), image_path.parent)
+        except Exception as e:
+            yield image_id, e
+            continue
+        yield image_id, image_path.parent / "mask.png"
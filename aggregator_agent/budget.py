@@ -0,0 +1,360 @@
+"""
+Spend a fixed monthly budget on the most important images first.
+
+Jobs to categorise or segment an image are submitted with a priority to a backlog persisted in SQLite, e.g. with
+candidate lenses flagged upstream given a higher priority. The scheduler starts the highest priority jobs first. It
+reserves each job's estimated cost before the job starts and replaces the estimate with the actual cost of the job's
+calls, from the token usage the provider reports, once it finishes. A job only starts if its estimate fits under the
+hard limit, and once spending would pass the soft limit only jobs of at least a given priority start. Jobs which cannot
+start stay in the backlog for a later run, e.g. next month when spending resets.
+
+Estimates come from the image size and assumed output tokens, raised to the largest actual cost of the same kind of job
+once any have finished, and once enough have finished from the 90th percentile of their actual costs. Only jobs whose
+calls reported tokens count towards these, as cache hits and jobs which failed before the provider answered cost nothing
+and would pull estimates below what a job that calls the model costs. Actual costs can
+still exceed estimates, so the hard limit may be overrun by the error in the estimates of jobs in flight when it is
+reached.
+"""
+import asyncio
+import collections
+import heapq
+import itertools
+import sqlite3
+import time
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Iterable
+
+from PIL import Image
+from pydantic import BaseModel
+
+from aggregator_agent.preprocessing import estimate_image_tokens
+from aggregator_agent.rate_limit import TEXT_TOKENS
+from aggregator_agent.segmentation import REQUEST_TOKENS
+from aggregator_agent.telemetry import PRICES, collect_records
+
+CATEGORISE = "categorise"
+SEGMENT = "segment"
+OPERATIONS = (CATEGORISE, SEGMENT)
+
+# Output tokens, including reasoning, assumed for a job before any of its kind has finished
+PRIOR_OUTPUT_TOKENS = {CATEGORISE: 2000, SEGMENT: 6000}
+# Finished jobs of a kind needed before their actual costs are used as estimates, and the most recent kept
+MIN_OBSERVED_COSTS = 5
+MAX_OBSERVED_COSTS = 200
+
+
+class Job(BaseModel):
+    """
+    An image to categorise or segment.
+
+    Attributes
+    ----------
+    operation - categorise or segment
+    path - the image, or for segmentation its rgb_zoom.png
+    priority - jobs with a higher priority start first
+    """
+
+    operation: str
+    path: Path
+    priority: float = 0.0
+
+    @property
+    def image_id(self) -> str:
+        """
+        The ID of the image: the filename without suffix, or for segmentation the name of its directory.
+        """
+        return self.path.parent.name if self.operation == SEGMENT else self.path.stem
+
+
+def current_period() -> str:
+    """
+    The calendar month, in UTC, over which the budget is counted.
+    """
+    return time.strftime("%Y-%m", time.gmtime())
+
+
+def prior_cost(job: Job, model: str) -> float:
+    """
+    The cost in US dollars of a job estimated from its input and assumed output tokens.
+    """
+    if job.operation == SEGMENT:
+        input_tokens = REQUEST_TOKENS
+    else:
+        with Image.open(job.path) as image:
+            input_tokens = estimate_image_tokens(image.width, image.height) + TEXT_TOKENS
+    input_price, output_price = PRICES.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + PRIOR_OUTPUT_TOKENS[job.operation] * output_price) / 1_000_000
+
+
+class BudgetScheduler:
+    """
+    Runs jobs from a persisted backlog in priority order within hard and soft monthly spending limits.
+    """
+
+    def __init__(
+            self,
+            path: Path,
+            limit: float,
+            soft_limit: float | None = None,
+            soft_priority: float = 1.0,
+            concurrency: int = 8,
+            model: str = "gpt-5",
+    ):
+        """
+        Parameters
+        ----------
+        path
+            The SQLite file holding the backlog and the record of spending
+        limit
+            The most to spend in a month, in US dollars
+        soft_limit
+            Once spending would pass this only jobs with at least soft_priority start
+        soft_priority
+            The priority a job needs to start once spending is past the soft limit
+        concurrency
+            The most jobs running at once
+        model
+            The model whose prices are used for estimates before any jobs have finished
+        """
+        if soft_limit is not None and soft_limit > limit:
+            raise ValueError(f"The soft limit ({soft_limit}) must not be above the hard limit ({limit})")
+        self.path = path
+        self.limit = limit
+        self.soft_limit = soft_limit
+        self.soft_priority = soft_priority
+        self.concurrency = concurrency
+        self.model = model
+
+        self.reserved = 0.0
+        self.finished = 0
+        self.failed = 0
+        self.deferred = 0
+        self.estimated = 0.0
+        self.actual = 0.0
+
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS backlog (
+                operation TEXT NOT NULL,
+                path TEXT NOT NULL,
+                priority REAL NOT NULL,
+                submitted_at REAL NOT NULL,
+                PRIMARY KEY (operation, path)
+            );
+            CREATE TABLE IF NOT EXISTS spend (
+                period TEXT NOT NULL,
+                operation TEXT NOT NULL,
+                image_id TEXT NOT NULL,
+                priority REAL NOT NULL,
+                estimated REAL NOT NULL,
+                actual REAL NOT NULL,
+                input_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                error TEXT,
+                recorded_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS spend_period ON spend (period);
+            """
+        )
+
+        # The most recent actual costs of each kind of job which called the model
+        self._costs = {operation: collections.deque(maxlen=MAX_OBSERVED_COSTS) for operation in OPERATIONS}
+        for operation in OPERATIONS:
+            rows = self._connection.execute(
+                "SELECT actual FROM spend WHERE operation = ? AND input_tokens > 0 ORDER BY recorded_at DESC LIMIT ?",
+                (operation, MAX_OBSERVED_COSTS),
+            )
+            self._costs[operation].extendleft(actual for actual, in rows)
+
+        # Jobs waiting to start in this run, highest priority first, in submission order for equal priorities
+        self._heap: list[tuple[float, int, Job]] = []
+        self._order = itertools.count()
+        # Jobs started in this run, as a job whose priority is raised is pushed again
+        self._started: set[tuple[str, Path]] = set()
+
+    def __enter__(self) -> "BudgetScheduler":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def submit(self, jobs: Iterable[Job]) -> int:
+        """
+        Add jobs to the backlog, returning how many were new. A job already in the backlog keeps the higher of its
+        priorities. Jobs submitted while the scheduler is running are started in turn.
+        """
+        added = 0
+        with self._connection:
+            self._connection.execute("BEGIN")
+            for job in jobs:
+                existing = self._connection.execute(
+                    "SELECT priority FROM backlog WHERE operation = ? AND path = ?",
+                    (job.operation, str(job.path)),
+                ).fetchone()
+                if existing is None:
+                    added += 1
+                    self._connection.execute(
+                        "INSERT INTO backlog (operation, path, priority, submitted_at) VALUES (?, ?, ?, ?)",
+                        (job.operation, str(job.path), job.priority, time.time()),
+                    )
+                elif job.priority > existing[0]:
+                    self._connection.execute(
+                        "UPDATE backlog SET priority = ? WHERE operation = ? AND path = ?",
+                        (job.priority, job.operation, str(job.path)),
+                    )
+                else:
+                    continue
+                heapq.heappush(self._heap, (-job.priority, next(self._order), job))
+        return added
+
+    def backlog(self) -> list[Job]:
+        """
+        Every job in the backlog, highest priority first.
+        """
+        rows = self._connection.execute(
+            "SELECT operation, path, priority FROM backlog ORDER BY priority DESC, submitted_at"
+        )
+        return [Job(operation=operation, path=Path(path), priority=priority) for operation, path, priority in rows]
+
+    def spent(self) -> float:
+        """
+        The actual spend so far this month, in US dollars.
+        """
+        (spent,) = self._connection.execute(
+            "SELECT COALESCE(SUM(actual), 0) FROM spend WHERE period = ?",
+            (current_period(),),
+        ).fetchone()
+        return spent
+
+    def estimate(self, job: Job) -> float:
+        """
+        The cost in US dollars a job is expected to have.
+        """
+        costs = self._costs[job.operation]
+        if len(costs) < MIN_OBSERVED_COSTS:
+            return max([prior_cost(job, self.model), *costs])
+        return sorted(costs)[int(0.9 * (len(costs) - 1))]
+
+    def admits(self, job: Job, estimate: float) -> bool:
+        """
+        Whether a job with the given estimate can start within the limits.
+        """
+        committed = self.spent() + self.reserved + estimate
+        if committed > self.limit:
+            return False
+        if self.soft_limit is not None and committed > self.soft_limit:
+            return job.priority >= self.soft_priority
+        return True
+
+    def _record(
+            self,
+            job: Job,
+            estimate: float,
+            actual: float,
+            input_tokens: int,
+            output_tokens: int,
+            error: str | None,
+    ):
+        with self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute(
+                "INSERT INTO spend (period, operation, image_id, priority, estimated, actual, input_tokens, "
+                "output_tokens, error, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (current_period(), job.operation, job.image_id, job.priority, estimate, actual, input_tokens,
+                 output_tokens, error, time.time()),
+            )
+            # Failed jobs stay in the backlog to be tried again by a later run
+            if error is None:
+                self._connection.execute(
+                    "DELETE FROM backlog WHERE operation = ? AND path = ?",
+                    (job.operation, str(job.path)),
+                )
+        if input_tokens > 0:
+            self._costs[job.operation].append(actual)
+
+    async def run(
+            self,
+            handlers: dict[str, Callable[[Path], Awaitable[object]]],
+    ) -> AsyncIterator[tuple[Job, object | Exception]]:
+        """
+        Run jobs from the backlog in priority order until it is empty or the budget allows no more to start.
+
+        Parameters
+        ----------
+        handlers
+            For each operation, a function which runs a job given its image and returns the result, e.g. the analysis
+            or mask
+
+        Yields
+        ------
+        Each job which ran, paired with its result or the exception it raised
+        """
+        self._heap = [(-job.priority, next(self._order), job) for job in self.backlog()]
+        heapq.heapify(self._heap)
+        self._started = set()
+        pending: dict[asyncio.Task, tuple[Job, float]] = {}
+
+        async def execute(job: Job) -> tuple[object | Exception, list]:
+            with collect_records() as records:
+                try:
+                    result = await handlers[job.operation](job.path)
+                except Exception as e:
+                    result = e
+            return result, records
+
+        def fill():
+            while self._heap and len(pending) < self.concurrency:
+                job = self._heap[0][2]
+                if (job.operation, job.path) in self._started:
+                    heapq.heappop(self._heap)
+                    continue
+                estimate = self.estimate(job)
+                # Jobs after this have no higher priority, so cannot start either until spending is known
+                if not self.admits(job, estimate):
+                    return
+                heapq.heappop(self._heap)
+                self._started.add((job.operation, job.path))
+                self.reserved += estimate
+                pending[asyncio.create_task(execute(job))] = job, estimate
+
+        try:
+            fill()
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    job, estimate = pending.pop(task)
+                    result, records = task.result()
+                    actual = sum(record.cost for record in records)
+                    self.reserved -= estimate
+                    self.estimated += estimate
+                    self.actual += actual
+                    if isinstance(result, Exception):
+                        self.failed += 1
+                    else:
+                        self.finished += 1
+                    self._record(
+                        job,
+                        estimate,
+                        actual,
+                        sum(record.input_tokens for record in records),
+                        sum(record.output_tokens for record in records),
+                        repr(result) if isinstance(result, Exception) else None,
+                    )
+                    yield job, result
+                fill()
+        finally:
+            for task in pending:
+                task.cancel()
+            self.deferred = len({(job.operation, job.path) for *_, job in self._heap} - self._started)
+
+    def summary(self) -> str:
+        soft = f", soft limit ${self.soft_limit:.2f}" if self.soft_limit is not None else ""
+        return (
+            f"Budget: ${self.spent():.2f} of ${self.limit:.2f} spent in {current_period()}{soft}. "
+            f"{self.finished} jobs finished and {self.failed} failed for ${self.actual:.4f} "
+            f"(estimated ${self.estimated:.4f}), {self.deferred} deferred to the backlog"
+        )
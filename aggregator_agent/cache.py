@@ -0,0 +1,201 @@
+import hashlib
+import sqlite3
+import time
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+
+from aggregator_agent.schema import LensFitAnalysis
+
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "aggregator_agent" / "categorise.sqlite"
+
+
+def cache_key(*parts: bytes | str) -> str:
+    """
+    Hash everything that determines an analysis into a single key.
+
+    Each part is length prefixed so that distinct combinations of parts cannot produce the same key.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    A persistent, content-addressed cache of analyses backed by SQLite.
+
+    Entries older than `max_age` seconds are treated as misses and removed. When there are more than `max_entries`
+    entries the least recently used are evicted.
+    """
+
+    # How many writes between checks of the number of entries
+    eviction_interval = 100
+
+    def __init__(
+            self,
+            path: Path,
+            max_entries: int | None = None,
+            max_age: float | None = None,
+            bypass: bool = False,
+    ):
+        """
+        Parameters
+        ----------
+        path
+            The SQLite database file. Parent directories are created if required.
+        max_entries
+            The maximum number of entries kept
+        max_age
+            The maximum age of an entry in seconds
+        bypass
+            If True lookups always miss but new results are still stored, refreshing the cache
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.bypass = bypass
+
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                analysis TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+        self._connection.commit()
+        self.evict()
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def get(self, key: str, output_type: type[LensFitAnalysis] = LensFitAnalysis) -> LensFitAnalysis | None:
+        """
+        Retrieve the analysis stored under the key, or None if there is no fresh entry.
+
+        The stored analysis is validated as `output_type`, which may be a subclass with extra fields.
+        """
+        if self.bypass:
+            self.misses += 1
+            return None
+
+        row = self._connection.execute(
+            "SELECT analysis, created_at FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+            self.misses += 1
+            return None
+
+        self._connection.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+        self._connection.commit()
+        self.hits += 1
+        return output_type.model_validate_json(row[0])
+
+    def put(self, key: str, analysis: LensFitAnalysis):
+        """
+        Store an analysis under the key, replacing any existing entry.
+        """
+        now = time.time()
+        self._connection.execute(
+            "INSERT OR REPLACE INTO results (key, analysis, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, analysis.model_dump_json(), now, now),
+        )
+        self._connection.commit()
+
+        self._writes += 1
+        if self._writes % self.eviction_interval == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove expired entries and, if there are too many, the least recently used entries.
+        """
+        if self.max_age is not None:
+            self._connection.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.max_age,))
+        if self.max_entries is not None:
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self._connection.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed_at LIMIT ?)",
+                    (excess,),
+                )
+        self._connection.commit()
+
+    def summary(self) -> str:
+        """
+        A one line description of how effective the cache has been.
+        """
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"Cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate), {len(self)} entries"
+
+
+def add_cache_arguments(parser: ArgumentParser):
+    """
+    Add options controlling the result cache to a script's argument parser.
+    """
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        default=DEFAULT_CACHE_PATH,
+        help=f"SQLite file caching previous results (default: {DEFAULT_CACHE_PATH})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Neither read from nor write to the cache",
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Ignore cached results but store new ones",
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=None,
+        help="Maximum age of a cached result in days",
+    )
+
+
+def cache_from_arguments(args: Namespace) -> ResultCache | None:
+    """
+    Create the result cache described by arguments added with `add_cache_arguments`.
+    """
+    if args.no_cache:
+        return None
+    return ResultCache(
+        args.cache,
+        max_entries=args.cache_max_entries,
+        max_age=None if args.cache_max_age is None else args.cache_max_age * 24 * 60 * 60,
+        bypass=args.refresh_cache,
+    )
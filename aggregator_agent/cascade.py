@@ -0,0 +1,123 @@
+"""
+A cascade in which a cheaper, faster model categorises each image first and only doubtful results are escalated.
+
+The small model reports a confidence alongside its analysis. Results below the confidence threshold, or in a category
+configured as hard, are re-run on the large model.
+"""
+from argparse import ArgumentParser, Namespace
+from typing import TYPE_CHECKING
+
+from pydantic import BaseModel
+
+from aggregator_agent.schema import Category, ConfidentLensFitAnalysis, LensFitAnalysis
+
+if TYPE_CHECKING:
+    from pydantic_ai.models import Model
+
+DEFAULT_SMALL_MODEL = "gpt-5-mini"
+DEFAULT_MIN_CONFIDENCE = 0.8
+DEFAULT_HARD_CATEGORIES = (Category.MightBeLensBadModel,)
+
+
+class CascadeOutcome(BaseModel):
+    """
+    The result of categorising an image through the cascade.
+
+    Attributes
+    ----------
+    analysis - the final analysis, from the large model if the image was escalated
+    screening - the analysis and confidence given by the small model
+    escalated - whether the image was re-run on the large model
+    """
+
+    analysis: LensFitAnalysis
+    screening: ConfidentLensFitAnalysis
+    escalated: bool
+
+
+class Cascade:
+    """
+    Decides which small model results are escalated, counting how many are accepted and how many escalated.
+    """
+
+    def __init__(
+            self,
+            small_model: "Model | str" = DEFAULT_SMALL_MODEL,
+            min_confidence: float = DEFAULT_MIN_CONFIDENCE,
+            hard_categories: tuple[Category, ...] = DEFAULT_HARD_CATEGORIES,
+    ):
+        """
+        Parameters
+        ----------
+        small_model
+            The model which categorises every image first
+        min_confidence
+            Results with a lower confidence are escalated to the large model
+        hard_categories
+            Results in these categories are always escalated
+        """
+        if not 0.0 <= min_confidence <= 1.0:
+            raise ValueError(f"min_confidence must be between 0 and 1, got {min_confidence}")
+        self.small_model = small_model
+        self.min_confidence = min_confidence
+        self.hard_categories = tuple(hard_categories)
+        self.accepted = 0
+        self.escalated = 0
+
+    def should_escalate(self, screening: ConfidentLensFitAnalysis) -> bool:
+        """
+        Whether the small model's analysis is too doubtful to accept, recording the decision.
+        """
+        escalate = screening.confidence < self.min_confidence or screening.category in self.hard_categories
+        if escalate:
+            self.escalated += 1
+        else:
+            self.accepted += 1
+        return escalate
+
+    def summary(self) -> str:
+        total = self.accepted + self.escalated
+        rate = self.escalated / total if total else 0.0
+        return f"Cascade: {self.accepted} accepted from the small model, {self.escalated} escalated ({rate:.0%})"
+
+
+def add_cascade_arguments(parser: ArgumentParser):
+    """
+    Add options controlling the model cascade to a script's argument parser.
+    """
+    parser.add_argument(
+        "--cascade",
+        action="store_true",
+        help="Categorise with a small model first and escalate doubtful results to the large model",
+    )
+    parser.add_argument(
+        "--small-model",
+        default=DEFAULT_SMALL_MODEL,
+        help=f"The model used first in the cascade (default: {DEFAULT_SMALL_MODEL})",
+    )
+    parser.add_argument(
+        "--min-confidence",
+        type=float,
+        default=DEFAULT_MIN_CONFIDENCE,
+        help="Small model results with a lower confidence are escalated",
+    )
+    parser.add_argument(
+        "--escalate-categories",
+        type=Category,
+        nargs="*",
+        default=list(DEFAULT_HARD_CATEGORIES),
+        help="Small model results in these categories are always escalated",
+    )
+
+
+def cascade_from_arguments(args: Namespace) -> Cascade | None:
+    """
+    Create the cascade described by arguments added with `add_cascade_arguments`, or None if it is not enabled.
+    """
+    if not args.cascade:
+        return None
+    return Cascade(
+        small_model=args.small_model,
+        min_confidence=args.min_confidence,
+        hard_categories=tuple(args.escalate_categories),
+    )
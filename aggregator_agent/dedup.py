@@ -0,0 +1,225 @@
+"""
+Perceptual hash deduplication so that near-identical images reuse an existing classification.
+
+Reruns and overlapping tiles often produce visually near-identical four panel images under different IDs. Each panel
+is reduced to a 64 bit difference hash (dHash) and the four are concatenated into a 256 bit hash. Images whose hashes
+differ in at most `max_distance` bits inherit the analysis of the nearest indexed image instead of calling the VLM.
+"""
+import sqlite3
+from pathlib import Path
+
+from PIL import Image
+
+from aggregator_agent.preprocessing import PANEL_NAMES
+from aggregator_agent.schema import LensFitAnalysis
+
+# Each panel hash has HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+DEFAULT_MAX_DISTANCE = 12
+
+
+def dhash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """
+    A difference hash: whether each pixel of a downscaled greyscale image is brighter than its right neighbour.
+    """
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            offset = row * (hash_size + 1) + column
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def image_hash(image_path: Path) -> int:
+    """
+    Concatenate the difference hashes of each panel of the image at the given path.
+    """
+    with Image.open(image_path) as image:
+        width = image.width // len(PANEL_NAMES)
+        value = 0
+        for index in range(len(PANEL_NAMES)):
+            panel = image.crop((index * width, 0, (index + 1) * width, image.height))
+            value = (value << HASH_SIZE * HASH_SIZE) | dhash(panel)
+    return value
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return (first ^ second).bit_count()
+
+
+class BKTree:
+    """
+    A Burkhard-Keller tree of hashes supporting nearest neighbour queries under Hamming distance.
+
+    Each child is keyed by its distance from its parent, so by the triangle inequality a query only descends into
+    children whose key is within the search radius of the query's distance to the parent. Removed hashes are left in
+    place, without an image ID, as their children are still reached through them.
+    """
+
+    def __init__(self):
+        # Each node is [hash, image ID or None once removed, children keyed by distance]
+        self._root: list | None = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, value: int, image_id: str):
+        node = [value, image_id, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+
+        parent = self._root
+        while True:
+            distance = hamming_distance(value, parent[0])
+            if distance not in parent[2]:
+                parent[2][distance] = node
+                return
+            parent = parent[2][distance]
+
+    def remove(self, value: int, image_id: str):
+        """
+        Remove a hash added for an image, following the path it was added along.
+        """
+        node = self._root
+        while node is not None:
+            if node[0] == value and node[1] == image_id:
+                node[1] = None
+                self._size -= 1
+                return
+            node = node[2].get(hamming_distance(value, node[0]))
+
+    def nearest(self, value: int, max_distance: int, exclude: str | None = None) -> tuple[str, int] | None:
+        """
+        The ID of the closest hash within max_distance, other than one added for the excluded image, and its distance,
+        or None if there is none.
+        """
+        if self._root is None:
+            return None
+
+        best = None
+        radius = max_distance
+        stack = [self._root]
+        while stack:
+            node_value, image_id, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= radius and image_id is not None and image_id != exclude:
+                best = (image_id, distance)
+                if distance == 0:
+                    break
+                # Only a strictly closer match can improve on this one
+                radius = distance - 1
+            stack.extend(
+                child for key, child in children.items()
+                if distance - radius <= key <= distance + radius
+            )
+        return best
+
+
+class DuplicateIndex:
+    """
+    A persistent index of image hashes and their analyses, backed by SQLite and searched with a BK-tree.
+
+    Images that inherit an analysis are recorded with the ID of the image it was originally given to. An image is
+    never matched with its own entry, and indexing it again, e.g. after it is rewritten, replaces that entry.
+
+    Every hash and image ID is held in memory in the BK-tree, roughly 350 bytes per indexed image, so an index of a
+    million images needs around 350 MB. Analyses stay in SQLite and are only read when they are reused.
+    """
+
+    def __init__(self, path: Path, max_distance: int = DEFAULT_MAX_DISTANCE):
+        """
+        Parameters
+        ----------
+        path
+            The SQLite database file, usually next to the results it indexes
+        max_distance
+            The maximum number of differing hash bits for an image to count as a near-duplicate
+        """
+        self.path = path
+        self.max_distance = max_distance
+        self.reused = 0
+        self.added = 0
+
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS hashes (
+                id TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                analysis TEXT NOT NULL,
+                inherited_from TEXT
+            )
+            """
+        )
+        self._connection.commit()
+
+        self._tree = BKTree()
+        for image_id, value in self._connection.execute("SELECT id, hash FROM hashes"):
+            self._tree.add(int(value, 16), image_id)
+
+    def __enter__(self) -> "DuplicateIndex":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._tree)
+
+    def close(self):
+        self._connection.close()
+
+    def _insert(self, image_id: str, value: int, analysis: LensFitAnalysis, inherited_from: str | None):
+        previous = self._connection.execute("SELECT hash FROM hashes WHERE id = ?", (image_id,)).fetchone()
+        self._connection.execute(
+            "INSERT OR REPLACE INTO hashes (id, hash, analysis, inherited_from) VALUES (?, ?, ?, ?)",
+            (image_id, f"{value:064x}", analysis.model_dump_json(), inherited_from),
+        )
+        self._connection.commit()
+        if previous is not None:
+            self._tree.remove(int(previous[0], 16), image_id)
+        self._tree.add(value, image_id)
+
+    def lookup(self, image_id: str, value: int) -> LensFitAnalysis | None:
+        """
+        Reuse the analysis of the nearest near-duplicate, recording that this image inherited it, or return None if
+        there is no near-duplicate. The image's own entry, from before it was rewritten, is not a near-duplicate.
+        """
+        if (match := self._tree.nearest(value, self.max_distance, exclude=image_id)) is None:
+            return None
+
+        analysis, inherited_from = self._connection.execute(
+            "SELECT analysis, inherited_from FROM hashes WHERE id = ?",
+            (match[0],),
+        ).fetchone()
+        analysis = LensFitAnalysis.model_validate_json(analysis)
+        # A copy of an earlier version of this image is recorded as the source rather than the image itself
+        if inherited_from in (None, image_id):
+            inherited_from = match[0]
+        self._insert(image_id, value, analysis, inherited_from)
+        self.reused += 1
+        return analysis
+
+    def add(self, image_id: str, value: int, analysis: LensFitAnalysis):
+        """
+        Index an analysis given to an image so near-duplicates can reuse it.
+        """
+        self._insert(image_id, value, analysis, None)
+        self.added += 1
+
+    def inherited_from(self, image_id: str) -> str | None:
+        """
+        The ID of the image whose analysis this image inherited, or None if it was categorised directly.
+        """
+        row = self._connection.execute("SELECT inherited_from FROM hashes WHERE id = ?", (image_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def summary(self) -> str:
+        total = self.reused + self.added
+        rate = self.reused / total if total else 0.0
+        return f"Deduplication: {self.reused} reused from near-duplicates ({rate:.0%} of calls avoided), {len(self)} indexed"
@@ -0,0 +1,184 @@
+"""
+Sequential, stratified evaluation against ground truth which stops as soon as the answer is known.
+
+Ground truths are sampled round-robin across categories so each class is measured at a similar rate however
+imbalanced the labels are. Per-class accuracy and each cell of the row-normalised confusion matrix carry a Wilson score
+interval, and evaluation stops once every interval is narrow enough. When two configurations are compared on the same
+images, an exact McNemar test on the images they disagree about can stop evaluation as soon as one is significantly
+better.
+"""
+import math
+import random
+from collections import defaultdict
+from typing import Hashable, Iterable, Iterator, TypeVar
+
+from aggregator_agent.schema import Category
+
+T = TypeVar("T")
+
+
+def wilson_interval(successes: int, trials: int, z: float = 1.96) -> tuple[float, float]:
+    """
+    The Wilson score interval for a binomial proportion, which behaves well for small samples and extreme rates.
+
+    Returns (0, 1) if there are no trials.
+    """
+    if trials == 0:
+        return 0.0, 1.0
+    proportion = successes / trials
+    denominator = 1 + z ** 2 / trials
+    centre = (proportion + z ** 2 / (2 * trials)) / denominator
+    half_width = z * math.sqrt(proportion * (1 - proportion) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+
+def mcnemar_p_value(only_first: int, only_second: int) -> float:
+    """
+    The two-sided exact McNemar p-value given the number of images only the first and only the second configuration
+    got right.
+    """
+    discordant = only_first + only_second
+    if discordant == 0:
+        return 1.0
+    tail = sum(math.comb(discordant, k) for k in range(min(only_first, only_second) + 1)) / 2 ** discordant
+    return min(1.0, 2 * tail)
+
+
+def stratified(items: Iterable[T], key, seed: int | None = None) -> Iterator[T]:
+    """
+    Yield items round-robin across the strata given by key, shuffling within each stratum.
+
+    Strata that run out are skipped, so every item is eventually yielded.
+    """
+    rng = random.Random(seed)
+    strata: dict[Hashable, list[T]] = defaultdict(list)
+    for item in items:
+        strata[key(item)].append(item)
+    for stratum in strata.values():
+        rng.shuffle(stratum)
+
+    order = list(strata)
+    rng.shuffle(order)
+    while order:
+        for stratum in list(order):
+            yield strata[stratum].pop()
+            if not strata[stratum]:
+                order.remove(stratum)
+
+
+class SequentialEvaluation:
+    """
+    Per-class accuracy and a confusion matrix for one configuration, updated as results arrive.
+    """
+
+    def __init__(self, z: float = 1.96):
+        """
+        Parameters
+        ----------
+        z
+            The normal quantile for intervals, 1.96 for 95%
+        """
+        self.z = z
+        self.confusion: dict[Category, dict[Category, int]] = defaultdict(lambda: defaultdict(int))
+
+    def update(self, expected: Category, predicted: Category):
+        self.confusion[expected][predicted] += 1
+
+    @property
+    def count(self) -> int:
+        return sum(self.support(category) for category in self.confusion)
+
+    @property
+    def correct(self) -> int:
+        return sum(row[category] for category, row in self.confusion.items())
+
+    def support(self, category: Category) -> int:
+        return sum(self.confusion[category].values())
+
+    def accuracy_interval(self, category: Category) -> tuple[float, float]:
+        """
+        The interval on the fraction of images of the category which are predicted correctly.
+        """
+        return wilson_interval(self.confusion[category][category], self.support(category), self.z)
+
+    def confusion_interval(self, expected: Category, predicted: Category) -> tuple[float, float]:
+        """
+        The interval on the fraction of images of the expected category which are given the predicted category.
+        """
+        return wilson_interval(self.confusion[expected][predicted], self.support(expected), self.z)
+
+    def is_converged(self, max_width: float, min_per_class: int, exhausted: set[Category] = frozenset()) -> bool:
+        """
+        Whether every class has at least min_per_class results and every accuracy and confusion interval is at most
+        max_width wide. Classes with no more ground truth to draw are not required to converge.
+        """
+        for category in Category:
+            if category in exhausted:
+                continue
+            if self.support(category) < min_per_class:
+                return False
+            intervals = [self.confusion_interval(category, predicted) for predicted in Category]
+            if any(high - low > max_width for low, high in intervals):
+                return False
+        return True
+
+    def report(self) -> list[str]:
+        """
+        Lines describing accuracy for each class with its interval.
+        """
+        lines = []
+        for category in Category:
+            support = self.support(category)
+            if support == 0:
+                continue
+            low, high = self.accuracy_interval(category)
+            correct = self.confusion[category][category]
+            lines.append(f"{category:<20} {correct:>4}/{support:<4} {correct / support:>6.1%}  [{low:.1%}, {high:.1%}]")
+        if self.count:
+            low, high = wilson_interval(self.correct, self.count, self.z)
+            lines.append(
+                f"{'Overall':<20} {self.correct:>4}/{self.count:<4} {self.correct / self.count:>6.1%}  "
+                f"[{low:.1%}, {high:.1%}]"
+            )
+        return lines
+
+
+class PairedComparison:
+    """
+    Counts how often each of two configurations is right on the same images, testing whether they differ.
+
+    Because the test is repeated as results arrive, the significance level is divided by the maximum number of looks
+    (a Bonferroni correction) so that stopping early does not inflate the false positive rate.
+    """
+
+    def __init__(self, alpha: float = 0.05, max_looks: int = 1):
+        self.alpha = alpha
+        self.max_looks = max_looks
+        self.only_first = 0
+        self.only_second = 0
+        self.both = 0
+        self.neither = 0
+
+    def update(self, first_correct: bool, second_correct: bool):
+        if first_correct and second_correct:
+            self.both += 1
+        elif first_correct:
+            self.only_first += 1
+        elif second_correct:
+            self.only_second += 1
+        else:
+            self.neither += 1
+
+    @property
+    def p_value(self) -> float:
+        return mcnemar_p_value(self.only_first, self.only_second)
+
+    def is_significant(self) -> bool:
+        return self.p_value < self.alpha / self.max_looks
+
+    def summary(self) -> str:
+        return (
+            f"Only first correct: {self.only_first}, only second correct: {self.only_second}, "
+            f"both: {self.both}, neither: {self.neither}, McNemar p = {self.p_value:.4f} "
+            f"(significant below {self.alpha / self.max_looks:.4f})"
+        )
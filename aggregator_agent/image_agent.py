@@ -1,8 +1,23 @@
+import asyncio
+import functools
+import itertools
+import json
+from collections import Counter
 from pathlib import Path
+from typing import AsyncIterator, Iterable
 
-from pydantic_ai import Agent, BinaryContent
+from pydantic_ai import Agent, AgentRunResult, BinaryContent
+from pydantic_ai.messages import UserContent
+from pydantic_ai.models import Model
 
-from aggregator_agent.schema import LensFitAnalysis
+from aggregator_agent.cache import ResultCache, cache_key
+from aggregator_agent.cascade import Cascade, CascadeOutcome
+from aggregator_agent.dedup import DuplicateIndex, image_hash
+from aggregator_agent.preprocessing import Preprocessing, preprocess_file
+from aggregator_agent.schema import Category, ConfidentLensFitAnalysis, IdentifiedLensFitAnalysis, LensFitAnalysis
+from aggregator_agent.telemetry import CallLog, CallRecord, optional_record
+from aggregator_agent.triage import Triage
+from aggregator_agent.voting import VoteOutcome, Voting, is_decided
 
 SYSTEM_PROMPT = """
 You are an expert in gravitational lens modelling and classification. Your task is to classify the results of lens
@@ -107,25 +122,622 @@ The lens–non-lens decision is clear, with:
 In short: the data are good, the model is adequate, and the system can be confidently classified.
 """
 
-agent = Agent(
-    model='gpt-5',
-    instructions=SYSTEM_PROMPT,
-    output_type=LensFitAnalysis,
-)
+GROUP_PROMPT = SYSTEM_PROMPT + """
+You will be presented with several images, each preceded by its ID. Categorise each image independently and return
+exactly one analysis per image, with its id set to the ID given before that image.
+"""
+
+CONFIDENT_PROMPT = SYSTEM_PROMPT + """
+Also give your confidence, from 0 to 1, that the category you chose is correct. Be honest: results with low confidence
+are checked by a stronger model.
+"""
+
+# Part of the cache key so that changes to the output schema invalidate cached results
+OUTPUT_SCHEMA = json.dumps(LensFitAnalysis.model_json_schema(), sort_keys=True)
+GROUP_OUTPUT_SCHEMA = json.dumps(IdentifiedLensFitAnalysis.model_json_schema(), sort_keys=True)
+CONFIDENT_OUTPUT_SCHEMA = json.dumps(ConfidentLensFitAnalysis.model_json_schema(), sort_keys=True)
 
 
-def categorise(image_path: Path) -> LensFitAnalysis:
+def prompt_hash(instructions: str, output_schema: str) -> str:
     """
-    Ask the LLM to categorise the image at the given path.
+    Identifies the instructions and output schema a result was produced with.
+    """
+    return cache_key(instructions, output_schema)[:16]
+
+
+PROMPT_HASH = prompt_hash(SYSTEM_PROMPT, OUTPUT_SCHEMA)
+GROUP_PROMPT_HASH = prompt_hash(GROUP_PROMPT, GROUP_OUTPUT_SCHEMA)
+CONFIDENT_PROMPT_HASH = prompt_hash(CONFIDENT_PROMPT, CONFIDENT_OUTPUT_SCHEMA)
+
+
+# Agents are built on first use rather than on import and then shared by the whole process. The model check is
+# deferred too, as it creates the provider's client, which needs credentials, even for runs given another model.
+
+@functools.cache
+def get_agent() -> Agent[None, LensFitAnalysis]:
+    """
+    The agent which categorises a single image.
+    """
+    return Agent(
+        model='gpt-5',
+        instructions=SYSTEM_PROMPT,
+        output_type=LensFitAnalysis,
+        defer_model_check=True,
+    )
+
+
+@functools.cache
+def get_group_agent() -> Agent[None, list[IdentifiedLensFitAnalysis]]:
+    """
+    The agent which categorises several images in one run, amortising the instructions and request overhead.
+    """
+    return Agent(
+        model='gpt-5',
+        instructions=GROUP_PROMPT,
+        output_type=list[IdentifiedLensFitAnalysis],
+        defer_model_check=True,
+    )
+
+
+@functools.cache
+def get_confident_agent() -> Agent[None, ConfidentLensFitAnalysis]:
+    """
+    The agent which screens images first in a cascade. The model is supplied by the Cascade.
+    """
+    return Agent(
+        instructions=CONFIDENT_PROMPT,
+        output_type=ConfidentLensFitAnalysis,
+    )
+
+
+_AGENTS = {"agent": get_agent, "group_agent": get_group_agent, "confident_agent": get_confident_agent}
+
+
+def __getattr__(name: str):
+    # The agents were once module attributes, e.g. `from aggregator_agent.image_agent import agent`, which still works
+    if name in _AGENTS:
+        return _AGENTS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _prompt(image_path: Path, preprocessing: Preprocessing | None = None) -> list[UserContent]:
     """
-    with image_path.open("rb") as f:
-        image_bytes = f.read()
+    Read the image at the given path into content that can be sent to the LLM.
 
-    return agent.run_sync(
-        [
+    If preprocessing is given the image is transformed first, and if panels have been dropped a note saying which
+    remain is included.
+    """
+    if preprocessing is None:
+        with image_path.open("rb") as f:
+            image_bytes = f.read()
+        return [
             BinaryContent(
                 data=image_bytes,
                 media_type="image/png"  # or image/jpeg etc. depending on the file
             ),
         ]
-    ).output
+
+    image_bytes, _ = preprocess_file(image_path, preprocessing)
+    prompt: list[UserContent] = [BinaryContent(data=image_bytes, media_type=preprocessing.media_type)]
+    if preprocessing.panel_note is not None:
+        prompt.insert(0, preprocessing.panel_note)
+    return prompt
+
+
+def _model_name(model: Model | str | None) -> str:
+    """
+    The name of the model that will answer a request, given an optional override of the agent's model.
+    """
+    model = model or get_agent().model
+    return model if isinstance(model, str) else model.model_name
+
+
+def _cache_key(
+        prompt: list[UserContent],
+        model: Model | str | None,
+        instructions: str = SYSTEM_PROMPT,
+        output_schema: str = OUTPUT_SCHEMA,
+) -> str:
+    """
+    Key a request by everything that determines its answer.
+    """
+    parts = [
+        part.data if isinstance(part, BinaryContent) else part
+        for part in prompt
+    ]
+    return cache_key(*parts, instructions, _model_name(model), output_schema)
+
+
+def _record_result(record: CallRecord, result: AgentRunResult):
+    """
+    Add the token usage and categories of an agent run to its call record.
+    """
+    usage = result.usage()
+    record.input_tokens = usage.input_tokens
+    record.output_tokens = usage.output_tokens
+    output = result.output if isinstance(result.output, list) else [result.output]
+    record.categories = [analysis.category for analysis in output]
+
+
+def categorise(
+        image_path: Path,
+        cache: ResultCache | None = None,
+        preprocessing: Preprocessing | None = None,
+        model: Model | str | None = None,
+        call_log: CallLog | None = None,
+) -> LensFitAnalysis:
+    """
+    Ask the LLM to categorise the image at the given path.
+
+    If a cache is given previous answers for identical requests are reused. If preprocessing is given the image is
+    transformed before it is sent. The agent's model can be overridden, e.g. with a rate limited model. If a call log
+    is given telemetry for the call is appended to it.
+    """
+    prompt = _prompt(image_path, preprocessing)
+    with optional_record(call_log, "categorise", [image_path.stem], _model_name(model), prompt) as record:
+        record.prompt_hash = PROMPT_HASH
+        if cache is not None:
+            key = _cache_key(prompt, model)
+            if (cached := cache.get(key)) is not None:
+                record.cache_hit = True
+                record.categories = [cached.category]
+                return cached
+
+        result = get_agent().run_sync(prompt, model=model)
+        _record_result(record, result)
+
+    if cache is not None:
+        cache.put(key, result.output)
+    return result.output
+
+
+async def categorise_async(
+        image_path: Path,
+        model: Model | str | None = None,
+        cache: ResultCache | None = None,
+        preprocessing: Preprocessing | None = None,
+        call_log: CallLog | None = None,
+        instructions: str = SYSTEM_PROMPT,
+) -> LensFitAnalysis:
+    """
+    Ask the LLM to categorise the image at the given path without blocking the event loop.
+
+    Parameters
+    ----------
+    image_path
+        The four panel image output by lens modelling
+    model
+        Optionally override the model used by the agent, e.g. with a local stand-in
+    cache
+        If given previous answers for identical requests are reused
+    preprocessing
+        If given the image is transformed before it is sent
+    call_log
+        If given telemetry for the call is appended to it
+    instructions
+        Optionally replace the agent's instructions, e.g. to compare prompts
+    """
+    prompt = await asyncio.to_thread(_prompt, image_path, preprocessing)
+    with optional_record(call_log, "categorise", [image_path.stem], _model_name(model), prompt) as record:
+        record.prompt_hash = prompt_hash(instructions, OUTPUT_SCHEMA)
+        if cache is not None:
+            key = _cache_key(prompt, model, instructions)
+            if (cached := cache.get(key)) is not None:
+                record.cache_hit = True
+                record.categories = [cached.category]
+                return cached
+
+        # The override only applies within this task, so concurrent runs with other instructions are unaffected
+        with get_agent().override(instructions=instructions):
+            result = await get_agent().run(prompt, model=model)
+        _record_result(record, result)
+
+    if cache is not None:
+        cache.put(key, result.output)
+    return result.output
+
+
+async def categorise_cascade(
+        image_path: Path,
+        cascade: Cascade,
+        model: Model | str | None = None,
+        cache: ResultCache | None = None,
+        preprocessing: Preprocessing | None = None,
+        call_log: CallLog | None = None,
+) -> CascadeOutcome:
+    """
+    Categorise the image with the cascade's small model, escalating to the large model if the result is doubtful.
+
+    Parameters
+    ----------
+    image_path
+        The four panel image output by lens modelling
+    cascade
+        The small model and the thresholds deciding which results are escalated
+    model
+        Optionally override the large model, e.g. with a local stand-in
+    cache
+        If given previous answers for identical requests to either model are reused
+    preprocessing
+        If given the image is transformed before it is sent
+    call_log
+        If given telemetry for the call to each model is appended to it
+    """
+    prompt = await asyncio.to_thread(_prompt, image_path, preprocessing)
+    small_model_name = _model_name(cascade.small_model)
+    with optional_record(call_log, "screen", [image_path.stem], small_model_name, prompt) as record:
+        record.prompt_hash = CONFIDENT_PROMPT_HASH
+        screening = None
+        if cache is not None:
+            key = _cache_key(prompt, cascade.small_model, CONFIDENT_PROMPT, CONFIDENT_OUTPUT_SCHEMA)
+            screening = cache.get(key, ConfidentLensFitAnalysis)
+            record.cache_hit = screening is not None
+
+        if screening is None:
+            result = await get_confident_agent().run(prompt, model=cascade.small_model)
+            _record_result(record, result)
+            screening = result.output
+            if cache is not None:
+                cache.put(key, screening)
+        record.categories = [screening.category]
+
+    if not cascade.should_escalate(screening):
+        return CascadeOutcome(
+            analysis=LensFitAnalysis.model_validate(screening, from_attributes=True),
+            screening=screening,
+            escalated=False,
+        )
+
+    analysis = await categorise_async(
+        image_path,
+        model=model,
+        cache=cache,
+        preprocessing=preprocessing,
+        call_log=call_log,
+    )
+    return CascadeOutcome(analysis=analysis, screening=screening, escalated=True)
+
+
+async def categorise_vote(
+        image_path: Path,
+        voting: Voting,
+        model: Model | str | None = None,
+        preprocessing: Preprocessing | None = None,
+        call_log: CallLog | None = None,
+) -> VoteOutcome:
+    """
+    Categorise the image with several concurrent runs and take the majority category.
+
+    Outstanding runs are cancelled as soon as one category has a majority they could not overturn. Results are not
+    cached, as each run must be an independent sample.
+
+    Parameters
+    ----------
+    image_path
+        The four panel image output by lens modelling
+    voting
+        The number of runs and the categories which are voted on
+    model
+        Optionally override the model used by the agent, e.g. with a local stand-in
+    preprocessing
+        If given the image is transformed before it is sent
+    call_log
+        If given telemetry for each run is appended to it
+    """
+    prompt = await asyncio.to_thread(_prompt, image_path, preprocessing)
+
+    async def run() -> LensFitAnalysis:
+        with optional_record(call_log, "vote", [image_path.stem], _model_name(model), prompt) as record:
+            record.prompt_hash = PROMPT_HASH
+            result = await get_agent().run(prompt, model=model)
+            _record_result(record, result)
+        return result.output
+
+    votes = Counter()
+    analyses: dict[Category, LensFitAnalysis] = {}
+    first = None
+    runs = 0
+    errors = []
+
+    if voting.borderline is not None:
+        first = await run()
+        runs = 1
+        votes[first.category] += 1
+        analyses[first.category] = first
+
+    if first is None or voting.needs_vote(first):
+        pending = {asyncio.create_task(run()) for _ in range(voting.votes - runs)}
+        try:
+            while pending and not is_decided(votes, len(pending)):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    runs += 1
+                    if (exception := task.exception()) is not None:
+                        errors.append(exception)
+                        continue
+                    analysis = task.result()
+                    first = first or analysis
+                    votes[analysis.category] += 1
+                    analyses.setdefault(analysis.category, analysis)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    if not votes:
+        raise errors[0]
+
+    winner = votes.most_common(1)[0][0]
+    outcome = VoteOutcome(analysis=analyses[winner], first=first, votes=dict(votes), runs=runs)
+    voting.record(outcome)
+    return outcome
+
+
+async def categorise_group(
+        image_paths: list[Path],
+        model: Model | str | None = None,
+        cache: ResultCache | None = None,
+        preprocessing: Preprocessing | None = None,
+        call_log: CallLog | None = None,
+) -> list[tuple[Path, LensFitAnalysis | Exception]]:
+    """
+    Categorise several images in a single agent run, so the instructions are sent once for all of them.
+
+    Each image is tagged with its ID (the filename without suffix). Images whose ID is missing from the output or
+    appears more than once are re-queued and categorised individually, as are all the images if the grouped run fails.
+    Re-queued images are categorised one at a time, so a group never has more than one request in flight and stays
+    within the concurrency of its caller.
+
+    Parameters
+    ----------
+    image_paths
+        The images to categorise together. An image with the same ID as an earlier one, e.g. from another
+        directory, is categorised individually rather than in the group.
+    model
+        Optionally override the model used by the agents, e.g. with a local stand-in
+    cache
+        If given previous answers for identical requests are reused
+    preprocessing
+        If given each image is transformed before it is sent
+    call_log
+        If given telemetry for each call is appended to it. Images found in the cache share one record.
+
+    Returns
+    -------
+    Each path paired with its analysis, or with the exception raised if it could not be categorised
+    """
+    paths: dict[str, Path] = {}
+    clashing: list[Path] = []
+    for path in image_paths:
+        if path.stem not in paths:
+            paths[path.stem] = path
+        elif path != paths[path.stem] and path not in clashing:
+            clashing.append(path)
+    prompts = {
+        image_id: await asyncio.to_thread(_prompt, path, preprocessing)
+        for image_id, path in paths.items()
+    }
+    results: dict[str, LensFitAnalysis | Exception] = {}
+
+    keys = {}
+    if cache is not None:
+        for image_id, prompt in prompts.items():
+            keys[image_id] = _cache_key(prompt, model, GROUP_PROMPT, GROUP_OUTPUT_SCHEMA)
+            if (cached := cache.get(keys[image_id])) is not None:
+                results[image_id] = cached
+        if results and call_log is not None:
+            with call_log.record("categorise_group", list(results), _model_name(model)) as record:
+                record.prompt_hash = GROUP_PROMPT_HASH
+                record.cache_hit = True
+                record.categories = [analysis.category for analysis in results.values()]
+
+    uncached = [image_id for image_id in prompts if image_id not in results]
+    if len(uncached) > 1:
+        prompt: list[UserContent] = []
+        for image_id in uncached:
+            prompt.append(f"Image ID: {image_id}")
+            prompt.extend(prompts[image_id])
+
+        try:
+            with optional_record(call_log, "categorise_group", uncached, _model_name(model), prompt) as record:
+                record.prompt_hash = GROUP_PROMPT_HASH
+                result = await get_group_agent().run(prompt, model=model)
+                _record_result(record, result)
+        except Exception:
+            # Every image is re-queued, so one that cannot be categorised does not fail the others
+            output = []
+        else:
+            output = result.output
+
+        analyses: dict[str, list[IdentifiedLensFitAnalysis]] = {}
+        for analysis in output:
+            analyses.setdefault(analysis.id, []).append(analysis)
+        for image_id in uncached:
+            if len(analyses.get(image_id, [])) == 1:
+                results[image_id] = LensFitAnalysis.model_validate(analyses[image_id][0], from_attributes=True)
+                if cache is not None:
+                    cache.put(keys[image_id], results[image_id])
+
+    individual: dict[Path, LensFitAnalysis | Exception] = {}
+    for path in [paths[image_id] for image_id in prompts if image_id not in results] + clashing:
+        try:
+            individual[path] = await categorise_async(
+                path,
+                model=model,
+                cache=cache,
+                preprocessing=preprocessing,
+                call_log=call_log,
+            )
+        except Exception as e:
+            individual[path] = e
+
+    return [
+        (path, individual[path] if path in individual else results[path.stem])
+        for path in image_paths
+    ]
+
+
+async def categorise_many(
+        image_paths: Iterable[Path],
+        concurrency: int = 8,
+        model: Model | str | None = None,
+        cache: ResultCache | None = None,
+        preprocessing: Preprocessing | None = None,
+        group_size: int = 1,
+        triage: Triage | None = None,
+        cascade: Cascade | None = None,
+        dedup: DuplicateIndex | None = None,
+        call_log: CallLog | None = None,
+        voting: Voting | None = None,
+        return_exceptions: bool = False,
+) -> AsyncIterator[tuple[Path, LensFitAnalysis | Exception]]:
+    """
+    Categorise many images with at most `concurrency` requests in flight at once.
+
+    Paths are consumed lazily so very large directories can be streamed, and results are yielded in the order
+    they complete rather than the order of `image_paths`.
+
+    Parameters
+    ----------
+    image_paths
+        The images to categorise
+    concurrency
+        The maximum number of requests that may be waiting on the model at any time
+    model
+        Optionally override the model used by the agent, e.g. with a local stand-in
+    cache
+        If given previous answers for identical requests are reused
+    preprocessing
+        If given each image is transformed before it is sent
+    group_size
+        The number of images sent together in each request, see `categorise_group`
+    triage
+        If given images are first triaged locally and only those it cannot decide are sent to the model
+    cascade
+        If given each image is categorised by a small model first and only doubtful results are sent to the large
+        model, see `categorise_cascade`. Images are then sent individually regardless of group_size.
+    dedup
+        If given images which are near-duplicates of an indexed image reuse its analysis, and new analyses are indexed
+    call_log
+        If given telemetry for each call is appended to it
+    voting
+        If given each image is categorised by a majority of concurrent runs, see `categorise_vote`. Images are then
+        sent individually regardless of group_size, and the cache is not used.
+    return_exceptions
+        If True an image that fails is yielded with its exception rather than aborting the remaining images
+
+    Yields
+    ------
+    Each path paired with its analysis, or with the exception raised if return_exceptions is True
+    """
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+    if group_size < 1:
+        raise ValueError(f"group_size must be at least 1, got {group_size}")
+    if cascade is not None and voting is not None:
+        raise ValueError("A cascade and voting cannot be used together")
+
+    paths = iter(image_paths)
+    pending: dict[asyncio.Task, list[Path]] = {}
+
+    async def categorise_chunk(chunk: list[Path]) -> list[tuple[Path, LensFitAnalysis | Exception]]:
+        results = []
+        if triage is not None:
+            triaged = await asyncio.gather(*(asyncio.to_thread(triage.categorise, path) for path in chunk))
+            results = [(path, analysis) for path, analysis in zip(chunk, triaged) if analysis is not None]
+            chunk = [path for path, analysis in zip(chunk, triaged) if analysis is None]
+
+        hashes = {}
+        if dedup is not None:
+            values = await asyncio.gather(
+                *(asyncio.to_thread(image_hash, path) for path in chunk),
+                return_exceptions=True,
+            )
+            # Images which cannot be hashed are sent to the model, which reports the error
+            hashes = {path: value for path, value in zip(chunk, values) if not isinstance(value, Exception)}
+            remaining = []
+            for path in chunk:
+                if path in hashes and (analysis := dedup.lookup(path.stem, hashes[path])) is not None:
+                    results.append((path, analysis))
+                else:
+                    remaining.append(path)
+            chunk = remaining
+
+        if voting is not None:
+            outcomes = await asyncio.gather(
+                *(categorise_vote(
+                    path,
+                    voting,
+                    model=model,
+                    preprocessing=preprocessing,
+                    call_log=call_log,
+                ) for path in chunk),
+                return_exceptions=True,
+            )
+            categorised = [
+                (path, outcome if isinstance(outcome, Exception) else outcome.analysis)
+                for path, outcome in zip(chunk, outcomes)
+            ]
+        elif cascade is not None:
+            outcomes = await asyncio.gather(
+                *(categorise_cascade(
+                    path,
+                    cascade,
+                    model=model,
+                    cache=cache,
+                    preprocessing=preprocessing,
+                    call_log=call_log,
+                ) for path in chunk),
+                return_exceptions=True,
+            )
+            categorised = [
+                (path, outcome if isinstance(outcome, Exception) else outcome.analysis)
+                for path, outcome in zip(chunk, outcomes)
+            ]
+        elif len(chunk) == 1:
+            categorised = [(chunk[0], await categorise_async(
+                chunk[0],
+                model=model,
+                cache=cache,
+                preprocessing=preprocessing,
+                call_log=call_log,
+            ))]
+        elif chunk:
+            categorised = await categorise_group(
+                chunk,
+                model=model,
+                cache=cache,
+                preprocessing=preprocessing,
+                call_log=call_log,
+            )
+        else:
+            categorised = []
+
+        for path, result in categorised:
+            if path in hashes and not isinstance(result, Exception):
+                dedup.add(path.stem, hashes[path], result)
+        return results + categorised
+
+    def fill():
+        while len(pending) < concurrency and (chunk := list(itertools.islice(paths, group_size))):
+            pending[asyncio.create_task(categorise_chunk(chunk))] = chunk
+
+    try:
+        fill()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            completed = [(pending.pop(task), task) for task in done]
+            # Top up before yielding so requests stay in flight while the caller handles results.
+            fill()
+            for chunk, task in completed:
+                if return_exceptions and (exception := task.exception()) is not None:
+                    for path in chunk:
+                        yield path, exception
+                    continue
+                for path, result in task.result():
+                    if isinstance(result, Exception) and not return_exceptions:
+                        raise result
+                    yield path, result
+    finally:
+        for task in pending:
+            task.cancel()
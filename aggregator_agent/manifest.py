@@ -0,0 +1,439 @@
+"""
+A persistent index of the images in a dataset, updated incrementally.
+
+Directories are walked with `os.scandir`, which reports file types without a system call per entry, so catalogues of
+millions of images can be listed quickly. The ID, size, modification time, dimensions and content hash of each image
+are stored in SQLite. Later scans only read files whose size or modification time has changed, so listing images,
+resuming and joining against ground truth become index lookups. Scans compare a directory at a time with the rows
+indexed for it, so memory is bounded by the largest directory rather than the whole tree.
+
+Hashing reads every byte of every new image, so scripts only use a manifest when asked to with `--manifest`.
+
+Dimensions are read from the PNG header, and a PNG only counts as valid if it has the PNG signature and ends with its
+IEND chunk. Invalid files are kept in the manifest with the reason, so they can be reported rather than sent to a model.
+"""
+import fnmatch
+import hashlib
+import os
+import sqlite3
+import struct
+import time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+from PIL import Image
+from pydantic import BaseModel
+
+from aggregator_agent.watch import is_written
+
+DEFAULT_MANIFEST_PATH = Path.home() / ".cache" / "aggregator_agent" / "manifest.sqlite"
+DEFAULT_PATTERN = "*.png"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Rows written to the manifest in each transaction while scanning
+_BATCH_SIZE = 1000
+
+
+def walk(
+        directory: Path,
+        pattern: str = DEFAULT_PATTERN,
+        recursive: bool = False,
+) -> Iterator[tuple[str, list[os.DirEntry]]]:
+    """
+    Yield each directory, and with recursive each directory beneath it, with the files in it whose names match a glob
+    pattern, a directory at a time and in no particular order.
+
+    Hidden files and directories are skipped, as are directories which cannot be read.
+    """
+    stack = [str(directory)]
+    while stack:
+        parent = stack.pop()
+        files = []
+        try:
+            with os.scandir(parent) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            stack.append(entry.path)
+                    elif fnmatch.fnmatch(entry.name, pattern) and entry.is_file():
+                        files.append(entry)
+        except (PermissionError, FileNotFoundError):
+            continue
+        yield parent, files
+
+
+def scan(directory: Path, pattern: str = DEFAULT_PATTERN, recursive: bool = False) -> Iterator[os.DirEntry]:
+    """
+    Yield the files in the directory whose names match a glob pattern, in no particular order.
+
+    Hidden files and directories are skipped, as are directories which cannot be read.
+    """
+    for _, files in walk(directory, pattern, recursive):
+        yield from files
+
+
+def image_dimensions(path: Path) -> tuple[int, int]:
+    """
+    The width and height of an image. For a PNG only the header is read.
+
+    Raises
+    ------
+    ValueError
+        If the image cannot be read
+    """
+    if path.suffix.lower() != ".png":
+        try:
+            with Image.open(path) as image:
+                return image.size
+        except OSError as e:
+            raise ValueError(f"Unreadable image: {e}") from e
+
+    with path.open("rb") as f:
+        header = f.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        raise ValueError("Not a PNG")
+    return struct.unpack(">II", header[16:24])
+
+
+def file_hash(path: Path) -> str:
+    """
+    The SHA-256 of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ManifestEntry(BaseModel):
+    """
+    An image in the manifest.
+
+    Attributes
+    ----------
+    id - the filename without suffix
+    path - the absolute path
+    size - the size in bytes
+    mtime_ns - the modification time in nanoseconds since the epoch
+    width - the width in pixels, if the image could be read
+    height - the height in pixels, if the image could be read
+    hash - the SHA-256 of the contents
+    error - why the image is invalid, or None if it is valid
+    """
+
+    id: str
+    path: Path
+    size: int
+    mtime_ns: int
+    width: int | None = None
+    height: int | None = None
+    hash: str
+    error: str | None = None
+
+
+def inspect(path: Path, size: int, mtime_ns: int) -> ManifestEntry:
+    """
+    Read an image's dimensions and hash, noting why it is invalid if it is.
+    """
+    entry = ManifestEntry(id=path.stem, path=path, size=size, mtime_ns=mtime_ns, hash=file_hash(path))
+    try:
+        entry.width, entry.height = image_dimensions(path)
+    except ValueError as e:
+        entry.error = str(e)
+    else:
+        if not is_written(path):
+            entry.error = "Truncated PNG"
+    return entry
+
+
+class ScanResult(BaseModel):
+    """
+    How a directory changed since it was last scanned.
+    """
+
+    added: int = 0
+    changed: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    invalid: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.added} added, {self.changed} changed, {self.removed} removed, {self.unchanged} unchanged, "
+            f"{self.invalid} invalid"
+        )
+
+
+def _prefix_range(directory: Path) -> tuple[str, str]:
+    """
+    Bounds between which every path beneath the directory sorts, so it can be found by a range query on the index.
+    """
+    prefix = os.path.join(str(directory), "")
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+class Manifest:
+    """
+    A SQLite index of images by path, with their ID, size, modification time, dimensions and content hash.
+    """
+
+    def __init__(self, path: Path = DEFAULT_MANIFEST_PATH, workers: int = 8):
+        """
+        Parameters
+        ----------
+        path
+            The SQLite database file. Parent directories are created if required.
+        workers
+            Threads reading new and changed files
+        """
+        self.path = path
+        self.workers = workers
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY,
+                parent TEXT NOT NULL,
+                id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                hash TEXT NOT NULL,
+                error TEXT,
+                scanned_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS images_parent ON images (parent);
+            CREATE INDEX IF NOT EXISTS images_id ON images (id);
+            CREATE INDEX IF NOT EXISTS images_hash ON images (hash);
+            """
+        )
+        self._connection.commit()
+
+    def __enter__(self) -> "Manifest":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def _select(self, columns: str, directory: Path, recursive: bool, condition: str = "1") -> sqlite3.Cursor:
+        if recursive:
+            return self._connection.execute(
+                f"SELECT {columns} FROM images WHERE path >= ? AND path < ? AND {condition} ORDER BY path",
+                _prefix_range(directory),
+            )
+        return self._connection.execute(
+            f"SELECT {columns} FROM images WHERE parent = ? AND {condition} ORDER BY path",
+            (str(directory),),
+        )
+
+    def _known(self, parent: str, pattern: str) -> dict[str, tuple[int, int]]:
+        """
+        The size and modification time of each image indexed directly in a directory whose name matches the pattern.
+        """
+        return {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self._connection.execute(
+                "SELECT path, size, mtime_ns FROM images WHERE parent = ?",
+                (parent,),
+            )
+            if fnmatch.fnmatch(os.path.basename(path), pattern)
+        }
+
+    def _remove(self, paths: list[str]):
+        self._connection.executemany("DELETE FROM images WHERE path = ?", ((path,) for path in paths))
+        self._connection.commit()
+
+    def update(self, directory: Path, pattern: str = DEFAULT_PATTERN, recursive: bool = False) -> ScanResult:
+        """
+        Bring the manifest up to date with the images in a directory, reading only new and changed files.
+
+        Each directory listed is compared with the images indexed for it before the next is listed, and directories
+        which have gone, or can no longer be read, then have their images removed.
+        """
+        directory = directory.resolve()
+        result = ScanResult()
+        listed = set()
+
+        def read(path: Path, size: int, mtime_ns: int) -> ManifestEntry | None:
+            try:
+                return inspect(path, size, mtime_ns)
+            except FileNotFoundError:
+                # Deleted since it was listed
+                return None
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            for parent, files in walk(directory, pattern, recursive):
+                listed.add(parent)
+                known = self._known(parent, pattern)
+                changed = []
+                for entry in files:
+                    stat = entry.stat()
+                    previous = known.pop(entry.path, None)
+                    if previous == (stat.st_size, stat.st_mtime_ns):
+                        result.unchanged += 1
+                        continue
+                    if previous is None:
+                        result.added += 1
+                    else:
+                        result.changed += 1
+                    changed.append((Path(entry.path), stat.st_size, stat.st_mtime_ns))
+
+                removed = list(known)
+                rows = []
+                for (path, *_), entry in zip(changed, pool.map(lambda args: read(*args), changed)):
+                    if entry is None:
+                        removed.append(str(path))
+                        continue
+                    result.invalid += entry.error is not None
+                    rows.append((
+                        str(entry.path), parent, entry.id, entry.size, entry.mtime_ns, entry.width, entry.height,
+                        entry.hash, entry.error, time.time(),
+                    ))
+                    if len(rows) == _BATCH_SIZE:
+                        self._write(rows)
+                        rows = []
+                self._write(rows)
+                result.removed += len(known)
+                self._remove(removed)
+
+        if recursive:
+            parents = [
+                parent for parent, in self._connection.execute(
+                    "SELECT DISTINCT parent FROM images WHERE path >= ? AND path < ?",
+                    _prefix_range(directory),
+                )
+            ]
+        else:
+            parents = [str(directory)]
+        for parent in parents:
+            if parent not in listed:
+                gone = list(self._known(parent, pattern))
+                result.removed += len(gone)
+                self._remove(gone)
+        return result
+
+    def _write(self, rows: list[tuple]):
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO images (path, parent, id, size, mtime_ns, width, height, hash, error, scanned_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        self._connection.commit()
+
+    def entries(self, directory: Path, recursive: bool = False) -> list[ManifestEntry]:
+        """
+        Every image indexed in a directory, valid or not, in path order.
+        """
+        columns = "id, path, size, mtime_ns, width, height, hash, error"
+        return [
+            ManifestEntry(**dict(zip(columns.split(", "), row)))
+            for row in self._select(columns, directory.resolve(), recursive)
+        ]
+
+    def images(self, directory: Path, pattern: str = DEFAULT_PATTERN, recursive: bool = False) -> list[Path]:
+        """
+        The valid images indexed in a directory whose names match the pattern, in path order.
+        """
+        return [
+            Path(path)
+            for path, in self._select("path", directory.resolve(), recursive, "error IS NULL")
+            if fnmatch.fnmatch(os.path.basename(path), pattern)
+        ]
+
+    def invalid(self, directory: Path, recursive: bool = False) -> list[tuple[Path, str]]:
+        """
+        The invalid images indexed in a directory with the reason each is invalid.
+        """
+        return [
+            (Path(path), error)
+            for path, error in self._select("path, error", directory.resolve(), recursive, "error IS NOT NULL")
+        ]
+
+    def lookup(self, image_id: str) -> list[ManifestEntry]:
+        """
+        Every indexed image with the given ID, in any directory.
+        """
+        columns = "id, path, size, mtime_ns, width, height, hash, error"
+        rows = self._connection.execute(f"SELECT {columns} FROM images WHERE id = ? ORDER BY path", (image_id,))
+        return [ManifestEntry(**dict(zip(columns.split(", "), row))) for row in rows]
+
+
+def find_images(
+        directory: Path,
+        manifest: Manifest | None = None,
+        pattern: str = DEFAULT_PATTERN,
+        recursive: bool = False,
+) -> list[Path]:
+    """
+    The images in a directory in path order.
+
+    With a manifest it is updated first and only valid images are returned, with any invalid ones reported.
+    """
+    if manifest is None:
+        return sorted(Path(entry.path) for entry in scan(directory, pattern, recursive))
+
+    result = manifest.update(directory, pattern, recursive)
+    print(f"Manifest for {directory}: {result}")
+    for path, error in manifest.invalid(directory, recursive):
+        print(f"Skipping invalid image {path}: {error}")
+    return manifest.images(directory, pattern, recursive)
+
+
+def add_manifest_arguments(parser: ArgumentParser, listing: bool = True, optional: bool = True):
+    """
+    Add options controlling how images are found and indexed to a script's argument parser.
+
+    If listing is False the script lists a fixed directory, so only the manifest options are added. If optional is
+    False the script always uses a manifest, so only its path can be chosen; otherwise a manifest is only used when
+    --manifest is given.
+    """
+    if listing:
+        parser.add_argument(
+            "--pattern",
+            default=DEFAULT_PATTERN,
+            help=f"Glob pattern matched against filenames (default: {DEFAULT_PATTERN})",
+        )
+        parser.add_argument(
+            "--recursive",
+            action="store_true",
+            help="Include images in subdirectories",
+        )
+    if not optional:
+        parser.add_argument(
+            "--manifest",
+            type=Path,
+            default=DEFAULT_MANIFEST_PATH,
+            help=f"SQLite file indexing images, updated incrementally (default: {DEFAULT_MANIFEST_PATH})",
+        )
+        return
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        nargs="?",
+        const=DEFAULT_MANIFEST_PATH,
+        default=None,
+        help="Index and validate images in this SQLite file, updated incrementally, and skip invalid images. Every "
+             f"new image is read and hashed. (default when given: {DEFAULT_MANIFEST_PATH})",
+    )
+
+
+def manifest_from_arguments(args: Namespace) -> Manifest | None:
+    """
+    Open the manifest described by arguments added with `add_manifest_arguments`, or None if images are listed
+    without one.
+    """
+    return Manifest(args.manifest) if args.manifest is not None else None
@@ -0,0 +1,249 @@
+import functools
+import io
+import math
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import Literal
+
+from PIL import Image
+from pydantic import BaseModel, Field, field_validator
+
+# The panels of an image output by lens modelling, from left to right
+PANEL_NAMES = (
+    "VIS Lens Light Subtracted",
+    "VIS Source Model Image",
+    "VIS Source Plane Zoomed",
+    "VIS Source Plane (No Zoom)",
+)
+
+MEDIA_TYPES = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+
+class Preprocessing(BaseModel, frozen=True):
+    """
+    How an image is transformed before it is sent to the LLM.
+
+    Attributes
+    ----------
+    long_edge - if set, the image is downscaled so its longest edge is at most this many pixels
+    panels - the indices of the panels kept, see PANEL_NAMES
+    crop - the fraction of each panel's width and height kept around its centre
+    format - the encoding of the image sent
+    quality - the quality used for lossy encodings
+    """
+
+    long_edge: int | None = None
+    panels: tuple[int, ...] = (0, 1, 2, 3)
+    crop: float = Field(default=1.0, gt=0.0, le=1.0)
+    format: Literal["PNG", "JPEG", "WEBP"] = "PNG"
+    quality: int = Field(default=85, ge=1, le=100)
+
+    @field_validator("panels")
+    @classmethod
+    def _check_panels(cls, panels: tuple[int, ...]) -> tuple[int, ...]:
+        if not panels:
+            raise ValueError("At least one panel must be kept")
+        if any(index not in range(len(PANEL_NAMES)) for index in panels):
+            raise ValueError(f"Panel indices must be from 0 to {len(PANEL_NAMES) - 1}, got {panels}")
+        if len(set(panels)) != len(panels):
+            raise ValueError(f"Each panel can only be kept once, got {panels}")
+        return panels
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+    @property
+    def panel_note(self) -> str | None:
+        """
+        A note for the LLM explaining which panels are included, if any have been dropped.
+        """
+        if self.panels == (0, 1, 2, 3):
+            return None
+        names = ", ".join(PANEL_NAMES[index] for index in self.panels)
+        return f"Only the following plots are included in this image (from left to right): {names}"
+
+
+class PreprocessReport(BaseModel):
+    """
+    The size of an image before and after preprocessing.
+
+    Attributes
+    ----------
+    original_bytes - the size of the file as written by lens modelling
+    processed_bytes - the size of the encoded image sent to the LLM
+    original_tokens - the estimated number of image tokens for the original image
+    processed_tokens - the estimated number of image tokens for the processed image
+    """
+
+    original_bytes: int
+    processed_bytes: int
+    original_tokens: int
+    processed_tokens: int
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - self.processed_bytes
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.original_tokens - self.processed_tokens
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """
+    Estimate the number of input tokens a high detail image costs.
+
+    The image is scaled to fit within 2048x2048, then so its shortest side is at most 768 pixels. Each 512 pixel tile
+    costs 170 tokens, plus a fixed 85.
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def _select_panels(image: Image.Image, preprocessing: Preprocessing) -> Image.Image:
+    """
+    Cut the image into its panels and join those kept, each cropped about its centre.
+    """
+    panel_width = image.width / len(PANEL_NAMES)
+    crops = []
+    for index in preprocessing.panels:
+        left = index * panel_width
+        margin_x = panel_width * (1 - preprocessing.crop) / 2
+        margin_y = image.height * (1 - preprocessing.crop) / 2
+        crops.append(image.crop((
+            round(left + margin_x),
+            round(margin_y),
+            round(left + panel_width - margin_x),
+            round(image.height - margin_y),
+        )))
+
+    joined = Image.new(image.mode, (sum(crop.width for crop in crops), crops[0].height))
+    x = 0
+    for crop in crops:
+        joined.paste(crop, (x, 0))
+        x += crop.width
+    return joined
+
+
+def preprocess(image_bytes: bytes, preprocessing: Preprocessing) -> tuple[bytes, PreprocessReport]:
+    """
+    Transform an image as described by the preprocessing.
+
+    The image is always re-encoded, which strips any metadata.
+
+    Returns
+    -------
+    The encoded image and a report of how much smaller it is
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    original_size = image.size
+    image = image.convert("RGB")
+
+    if preprocessing.panels != (0, 1, 2, 3) or preprocessing.crop < 1.0:
+        image = _select_panels(image, preprocessing)
+
+    if preprocessing.long_edge is not None and max(image.size) > preprocessing.long_edge:
+        scale = preprocessing.long_edge / max(image.size)
+        image = image.resize(
+            (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+            Image.LANCZOS,
+        )
+
+    buffer = io.BytesIO()
+    if preprocessing.format == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+    else:
+        image.save(buffer, format=preprocessing.format, quality=preprocessing.quality)
+    processed_bytes = buffer.getvalue()
+
+    return processed_bytes, PreprocessReport(
+        original_bytes=len(image_bytes),
+        processed_bytes=len(processed_bytes),
+        original_tokens=estimate_image_tokens(*original_size),
+        processed_tokens=estimate_image_tokens(*image.size),
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def _preprocess_file(
+        path: Path,
+        size: int,
+        mtime_ns: int,
+        preprocessing: Preprocessing,
+) -> tuple[bytes, PreprocessReport]:
+    return preprocess(path.read_bytes(), preprocessing)
+
+
+def preprocess_file(path: Path, preprocessing: Preprocessing) -> tuple[bytes, PreprocessReport]:
+    """
+    Transform the image at a path, see `preprocess`.
+
+    The results for the most recently transformed files are kept, so an image which is read again, e.g. to report
+    what preprocessing saved or when a cascade escalates it, is only transformed once. A file which has been rewritten
+    since is transformed again.
+    """
+    stat = path.stat()
+    return _preprocess_file(path, stat.st_size, stat.st_mtime_ns, preprocessing)
+
+
+def add_preprocessing_arguments(parser: ArgumentParser):
+    """
+    Add options controlling image preprocessing to a script's argument parser.
+    """
+    parser.add_argument(
+        "--long-edge",
+        type=int,
+        default=None,
+        help="Downscale images so their longest edge is at most this many pixels",
+    )
+    parser.add_argument(
+        "--panels",
+        type=int,
+        nargs="+",
+        choices=range(len(PANEL_NAMES)),
+        default=None,
+        help="Indices of the panels to keep, from 0 (VIS Lens Light Subtracted) to 3 (VIS Source Plane (No Zoom))",
+    )
+    parser.add_argument(
+        "--crop",
+        type=float,
+        default=1.0,
+        help="Fraction of each panel kept around its centre",
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(MEDIA_TYPES),
+        default=None,
+        help="Re-encode images in this format",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=85,
+        help="Quality for JPEG and WEBP encoding",
+    )
+
+
+def preprocessing_from_arguments(args: Namespace) -> Preprocessing | None:
+    """
+    Create the preprocessing described by arguments added with `add_preprocessing_arguments`, or None if images
+    should be sent as they are.
+    """
+    if args.long_edge is None and args.panels is None and args.crop == 1.0 and args.format is None:
+        return None
+    return Preprocessing(
+        long_edge=args.long_edge,
+        panels=tuple(args.panels) if args.panels is not None else (0, 1, 2, 3),
+        crop=args.crop,
+        format=args.format or "PNG",
+        quality=args.quality,
+    )
@@ -0,0 +1,332 @@
+"""
+A shared client layer which keeps requests within provider rate limits and retries transient failures.
+
+Requests and tokens are metered by token buckets refilled at the per-minute limits. Requests which fail with a 429,
+a transient 5xx or a connection error are retried with jittered exponential backoff, waiting at least as long as any
+Retry-After header asks. The number of requests in flight is adjusted by additive increase, multiplicative decrease
+(AIMD): it grows by one for every `concurrency` successes and halves on each 429, so it settles just under the limit.
+"""
+import asyncio
+import collections
+import email.utils
+import random
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+import httpx
+
+from aggregator_agent.telemetry import current_call
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Tokens assumed per request for text and output when estimating usage in advance
+TEXT_TOKENS = 2000
+
+
+class TokenBucket:
+    """
+    A bucket holding up to `capacity` tokens, refilled continuously at `per_minute` tokens a minute.
+
+    Safe to share between threads and event loops.
+    """
+
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount: float) -> float:
+        """
+        Take `amount` tokens, possibly going into debt, and return how long to wait until the debt is repaid.
+        """
+        # Requests larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    async def acquire(self, amount: float = 1.0):
+        if (delay := self._reserve(amount)) > 0:
+            await asyncio.sleep(delay)
+
+    def acquire_sync(self, amount: float = 1.0):
+        if (delay := self._reserve(amount)) > 0:
+            time.sleep(delay)
+
+
+def status_code(exception: BaseException) -> int | None:
+    """
+    The HTTP status code of a failed request, looking through exceptions raised from others.
+    """
+    while exception is not None:
+        if isinstance(code := getattr(exception, "status_code", None), int):
+            return code
+        exception = exception.__cause__
+    return None
+
+
+def retry_after(exception: BaseException) -> float | None:
+    """
+    The number of seconds the provider asked to wait before retrying, if it said.
+    """
+    while exception is not None:
+        response = getattr(exception, "response", None)
+        if isinstance(response, httpx.Response):
+            headers = response.headers
+            if (milliseconds := headers.get("retry-after-ms")) is not None:
+                try:
+                    return float(milliseconds) / 1000
+                except ValueError:
+                    pass
+            if (value := headers.get("retry-after")) is not None:
+                try:
+                    return float(value)
+                except ValueError:
+                    pass
+                # Otherwise an HTTP date, and anything else malformed is ignored in favour of the computed backoff
+                try:
+                    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        exception = exception.__cause__
+    return None
+
+
+def is_retryable(exception: BaseException) -> bool:
+    """
+    Whether a request which raised the exception may succeed if sent again.
+    """
+    from openai import APIConnectionError
+
+    if (code := status_code(exception)) is not None:
+        return code in RETRYABLE_STATUS_CODES
+    while exception is not None:
+        if isinstance(exception, (APIConnectionError, httpx.TransportError, asyncio.TimeoutError)):
+            return True
+        exception = exception.__cause__
+    return False
+
+
+class RateLimiter:
+    """
+    Meters, retries and adaptively limits the concurrency of requests to a provider.
+
+    One limiter should be shared by everything calling the same provider account so their usage is counted together.
+    """
+
+    def __init__(
+            self,
+            requests_per_minute: float | None = None,
+            tokens_per_minute: float | None = None,
+            max_concurrency: int = 32,
+            min_concurrency: int = 1,
+            initial_concurrency: int | None = None,
+            max_retries: int = 6,
+            base_delay: float = 1.0,
+            max_delay: float = 60.0,
+    ):
+        """
+        Parameters
+        ----------
+        requests_per_minute
+            The provider's request limit, or None if unlimited
+        tokens_per_minute
+            The provider's token limit, or None if unlimited
+        max_concurrency
+            The most requests allowed in flight however well things are going
+        min_concurrency
+            The fewest requests allowed in flight however many are rate limited
+        initial_concurrency
+            Requests allowed in flight to begin with (default: max_concurrency)
+        max_retries
+            The number of times a request is retried before its error is raised
+        base_delay
+            Seconds before the first retry, doubling for each subsequent retry
+        max_delay
+            The longest wait between retries
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(initial_concurrency or max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+        self._in_flight = 0
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_concurrency, min(self.max_concurrency, int(self.concurrency)))
+
+    def _wake(self):
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                # The woken coroutine takes the slot when it runs
+                break
+
+    @asynccontextmanager
+    async def _slot(self) -> AsyncIterator[None]:
+        # Waiters are futures of whichever loop is running, so a limiter can outlive a single asyncio.run
+        while self._in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass on a wake up that arrived as this waiter was cancelled
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._wake()
+
+    def _succeeded(self):
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / max(self.concurrency, 1))
+        self._wake()
+
+    def _failed(self, exception: BaseException, attempt: int) -> float:
+        """
+        Record a retryable failure, returning how long to wait before retrying.
+        """
+        self.retries += 1
+        if (record := current_call.get()) is not None:
+            record.retries += 1
+        if status_code(exception) == 429:
+            self.rate_limited += 1
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+        # Full jitter spreads retries from many workers so they do not arrive together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if (requested := retry_after(exception)) is not None:
+            delay = max(delay, requested)
+        return delay
+
+    async def call(self, function: Callable[[], Awaitable[T]], tokens: float = 0) -> T:
+        """
+        Await `function()` within the limits, retrying transient failures.
+
+        Parameters
+        ----------
+        function
+            Makes the request. Called again for each retry.
+        tokens
+            An estimate of the tokens the request will use
+        """
+        record = current_call.get()
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            if self.requests is not None:
+                await self.requests.acquire()
+            if self.tokens is not None and tokens:
+                await self.tokens.acquire(tokens)
+
+            async with self._slot():
+                if record is not None:
+                    record.queue_wait += time.perf_counter() - queued
+                self.calls += 1
+                try:
+                    result = await function()
+                except Exception as e:
+                    if attempt == self.max_retries or not is_retryable(e):
+                        raise
+                    delay = self._failed(e, attempt)
+                else:
+                    self._succeeded()
+                    return result
+            await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    def call_sync(self, function: Callable[[], T], tokens: float = 0) -> T:
+        """
+        Call `function()` within the rate limits from synchronous code, retrying transient failures.
+
+        Synchronous calls are not counted towards concurrency, which only applies to the event loop.
+        """
+        record = current_call.get()
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            if self.requests is not None:
+                self.requests.acquire_sync()
+            if self.tokens is not None and tokens:
+                self.tokens.acquire_sync(tokens)
+
+            if record is not None:
+                record.queue_wait += time.perf_counter() - queued
+            self.calls += 1
+            try:
+                result = function()
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                time.sleep(self._failed(e, attempt))
+            else:
+                self._succeeded()
+                return result
+        raise AssertionError("unreachable")
+
+    def summary(self) -> str:
+        return (
+            f"Rate limiting: {self.calls} calls, {self.retries} retries ({self.rate_limited} rate limited), "
+            f"settled at {self.limit} concurrent requests"
+        )
+
+
+def add_rate_limit_arguments(parser: ArgumentParser):
+    """
+    Add options controlling rate limiting to a script's argument parser.
+    """
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=None,
+        help="The provider's request limit. Requests are spread out to stay within it.",
+    )
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=float,
+        default=None,
+        help="The provider's token limit. Requests are spread out to stay within it.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=6,
+        help="Number of times a rate limited or failed request is retried",
+    )
+
+
+def rate_limiter_from_arguments(args: Namespace, max_concurrency: int = 32) -> RateLimiter:
+    """
+    Create the rate limiter described by arguments added with `add_rate_limit_arguments`.
+    """
+    return RateLimiter(
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        max_concurrency=max_concurrency,
+        max_retries=args.max_retries,
+    )
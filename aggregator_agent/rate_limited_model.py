@@ -0,0 +1,64 @@
+"""
+A pydantic-ai model whose requests go through the rate limiter.
+
+This is kept apart from `aggregator_agent.rate_limit` so that the limiter, which segmentation also uses, and the rate
+limiting options of the scripts can be imported without pydantic-ai.
+"""
+import asyncio
+import io
+from typing import Any
+
+from PIL import Image
+from pydantic_ai.messages import BinaryContent, ModelMessage, ModelRequest, ModelResponse, UserPromptPart
+from pydantic_ai.models import KnownModelName, Model, infer_model
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from aggregator_agent.preprocessing import estimate_image_tokens
+from aggregator_agent.rate_limit import TEXT_TOKENS, RateLimiter
+from aggregator_agent.telemetry import async_http_client
+
+
+def estimate_tokens(messages: list[ModelMessage]) -> int:
+    """
+    Estimate the tokens a request will use from the size of its images, plus an allowance for text and output.
+    """
+    tokens = TEXT_TOKENS
+    for message in messages:
+        if not isinstance(message, ModelRequest):
+            continue
+        for part in message.parts:
+            if not isinstance(part, UserPromptPart) or isinstance(part.content, str):
+                continue
+            for content in part.content:
+                if isinstance(content, BinaryContent) and content.is_image:
+                    with Image.open(io.BytesIO(content.data)) as image:
+                        tokens += estimate_image_tokens(image.width, image.height)
+    return tokens
+
+
+def unretried_model(model: Model | KnownModelName | str) -> Model:
+    """
+    Copy an OpenAI model with a client which does not retry by itself, so failures reach the rate limiter, and which
+    records the time to first byte of each response. Other models are returned as they are.
+    """
+    model = infer_model(model)
+    if not isinstance(model, OpenAIChatModel):
+        return model
+    client = model.client.with_options(max_retries=0, http_client=async_http_client())
+    return OpenAIChatModel(model.model_name, provider=OpenAIProvider(openai_client=client), settings=model.settings)
+
+
+class RateLimitedModel(WrapperModel):
+    """
+    A model whose requests go through a rate limiter. Pass it as the `model` of an agent run.
+    """
+
+    def __init__(self, wrapped: Model | KnownModelName | str, limiter: RateLimiter):
+        super().__init__(unretried_model(wrapped))
+        self.limiter = limiter
+
+    async def request(self, messages: list[ModelMessage], *args: Any, **kwargs: Any) -> ModelResponse:
+        tokens = await asyncio.to_thread(estimate_tokens, messages)
+        return await self.limiter.call(lambda: self.wrapped.request(messages, *args, **kwargs), tokens=tokens)
@@ -0,0 +1,432 @@
+"""
+An append-only store of categorisations from every run, with an index for lookups, filters and comparisons.
+
+Results are buffered and written as immutable, gzip compressed partitions of JSON lines under `partitions/<run>/`, one
+file per flush of up to `partition_rows` results. Every result is also indexed in SQLite by run, ID and category along
+with its model, prompt hash, latency and tokens, and the partition and line holding it. Looking up an image, or
+filtering a run by category, reads only the partitions holding the matches, one at a time, and comparing two runs is a
+join on the index which reads no partitions at all. The index can be rebuilt from the partitions, and partitions
+written by a process which died before indexing them are indexed the next time the store is opened.
+"""
+import csv
+import gzip
+import os
+import re
+import sqlite3
+import time
+import uuid
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from pydantic import BaseModel, Field
+
+from aggregator_agent.schema import Category, LensFitAnalysis
+from aggregator_agent.telemetry import CallRecord
+
+DEFAULT_PARTITION_ROWS = 1000
+# Runs name directories of partitions, so are restricted to characters safe in a filename
+RUN_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+_COLUMNS = (
+    "run", "id", "category", "expected", "model", "prompt_hash", "latency", "input_tokens", "output_tokens",
+    "recorded_at",
+)
+
+
+class ResultRecord(BaseModel):
+    """
+    The categorisation of an image in a run.
+
+    Attributes
+    ----------
+    run - the name of the run which produced the result
+    id - the image ID, the filename without suffix
+    category - the category assigned
+    description - the description given with the category
+    expected - the ground truth category, if known
+    model - the model which gave the final answer, if one was called
+    prompt_hash - identifies the instructions and output schema the model which gave the final answer was given, if
+        one was called
+    latency - seconds spent on calls for the image, with calls for several images shared equally between them
+    input_tokens - input tokens for the image, shared in the same way
+    output_tokens - output tokens for the image, shared in the same way
+    recorded_at - the Unix time at which the result was stored
+    """
+
+    run: str
+    id: str
+    category: Category
+    description: str
+    expected: Category | None = None
+    model: str | None = None
+    prompt_hash: str | None = None
+    latency: float | None = None
+    input_tokens: int | None = None
+    output_tokens: int | None = None
+    recorded_at: float = Field(default_factory=time.time)
+
+    @classmethod
+    def from_analysis(
+            cls,
+            run: str,
+            image_id: str,
+            analysis: LensFitAnalysis,
+            calls: list[CallRecord] | None = None,
+            prompt_hash: str | None = None,
+            expected: Category | None = None,
+    ) -> "ResultRecord":
+        """
+        A result for an analysis, with the latency and tokens of the calls made for the image.
+
+        The model and prompt hash are those of the last call, which gave the final answer, unless a prompt hash is given.
+        """
+        record = cls(
+            run=run,
+            id=image_id,
+            category=analysis.category,
+            description=analysis.description,
+            expected=expected,
+            prompt_hash=prompt_hash,
+        )
+        if calls:
+            record.model = calls[-1].model
+            record.prompt_hash = prompt_hash or calls[-1].prompt_hash
+            record.latency = sum(call.latency / len(call.image_ids) for call in calls)
+            record.input_tokens = sum(call.input_tokens // len(call.image_ids) for call in calls)
+            record.output_tokens = sum(call.output_tokens // len(call.image_ids) for call in calls)
+        return record
+
+
+class ResultDiff(BaseModel):
+    """
+    An image categorised differently by two runs.
+
+    Attributes
+    ----------
+    id - the image ID
+    before - the category in the first run, or None if it was not categorised
+    after - the category in the second run, or None if it was not categorised
+    """
+
+    id: str
+    before: Category | None
+    after: Category | None
+
+
+class CallAttribution:
+    """
+    Matches the calls finished within a `collect_records` block to the images they were made for, so each result can
+    be stored with its latency and tokens.
+    """
+
+    def __init__(self, records: list[CallRecord]):
+        """
+        Parameters
+        ----------
+        records
+            The list being filled by `collect_records`. Records are removed from it as they are matched.
+        """
+        self.records = records
+        self._by_image: dict[str, list[CallRecord]] = {}
+
+    def pop(self, image_id: str) -> list[CallRecord]:
+        """
+        The calls made for an image since it was last popped, which are then forgotten.
+        """
+        for record in self.records:
+            for call_image_id in record.image_ids:
+                self._by_image.setdefault(call_image_id, []).append(record)
+        self.records.clear()
+        return self._by_image.pop(image_id, [])
+
+
+def default_run_name(prefix: str) -> str:
+    """
+    A run name from a prefix and the current time, e.g. predict-20250101T120000.
+    """
+    prefix = re.sub(r"[^A-Za-z0-9._-]+", "-", prefix).strip("-") or "run"
+    return f"{prefix}-{time.strftime('%Y%m%dT%H%M%S')}"
+
+
+class ResultStore:
+    """
+    Compressed, append-only partitions of results with a SQLite index.
+    """
+
+    def __init__(self, directory: Path, partition_rows: int = DEFAULT_PARTITION_ROWS):
+        """
+        Parameters
+        ----------
+        directory
+            Holds the index and the partitions. Created if required.
+        partition_rows
+            Results buffered for a run before they are written as a partition
+        """
+        self.directory = directory
+        self.partition_rows = partition_rows
+        self.written = 0
+        self.partitions_written = 0
+
+        self._partitions = directory / "partitions"
+        self._partitions.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(directory / "index.sqlite")
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                run TEXT NOT NULL,
+                id TEXT NOT NULL,
+                category TEXT NOT NULL,
+                expected TEXT,
+                model TEXT,
+                prompt_hash TEXT,
+                latency REAL,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                recorded_at REAL NOT NULL,
+                partition INTEGER NOT NULL,
+                line INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_id ON results (id);
+            CREATE INDEX IF NOT EXISTS results_run ON results (run, id);
+            CREATE INDEX IF NOT EXISTS results_category ON results (run, category);
+            CREATE TABLE IF NOT EXISTS partitions (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                run TEXT NOT NULL,
+                rows INTEGER NOT NULL
+            );
+            """
+        )
+        self._connection.commit()
+        self._pending: dict[str, list[ResultRecord]] = {}
+        self._index_unindexed()
+
+    def __enter__(self) -> "ResultStore":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def append(self, record: ResultRecord):
+        """
+        Buffer a result, writing a partition once its run has `partition_rows` buffered.
+        """
+        if not RUN_PATTERN.fullmatch(record.run):
+            raise ValueError(f"Run names may only contain letters, digits, '.', '_' and '-', got {record.run!r}")
+        pending = self._pending.setdefault(record.run, [])
+        pending.append(record)
+        if len(pending) >= self.partition_rows:
+            self._write(record.run)
+
+    def extend(self, records: Iterable[ResultRecord]):
+        for record in records:
+            self.append(record)
+
+    def flush(self):
+        """
+        Write every buffered result.
+        """
+        for run in list(self._pending):
+            self._write(run)
+
+    def _write(self, run: str):
+        records = self._pending.pop(run, [])
+        if not records:
+            return
+        # Named by time first so a run's partitions sort in the order they were written
+        name = f"{run}/{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+        path = self._partitions / name
+        path.parent.mkdir(exist_ok=True)
+        temporary = path.with_suffix(".tmp")
+        with gzip.open(temporary, "wt", encoding="utf-8") as f:
+            for record in records:
+                f.write(record.model_dump_json(exclude_none=True))
+                f.write("\n")
+        os.replace(temporary, path)
+        self._index(name, records)
+        self.written += len(records)
+        self.partitions_written += 1
+
+    def _index(self, name: str, records: list[ResultRecord]):
+        with self._connection:
+            partition = self._connection.execute(
+                "INSERT INTO partitions (name, run, rows) VALUES (?, ?, ?)",
+                (name, name.split("/")[0], len(records)),
+            ).lastrowid
+            self._connection.executemany(
+                f"INSERT INTO results ({', '.join(_COLUMNS)}, partition, line) "
+                f"VALUES ({', '.join('?' * (len(_COLUMNS) + 2))})",
+                (
+                    (*(getattr(record, column) for column in _COLUMNS), partition, line)
+                    for line, record in enumerate(records)
+                ),
+            )
+
+    def _partition_names(self) -> list[str]:
+        return sorted(
+            f"{run.name}/{path.name}"
+            for run in self._partitions.iterdir() if run.is_dir()
+            for path in run.glob("*.jsonl.gz")
+        )
+
+    def _index_unindexed(self):
+        indexed = {name for name, in self._connection.execute("SELECT name FROM partitions")}
+        for name in self._partition_names():
+            if name not in indexed:
+                self._index(name, [ResultRecord.model_validate_json(line) for line in self._read(name)])
+
+    def rebuild_index(self):
+        """
+        Index every partition again, e.g. after the index was lost or damaged.
+        """
+        with self._connection:
+            self._connection.execute("DELETE FROM results")
+            self._connection.execute("DELETE FROM partitions")
+        self._index_unindexed()
+
+    def _read(self, name: str) -> list[str]:
+        with gzip.open(self._partitions / name, "rt", encoding="utf-8") as f:
+            return f.readlines()
+
+    def _select(self, condition: str, parameters: Iterable) -> Iterator[ResultRecord]:
+        """
+        The results whose index rows meet a condition, read a partition at a time so only one is held in memory.
+        """
+        self.flush()
+        rows = self._connection.execute(
+            "SELECT partitions.name, results.line FROM results JOIN partitions ON partitions.id = results.partition "
+            f"WHERE {condition} ORDER BY results.partition, results.line",
+            tuple(parameters),
+        )
+        name, lines = None, []
+        for partition, line in rows:
+            if partition != name:
+                name, lines = partition, self._read(partition)
+            yield ResultRecord.model_validate_json(lines[line])
+
+    def runs(self) -> dict[str, int]:
+        """
+        The number of results in each run, in the order runs were first written.
+        """
+        rows = self._connection.execute("SELECT run, COUNT(*) FROM results GROUP BY run ORDER BY MIN(recorded_at)")
+        return dict(rows.fetchall())
+
+    def lookup(self, image_id: str, run: str | None = None) -> list[ResultRecord]:
+        """
+        Every result for an image, in any run or in the given one, oldest first.
+        """
+        condition = "results.id = ?"
+        parameters: tuple = (image_id,)
+        if run is not None:
+            condition += " AND results.run = ?"
+            parameters += (run,)
+        return sorted(self._select(condition, parameters), key=lambda record: record.recorded_at)
+
+    def select(
+            self,
+            run: str | None = None,
+            category: Category | None = None,
+            mismatched: bool = False,
+    ) -> Iterator[ResultRecord]:
+        """
+        Results matching every given filter, in the order they were written within each run.
+
+        Parameters
+        ----------
+        run
+            Only results from this run
+        category
+            Only results assigned this category
+        mismatched
+            Only results with a ground truth which they do not match
+        """
+        conditions = []
+        parameters = []
+        if run is not None:
+            conditions.append("results.run = ?")
+            parameters.append(run)
+        if category is not None:
+            conditions.append("results.category = ?")
+            parameters.append(category)
+        if mismatched:
+            conditions.append("results.expected != results.category")
+        yield from self._select(" AND ".join(conditions) or "1", parameters)
+
+    def diff(self, before: str, after: str) -> Iterator[ResultDiff]:
+        """
+        Images whose latest category differs between two runs, including images in only one of them, by ID.
+        """
+        self.flush()
+        rows = self._connection.execute(
+            """
+            WITH
+                a AS (SELECT id, category FROM results WHERE rowid IN (
+                    SELECT MAX(rowid) FROM results WHERE run = ? GROUP BY id)),
+                b AS (SELECT id, category FROM results WHERE rowid IN (
+                    SELECT MAX(rowid) FROM results WHERE run = ? GROUP BY id))
+            SELECT a.id, a.category, b.category FROM a LEFT JOIN b ON a.id = b.id
+            WHERE b.category IS NULL OR a.category != b.category
+            UNION ALL
+            SELECT b.id, NULL, b.category FROM b WHERE b.id NOT IN (SELECT id FROM a)
+            ORDER BY 1
+            """,
+            (before, after),
+        )
+        for image_id, before_category, after_category in rows:
+            yield ResultDiff(id=image_id, before=before_category, after=after_category)
+
+    def export_csv(self, run: str, path: Path, expected: bool = False) -> int:
+        """
+        Write a run's results as a CSV with the columns written by `predict_directory.py`, returning the number of
+        rows. If expected is True the ground truth category is included too.
+        """
+        columns = ["id", "category", "description"] + (["expected"] if expected else [])
+        count = 0
+        with path.open("w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for record in self.select(run=run):
+                writer.writerow([getattr(record, column) or "" for column in columns])
+                count += 1
+        return count
+
+    def summary(self) -> str:
+        return (
+            f"Result store: {self.written} results written in {self.partitions_written} partitions to "
+            f"{self.directory}"
+        )
+
+
+def add_store_arguments(parser: ArgumentParser):
+    """
+    Add options for recording results in a result store to a script's argument parser.
+    """
+    parser.add_argument(
+        "--store",
+        type=Path,
+        default=None,
+        help="Also record results in the result store in this directory",
+    )
+    parser.add_argument(
+        "--run",
+        default=None,
+        help="Name of the run results are recorded under in the store (default: the script and time)",
+    )
+
+
+def store_from_arguments(args: Namespace) -> ResultStore | None:
+    """
+    Open the result store described by arguments added with `add_store_arguments`.
+    """
+    if args.store is None:
+        return None
+    return ResultStore(args.store)
@@ -1,6 +1,6 @@
 from enum import StrEnum
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class Category(StrEnum):
@@ -39,3 +39,27 @@ class LensFitAnalysis(BaseModel):
 
     category: Category
     description: str
+
+
+class IdentifiedLensFitAnalysis(LensFitAnalysis):
+    """
+    An analysis of one of several images categorised together.
+
+    Attributes
+    ---------
+    id - the ID given alongside the image
+    """
+
+    id: str
+
+
+class ConfidentLensFitAnalysis(LensFitAnalysis):
+    """
+    An analysis which also states how confident the model is in its category.
+
+    Attributes
+    ---------
+    confidence - the probability, from 0 to 1, that the category is correct
+    """
+
+    confidence: float = Field(ge=0.0, le=1.0)
@@ -1,11 +1,18 @@
 import base64
+import functools
 import io
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from PIL import Image
-from openai import OpenAI
+from PIL import Image, ImageChops
 
-client = OpenAI()
+from aggregator_agent.preprocessing import estimate_image_tokens
+from aggregator_agent.rate_limit import TEXT_TOKENS, RateLimiter
+from aggregator_agent.telemetry import CallLog, CallRecord, async_http_client, http_client, optional_record
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+    from openai.types.responses import Response
 
 INSTRUCTIONS = """
 You are an expert astronomer analysing an image of a gravitational lens.
@@ -23,26 +30,60 @@ Ensure the masks entirely cover the objects, including any faint outer regions.
 TARGET_SIZE = (1024, 1024)
 TARGET_SIZE_STR = f"{TARGET_SIZE[0]}x{TARGET_SIZE[1]}"
 
+# Estimated tokens for each mask request, used to stay within a tokens per minute limit
+REQUEST_TOKENS = estimate_image_tokens(*TARGET_SIZE) + TEXT_TOKENS
+
+# The alpha given to coloured (masked) regions so the original image shows through an overlay
+TRANSLUCENT_ALPHA = 140
+
+
+@functools.cache
+def get_client() -> "OpenAI":
+    """
+    The OpenAI client used for masks, created on first use and shared by the whole process.
+
+    The SDK is only imported here, so loading images and compositing masks, e.g. in worker processes, does not need it
+    or any credentials.
+    """
+    from openai import OpenAI
 
-def process_image(image_path: Path) -> Image.Image:
-    path = image_path.parent
+    return OpenAI(http_client=http_client())
 
+
+@functools.cache
+def get_async_client() -> "AsyncOpenAI":
+    """
+    The async OpenAI client used for masks, created on first use and shared by the whole process.
+    """
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(http_client=async_http_client())
+
+
+def load_image(image_path: Path) -> Image.Image:
+    """
+    Load an image and resize it to the size of the mask that will be generated.
+    """
     with image_path.open("rb") as f:
         image_bytes = f.read()
 
     original_image = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
-    original_image = original_image.resize(TARGET_SIZE, Image.LANCZOS)
+    return original_image.resize(TARGET_SIZE, Image.LANCZOS)
+
 
+def request_body(original_image: Image.Image) -> dict:
+    """
+    The arguments for the Responses API call which generates a mask for the (resized) image.
+    """
     # Use the resized image bytes as the model input so sizes match the requested output.
     resized_buf = io.BytesIO()
     original_image.save(resized_buf, format="PNG")
     resized_image_bytes = resized_buf.getvalue()
 
-    # Generate the mask via OpenAI Responses API using the image generation tool.
     b64_image = base64.b64encode(resized_image_bytes).decode("utf-8")
-    response = client.responses.create(
-        model="gpt-5",
-        input=[
+    return {
+        "model": "gpt-5",
+        "input": [
             {
                 "role": "user",
                 "content": [
@@ -54,15 +95,69 @@ def process_image(image_path: Path) -> Image.Image:
                 ],
             }
         ],
-        tools=[
+        "tools": [
             {
                 "type": "image_generation",
                 "size": TARGET_SIZE_STR,
                 "quality": "high",
             }
         ],
-    )
+    }
+
+
+def make_translucent(
+        mask: Image.Image,
+        black_tolerance: int = 0,
+        translucent_alpha: int = TRANSLUCENT_ALPHA,
+) -> Image.Image:
+    """
+    Make black pixels of a mask fully transparent and coloured regions translucent.
+
+    Parameters
+    ----------
+    mask
+        The mask generated by the model
+    black_tolerance
+        Pixels whose red, green and blue values are all at most this are treated as black
+    translucent_alpha
+        The alpha given to all other pixels
+    """
+    mask = mask.convert("RGBA")
+    r, g, b, _ = mask.split()
+    brightest = ImageChops.lighter(ImageChops.lighter(r, g), b)
+    alpha = brightest.point([0 if value <= black_tolerance else translucent_alpha for value in range(256)])
+    mask.putalpha(alpha)
+    return mask
+
+
+def save_mask(
+        mask_b64: str,
+        original_image: Image.Image,
+        path: Path,
+        black_tolerance: int = 0,
+) -> Image.Image:
+    """
+    Decode a generated mask and save it, along with an overlay on the original image, to the given directory.
+    """
+    mask_bytes = base64.b64decode(mask_b64)
+    image = make_translucent(Image.open(io.BytesIO(mask_bytes)), black_tolerance=black_tolerance)
+
+    mask_path = path / "mask.png"
+    image.save(str(mask_path))
+    print("Saved mask to:", mask_path)
+
+    overlay = Image.alpha_composite(original_image, image)
+    overlay_path = path / "mask_overlay.png"
+    overlay.save(str(overlay_path))
+    print("Saved overlay to:", overlay_path)
 
+    return image
+
+
+def mask_from_response(response: "Response") -> str:
+    """
+    Extract the base64 encoded mask generated by the image generation tool.
+    """
     image_data = [
         output.result
         for output in response.output
@@ -72,26 +167,88 @@ def process_image(image_path: Path) -> Image.Image:
     if not image_data:
         raise RuntimeError("No image returned from OpenAI image generation tool.")
 
-    mask_bytes = base64.b64decode(image_data[0])
-    image = Image.open(io.BytesIO(mask_bytes)).convert("RGBA")
+    return image_data[0]
 
-    # Make black pixels fully transparent and keep coloured regions translucent.
-    translucent_alpha = 140
-    pixels = []
-    for r, g, b, _ in image.getdata():
-        if r == 0 and g == 0 and b == 0:
-            pixels.append((r, g, b, 0))
-        else:
-            pixels.append((r, g, b, translucent_alpha))
-    image.putdata(pixels)
 
-    mask_path = path / "mask.png"
-    image.save(str(mask_path))
-    print("Saved mask to:", mask_path)
+def _payload_bytes(body: dict) -> int:
+    """
+    The size of the image in a request body created by `request_body`.
+    """
+    image_url = body["input"][0]["content"][1]["image_url"]
+    return len(image_url.partition(",")[2]) * 3 // 4
 
-    overlay = Image.alpha_composite(original_image, image)
-    overlay_path = path / "mask_overlay.png"
-    overlay.save(str(overlay_path))
-    print("Saved overlay to:", overlay_path)
 
-    return image
+def _record_response(record: CallRecord, response: "Response"):
+    if response.usage is not None:
+        record.input_tokens = response.usage.input_tokens
+        record.output_tokens = response.usage.output_tokens
+    record.image_tokens = REQUEST_TOKENS - TEXT_TOKENS
+
+
+async def request_mask_async(
+        body: dict,
+        limiter: RateLimiter | None = None,
+        call_log: CallLog | None = None,
+        image_id: str = "",
+) -> str:
+    """
+    Generate a mask without blocking the event loop, given the body created by `request_body`.
+
+    If a rate limiter is given it paces and retries the request in place of the client's own retries. If a call log
+    is given telemetry for the request is appended to it under the image ID.
+    """
+    with optional_record(call_log, "segment", [image_id], body["model"], payload_bytes=_payload_bytes(body)) as record:
+        if limiter is None:
+            response = await get_async_client().responses.create(**body)
+        else:
+            unretried_client = get_async_client().with_options(max_retries=0)
+            response = await limiter.call(lambda: unretried_client.responses.create(**body), tokens=REQUEST_TOKENS)
+        _record_response(record, response)
+    return mask_from_response(response)
+
+
+def prepare(image_path: Path) -> tuple[dict, Image.Image]:
+    """
+    The CPU bound work before a mask is requested: load, resize and encode the image into a request body.
+
+    Returns
+    -------
+    The request body and the resized image, which is given to `finalise` so it is not loaded and resized again
+    """
+    original_image = load_image(image_path)
+    return request_body(original_image), original_image
+
+
+def finalise(image_path: Path, original_image: Image.Image, mask_b64: str, black_tolerance: int = 0) -> Path:
+    """
+    The CPU bound work after a mask is generated: decode it, composite it onto the resized image returned by `prepare`
+    and save both images.
+
+    Returns
+    -------
+    The path of the saved mask
+    """
+    save_mask(mask_b64, original_image, image_path.parent, black_tolerance=black_tolerance)
+    return image_path.parent / "mask.png"
+
+
+def process_image(
+        image_path: Path,
+        black_tolerance: int = 0,
+        limiter: RateLimiter | None = None,
+        call_log: CallLog | None = None,
+) -> Image.Image:
+    original_image = load_image(image_path)
+    body = request_body(original_image)
+    image_id = image_path.parent.name
+
+    # Generate the mask via OpenAI Responses API using the image generation tool.
+    with optional_record(call_log, "segment", [image_id], body["model"], payload_bytes=_payload_bytes(body)) as record:
+        if limiter is None:
+            response = get_client().responses.create(**body)
+        else:
+            unretried_client = get_client().with_options(max_retries=0)
+            response = limiter.call_sync(lambda: unretried_client.responses.create(**body), tokens=REQUEST_TOKENS)
+        _record_response(record, response)
+
+    return save_mask(mask_from_response(response), original_image, image_path.parent, black_tolerance=black_tolerance)
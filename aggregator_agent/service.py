@@ -0,0 +1,401 @@
+"""
+A long-lived local service which categorises and segments images for many pipeline processes.
+
+Keeping one process warm avoids importing pydantic-ai and building the agents and HTTP connection pools in every
+script, and lets one rate limiter govern every caller. Categorisation jobs arriving within a short window are coalesced
+into a single grouped request, see `categorise_group`, and jobs for the same image share one request.
+
+The protocol is JSON over HTTP/1.1, on a TCP port or a Unix socket:
+
+    POST /categorise {"path": "..."}                         -> a LensFitAnalysis
+    POST /segment {"path": "...", "black_tolerance": 0}       -> {"mask": "..."}
+    GET /status                                               -> counters
+
+Paths are read by the service, so must be visible to it. Errors are returned as {"error": "..."} with a 4xx or 5xx
+status.
+
+Given a budget, each request reserves its estimated cost before it is sent, see `aggregator_agent.budget.prior_cost`,
+and the estimate is replaced by the cost of its calls once it finishes. Jobs whose request would take spending past the
+budget are refused with 402 Payment Required. As in `BudgetScheduler`, the budget can still be overrun by the error in
+the estimates of requests in flight.
+"""
+import asyncio
+import json
+from http import HTTPStatus
+from pathlib import Path
+from typing import TYPE_CHECKING, Awaitable, Callable, TypeVar
+
+import httpx
+
+from aggregator_agent.budget import CATEGORISE, SEGMENT, Job, prior_cost
+from aggregator_agent.cache import ResultCache
+from aggregator_agent.preprocessing import Preprocessing
+from aggregator_agent.rate_limit import RateLimiter
+from aggregator_agent.schema import LensFitAnalysis
+from aggregator_agent.segmentation import finalise, prepare, request_mask_async
+from aggregator_agent.telemetry import CallLog, collect_records
+
+# pydantic-ai is slow to import and only needed once jobs are run, so clients and the script's --help start quickly
+if TYPE_CHECKING:
+    from pydantic_ai.models import Model
+
+T = TypeVar("T")
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_MAX_WAIT = 0.05
+
+
+class BudgetExceeded(Exception):
+    """
+    A job was refused because its request would take spending past the service's budget.
+    """
+
+
+class Service:
+    """
+    Categorises and segments images submitted by clients, coalescing categorisation jobs into micro-batches.
+    """
+
+    def __init__(
+            self,
+            model: "Model | str | None" = None,
+            limiter: RateLimiter | None = None,
+            cache: ResultCache | None = None,
+            preprocessing: Preprocessing | None = None,
+            call_log: CallLog | None = None,
+            max_batch: int = 1,
+            max_wait: float = DEFAULT_MAX_WAIT,
+            concurrency: int = 8,
+            budget: float | None = None,
+    ):
+        """
+        Parameters
+        ----------
+        model
+            Optionally override the model used by the agents, e.g. with a rate limited model or a local stand-in
+        limiter
+            If given segmentation requests are paced and retried by it. Categorisation is limited through the model.
+        cache
+            If given previous answers for identical requests are reused
+        preprocessing
+            If given each image is transformed before it is categorised
+        call_log
+            If given telemetry for each call is appended to it
+        max_batch
+            The most images sent together in one categorisation request
+        max_wait
+            Seconds to wait after the first job of a batch for others to join it
+        concurrency
+            The most requests in flight at once, across all clients
+        budget
+            If given the most to spend, in US dollars, over the life of the service
+        """
+        if max_batch < 1:
+            raise ValueError(f"max_batch must be at least 1, got {max_batch}")
+        self.model = model
+        self.limiter = limiter
+        self.cache = cache
+        self.preprocessing = preprocessing
+        self.call_log = call_log
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.budget = budget
+
+        self.jobs = {"categorise": 0, "segment": 0}
+        self.batches = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.refused = 0
+        self.spent = 0.0
+        self.reserved = 0.0
+
+        self._queue: asyncio.Queue[tuple[Path, asyncio.Future]] | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+
+    async def categorise(self, path: Path) -> LensFitAnalysis:
+        """
+        Categorise an image as part of the next batch.
+        """
+        self.jobs["categorise"] += 1
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((path, future))
+        return await future
+
+    async def segment(self, path: Path, black_tolerance: int = 0) -> Path:
+        """
+        Segment an image, returning the path of the saved mask.
+        """
+        self.jobs["segment"] += 1
+        async with self._semaphore:
+            body, original_image = await asyncio.to_thread(prepare, path)
+            mask = await self._spend(
+                SEGMENT,
+                [path],
+                lambda: request_mask_async(body, self.limiter, self.call_log, path.parent.name),
+            )
+            return await asyncio.to_thread(finalise, path, original_image, mask, black_tolerance)
+
+    async def _spend(self, operation: str, paths: list[Path], request: Callable[[], Awaitable[T]]) -> T:
+        """
+        Make a request for images, counting the cost of its calls and, given a budget, first reserving its estimated
+        cost or raising BudgetExceeded if that would take spending past the budget.
+        """
+        from aggregator_agent.image_agent import _model_name
+
+        estimate = 0.0
+        if self.budget is not None:
+            model_name = _model_name(self.model)
+            estimate = sum(await asyncio.to_thread(
+                lambda: [prior_cost(Job(operation=operation, path=path), model_name) for path in paths]
+            ))
+            if self.spent + self.reserved + estimate > self.budget:
+                self.refused += len(paths)
+                raise BudgetExceeded(
+                    f"An estimated ${estimate:.4f} would take spending past the budget of ${self.budget:.2f} "
+                    f"(${self.spent:.4f} spent, ${self.reserved:.4f} reserved)"
+                )
+        self.reserved += estimate
+        with collect_records() as records:
+            try:
+                return await request()
+            finally:
+                self.reserved -= estimate
+                self.spent += sum(record.cost for record in records)
+
+    async def _dispatch(self):
+        """
+        Gather queued categorisation jobs into batches and send each once a request slot is free.
+
+        A batch is sent when it is full or max_wait seconds after its first job. While every slot is busy jobs keep
+        queueing, so batches fill up under load.
+        """
+        loop = asyncio.get_running_loop()
+        deferred: list[tuple[Path, asyncio.Future]] = []
+        while True:
+            # Image ID to its path and the futures waiting on it
+            batch: dict[str, tuple[Path, list[asyncio.Future]]] = {}
+
+            def add(path: Path, future: asyncio.Future) -> bool:
+                if path.stem not in batch:
+                    batch[path.stem] = (path, [future])
+                elif batch[path.stem][0] == path:
+                    batch[path.stem][1].append(future)
+                    self.coalesced += 1
+                else:
+                    # Grouped images must have unique IDs
+                    return False
+                return True
+
+            waiting, deferred = deferred, []
+            for path, future in waiting:
+                if len(batch) == self.max_batch or not add(path, future):
+                    deferred.append((path, future))
+            if not batch:
+                add(*await self._queue.get())
+
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch and (timeout := deadline - loop.time()) > 0:
+                try:
+                    path, future = await asyncio.wait_for(self._queue.get(), timeout)
+                except TimeoutError:
+                    break
+                if not add(path, future):
+                    deferred.append((path, future))
+
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self._run(list(batch.values())))
+            task.add_done_callback(lambda _: self._semaphore.release())
+
+    async def _run(self, batch: list[tuple[Path, list[asyncio.Future]]]):
+        from aggregator_agent.image_agent import categorise_async, categorise_group
+
+        self.batches += 1
+        paths = [path for path, _ in batch]
+        try:
+            if len(paths) == 1:
+                results = [(paths[0], await self._spend(CATEGORISE, paths, lambda: categorise_async(
+                    paths[0],
+                    model=self.model,
+                    cache=self.cache,
+                    preprocessing=self.preprocessing,
+                    call_log=self.call_log,
+                )))]
+            else:
+                results = await self._spend(CATEGORISE, paths, lambda: categorise_group(
+                    paths,
+                    model=self.model,
+                    cache=self.cache,
+                    preprocessing=self.preprocessing,
+                    call_log=self.call_log,
+                ))
+        except Exception as e:
+            results = [(path, e) for path in paths]
+
+        for (_, futures), (_, result) in zip(batch, results):
+            for future in futures:
+                # A client which disconnected has cancelled its future
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def status(self) -> dict:
+        return {
+            "jobs": self.jobs,
+            "batches": self.batches,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "refused": self.refused,
+            "spent": self.spent,
+            "budget": self.budget,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+    def summary(self) -> str:
+        categorised = self.jobs["categorise"] - self.coalesced
+        return (
+            f"Service: {self.jobs['categorise']} categorisation jobs in {self.batches} requests "
+            f"({categorised / max(self.batches, 1):.1f} images per request, {self.coalesced} shared), "
+            f"{self.jobs['segment']} segmentation jobs, {self.errors} errors, {self.refused} refused over budget, "
+            f"${self.spent:.4f} spent"
+        )
+
+    async def _respond(self, method: str, target: str, body: bytes) -> tuple[int, dict]:
+        if method == "GET" and target == "/status":
+            return 200, self.status()
+        if method != "POST" or target not in ("/categorise", "/segment"):
+            return 404, {"error": f"No route for {method} {target}"}
+
+        try:
+            job = json.loads(body)
+            path = Path(job["path"])
+            black_tolerance = int(job.get("black_tolerance", 0))
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {"error": f"Invalid job: {e!r}"}
+        if not path.is_file():
+            return 404, {"error": f"{path} does not exist"}
+
+        try:
+            if target == "/categorise":
+                return 200, (await self.categorise(path)).model_dump(mode="json")
+            return 200, {"mask": str(await self.segment(path, black_tolerance))}
+        except BudgetExceeded as e:
+            return 402, {"error": str(e)}
+        except Exception as e:
+            self.errors += 1
+            return 500, {"error": repr(e)}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Answer requests on a connection until the client closes it.
+        """
+        try:
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response = await self._respond(method, target, body)
+                data = json.dumps(response).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # The client went away or sent something other than HTTP
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, socket_path: Path | None = None):
+        """
+        Serve jobs until cancelled, on a Unix socket if a path is given and otherwise on a TCP port.
+        """
+        self._queue = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        dispatcher = asyncio.create_task(self._dispatch())
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self._handle, socket_path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            dispatcher.cancel()
+
+
+class ServiceClient:
+    """
+    Submits jobs to a running service. The synchronous methods may be shared between threads, and the asynchronous
+    methods between tasks of one event loop.
+    """
+
+    def __init__(
+            self,
+            url: str = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}",
+            socket_path: Path | None = None,
+            timeout: float = 600.0,
+    ):
+        """
+        Parameters
+        ----------
+        url
+            The address of a service listening on a TCP port
+        socket_path
+            The path of a service listening on a Unix socket, used in place of the URL
+        timeout
+            Seconds to wait for a job, including time spent queued behind other clients' jobs
+        """
+        if socket_path is not None:
+            url = "http://localhost"
+        self._client = httpx.Client(
+            base_url=url,
+            timeout=timeout,
+            transport=httpx.HTTPTransport(uds=str(socket_path)) if socket_path is not None else None,
+        )
+        self._async_client = httpx.AsyncClient(
+            base_url=url,
+            timeout=timeout,
+            transport=httpx.AsyncHTTPTransport(uds=str(socket_path)) if socket_path is not None else None,
+        )
+
+    def close(self):
+        self._client.close()
+
+    async def aclose(self):
+        await self._async_client.aclose()
+
+    @staticmethod
+    def _result(response: httpx.Response) -> dict:
+        if response.is_error:
+            raise RuntimeError(f"Service returned {response.status_code}: {response.json()['error']}")
+        return response.json()
+
+    def categorise(self, image_path: Path) -> LensFitAnalysis:
+        response = self._client.post("/categorise", json={"path": str(image_path.resolve())})
+        return LensFitAnalysis.model_validate(self._result(response))
+
+    async def categorise_async(self, image_path: Path) -> LensFitAnalysis:
+        response = await self._async_client.post("/categorise", json={"path": str(image_path.resolve())})
+        return LensFitAnalysis.model_validate(self._result(response))
+
+    def segment(self, image_path: Path, black_tolerance: int = 0) -> Path:
+        response = self._client.post(
+            "/segment",
+            json={"path": str(image_path.resolve()), "black_tolerance": black_tolerance},
+        )
+        return Path(self._result(response)["mask"])
+
+    def status(self) -> dict:
+        return self._result(self._client.get("/status"))
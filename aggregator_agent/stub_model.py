@@ -0,0 +1,55 @@
+import asyncio
+
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, ToolCallPart, UserPromptPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+
+from aggregator_agent.schema import Category
+
+
+def stub_model(
+        latency: float = 1.0,
+        category: Category = Category.Good,
+        confidence: float = 1.0,
+) -> FunctionModel:
+    """
+    A local stand-in for the VLM which waits for `latency` seconds and then returns a fixed analysis.
+
+    This lets throughput be measured without calling (or paying) a provider. When several images are sent together
+    one analysis is returned for each image ID in the prompt.
+
+    Parameters
+    ----------
+    latency
+        Seconds to wait before responding, simulating network and inference time
+    category
+        The category every image is assigned
+    confidence
+        The confidence reported when the output asks for one
+    """
+
+    async def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        await asyncio.sleep(latency)
+
+        output_tool = info.output_tools[0]
+        analysis = {"category": category, "description": "Stub analysis"}
+        if "confidence" in output_tool.parameters_json_schema["properties"]:
+            analysis["confidence"] = confidence
+        if "response" not in output_tool.parameters_json_schema["properties"]:
+            return ModelResponse(parts=[ToolCallPart(output_tool.name, analysis)])
+
+        image_ids = [
+            content.removeprefix("Image ID: ")
+            for message in messages if isinstance(message, ModelRequest)
+            for part in message.parts if isinstance(part, UserPromptPart)
+            for content in part.content if isinstance(content, str) and content.startswith("Image ID: ")
+        ]
+        return ModelResponse(
+            parts=[
+                ToolCallPart(
+                    output_tool.name,
+                    {"response": [{"id": image_id, **analysis} for image_id in image_ids]},
+                )
+            ]
+        )
+
+    return FunctionModel(respond, model_name="stub")
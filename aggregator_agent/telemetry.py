@@ -0,0 +1,305 @@
+"""
+Per-call telemetry: where the time and tokens of each request to a provider go.
+
+A call is recorded by wrapping it in `CallLog.record`, which makes the record being built available through a context
+variable. The rate limiter adds how long the call queued and how many times it was retried, and the HTTP clients
+created here note when the first byte of the response arrived. Completed records are appended to a JSONL file which
+`scripts/call_log_summary.py` summarises. Records can also be collected in memory with `collect_records`, e.g. to
+account for spend.
+"""
+import contextvars
+import io
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
+
+import httpx
+from PIL import Image
+from pydantic import BaseModel
+
+from aggregator_agent.preprocessing import estimate_image_tokens
+
+# pydantic-ai and the OpenAI SDK are slow to import and only needed once a call is made, so scripts importing the
+# argument helpers here start quickly
+if TYPE_CHECKING:
+    from pydantic_ai.messages import UserContent
+
+DEFAULT_CALL_LOG_PATH = Path("call_log.jsonl")
+
+# US dollars per million input and output tokens
+PRICES = {
+    "gpt-5": (1.25, 10.0),
+    "gpt-5-mini": (0.25, 2.0),
+    "gpt-5-nano": (0.05, 0.4),
+}
+
+
+class CallRecord(BaseModel):
+    """
+    Telemetry for a single call to a provider, or a cache hit in its place.
+
+    Attributes
+    ----------
+    started_at - the Unix time at which the call started
+    operation - what the call was for, e.g. categorise or segment
+    image_ids - the IDs of the images in the request
+    model - the name of the model called
+    prompt_hash - identifies the instructions and output schema sent, see `image_agent.prompt_hash`, if known
+    payload_bytes - the size of the images sent
+    queue_wait - seconds spent waiting for the rate limiter before the request was sent, across all attempts
+    time_to_first_byte - seconds from sending the final attempt to receiving the start of its response
+    latency - seconds from the start of the call to its result
+    input_tokens - input tokens reported by the provider
+    output_tokens - output tokens reported by the provider
+    image_tokens - estimated tokens for the images sent, included in the input tokens
+    retries - the number of times the request was retried
+    cache_hit - whether the result came from the cache, in which case nothing was sent
+    categories - the category assigned to each image, if it was categorised
+    error - the error raised, if the call failed
+    """
+
+    started_at: float
+    operation: str
+    image_ids: list[str]
+    model: str
+    prompt_hash: str | None = None
+    payload_bytes: int = 0
+    queue_wait: float = 0.0
+    time_to_first_byte: float | None = None
+    latency: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    image_tokens: int = 0
+    retries: int = 0
+    cache_hit: bool = False
+    categories: list[str] = []
+    error: str | None = None
+
+    @property
+    def cost(self) -> float:
+        """
+        The cost of the call in US dollars, or zero if the model's price is unknown.
+        """
+        input_price, output_price = PRICES.get(self.model, (0.0, 0.0))
+        return (self.input_tokens * input_price + self.output_tokens * output_price) / 1_000_000
+
+
+# The record of the call being made in the current task or thread
+current_call: contextvars.ContextVar[CallRecord | None] = contextvars.ContextVar("current_call", default=None)
+# When the request currently being sent started, used to measure time to first byte
+_sent_at: contextvars.ContextVar[float | None] = contextvars.ContextVar("sent_at", default=None)
+# Records of calls finished within the current `collect_records` block
+_collected: contextvars.ContextVar[list[CallRecord] | None] = contextvars.ContextVar("collected", default=None)
+
+
+@contextmanager
+def collect_records() -> Iterator[list[CallRecord]]:
+    """
+    Collect the record of every call finished within the block, whether or not it is logged, including calls made by
+    tasks and threads started within it.
+    """
+    records = []
+    token = _collected.set(records)
+    try:
+        yield records
+    finally:
+        _collected.reset(token)
+
+
+def _finished(record: CallRecord):
+    if (collected := _collected.get()) is not None:
+        collected.append(record)
+
+
+@contextmanager
+def _track(record: CallRecord, call_log: "CallLog | None" = None) -> Iterator[CallRecord]:
+    """
+    Make a record current and time the call, noting any error, then write it to the log, if any, and collect it.
+    """
+    token = current_call.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record.error = repr(e)
+        raise
+    finally:
+        record.latency = time.perf_counter() - start
+        current_call.reset(token)
+        if call_log is not None:
+            call_log.write(record)
+        _finished(record)
+
+
+def payload(prompt: "list[UserContent]") -> tuple[int, int]:
+    """
+    The total size in bytes and estimated tokens of the images in a prompt.
+    """
+    from pydantic_ai import BinaryContent
+
+    size = 0
+    tokens = 0
+    for part in prompt:
+        if isinstance(part, BinaryContent) and part.is_image:
+            size += len(part.data)
+            with Image.open(io.BytesIO(part.data)) as image:
+                tokens += estimate_image_tokens(image.width, image.height)
+    return size, tokens
+
+
+class CallLog:
+    """
+    Appends call records to a JSONL file. Safe to share between threads.
+    """
+
+    def __init__(self, path: Path = DEFAULT_CALL_LOG_PATH):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = path.open("a", buffering=1)
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "CallLog":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def write(self, record: CallRecord):
+        line = record.model_dump_json()
+        with self._lock:
+            self._file.write(line + "\n")
+
+    @contextmanager
+    def record(
+            self,
+            operation: str,
+            image_ids: list[str],
+            model: str,
+            payload_bytes: int = 0,
+    ) -> Iterator[CallRecord]:
+        """
+        Time a call, making its record current so other layers can fill it in, and write it when the call ends.
+        """
+        record = CallRecord(
+            started_at=time.time(),
+            operation=operation,
+            image_ids=image_ids,
+            model=model,
+            payload_bytes=payload_bytes,
+        )
+        with _track(record, self):
+            yield record
+
+
+@contextmanager
+def optional_record(
+        call_log: "CallLog | None",
+        operation: str,
+        image_ids: list[str],
+        model: str,
+        prompt: "list[UserContent] | None" = None,
+        payload_bytes: int = 0,
+) -> Iterator[CallRecord]:
+    """
+    Record the call if there is a log, otherwise time and fill in a record which is only kept by `collect_records`.
+
+    Either way the record is current during the call, so its latency, queue wait and retries are the same whether or
+    not it is logged. If a prompt is given the size and estimated tokens of its images are recorded. This is skipped
+    without a log, as it requires reading each image's dimensions.
+    """
+    if call_log is None:
+        record = CallRecord(
+            started_at=time.time(),
+            operation=operation,
+            image_ids=image_ids,
+            model=model,
+            payload_bytes=payload_bytes,
+        )
+        with _track(record):
+            yield record
+        return
+
+    image_tokens = 0
+    if prompt is not None:
+        payload_bytes, image_tokens = payload(prompt)
+    with call_log.record(operation, image_ids, model, payload_bytes) as record:
+        record.image_tokens = image_tokens
+        yield record
+
+
+def _request_sent(_: httpx.Request):
+    _sent_at.set(time.perf_counter())
+
+
+def _response_started(_: httpx.Response):
+    record = current_call.get()
+    sent_at = _sent_at.get()
+    if record is not None and sent_at is not None:
+        record.time_to_first_byte = time.perf_counter() - sent_at
+
+
+async def _request_sent_async(request: httpx.Request):
+    _request_sent(request)
+
+
+async def _response_started_async(response: httpx.Response):
+    _response_started(response)
+
+
+def http_client() -> httpx.Client:
+    """
+    An HTTP client for the OpenAI SDK, with its defaults, which notes when responses start arriving.
+    """
+    from openai import DefaultHttpxClient
+
+    return DefaultHttpxClient(event_hooks={"request": [_request_sent], "response": [_response_started]})
+
+
+def async_http_client() -> httpx.AsyncClient:
+    """
+    An async HTTP client for the OpenAI SDK, with its defaults, which notes when responses start arriving.
+    """
+    from openai import DefaultAsyncHttpxClient
+
+    return DefaultAsyncHttpxClient(
+        event_hooks={"request": [_request_sent_async], "response": [_response_started_async]}
+    )
+
+
+def read_call_log(path: Path) -> list[CallRecord]:
+    """
+    Read every record from a call log, skipping a partially written final line.
+    """
+    records = []
+    with path.open() as f:
+        for line in f:
+            if line.endswith("\n"):
+                records.append(CallRecord.model_validate_json(line))
+    return records
+
+
+def add_call_log_arguments(parser: ArgumentParser):
+    """
+    Add an option to record per-call telemetry to a script's argument parser.
+    """
+    parser.add_argument(
+        "--call-log",
+        type=Path,
+        nargs="?",
+        const=DEFAULT_CALL_LOG_PATH,
+        default=None,
+        help=f"Append telemetry for each call to this JSONL file (default when given: {DEFAULT_CALL_LOG_PATH})",
+    )
+
+
+def call_log_from_arguments(args: Namespace) -> CallLog | None:
+    """
+    Open the call log described by arguments added with `add_call_log_arguments`, or None if calls are not logged.
+    """
+    return CallLog(args.call_log) if args.call_log is not None else None
@@ -0,0 +1,283 @@
+"""
+Downsampled thumbnails of images, cached on disk, and the contact sheets and HTML galleries built from them.
+
+Decoding a full resolution PNG is most of the cost of showing it, so each image is decoded once and a small JPEG kept in
+the cache directory, keyed by the image's path, size, modification time and the thumbnail size. Later reviews of the
+same images only read the thumbnails. Thumbnails are generated by a thread pool, as decoding and resampling release the
+GIL, and can be prefetched in the background while the previous page is being looked at.
+"""
+import html
+import os
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable
+
+from PIL import Image, ImageDraw, ImageFont
+
+from aggregator_agent.cache import cache_key
+
+DEFAULT_THUMBNAIL_DIRECTORY = Path.home() / ".cache" / "aggregator_agent" / "thumbnails"
+# Longest edge of a thumbnail in pixels. Images are four panels wide, so this keeps each panel legible.
+DEFAULT_THUMBNAIL_SIZE = 640
+DEFAULT_QUALITY = 85
+
+_CAPTION_LINE_HEIGHT = 14
+_PADDING = 6
+
+
+class ThumbnailCache:
+    """
+    JPEG thumbnails of images in a directory, generated in parallel on first use and reused afterwards.
+    """
+
+    def __init__(
+            self,
+            directory: Path = DEFAULT_THUMBNAIL_DIRECTORY,
+            size: int = DEFAULT_THUMBNAIL_SIZE,
+            workers: int = 8,
+    ):
+        """
+        Parameters
+        ----------
+        directory
+            Where thumbnails are kept. Created if required.
+        size
+            The longest edge of a thumbnail in pixels
+        workers
+            Threads generating thumbnails
+        """
+        self.directory = directory
+        self.size = size
+        self.hits = 0
+        self.generated = 0
+        self.failed = 0
+        directory.mkdir(parents=True, exist_ok=True)
+        self._pool = ThreadPoolExecutor(workers)
+        self._futures: dict[Path, Future] = {}
+
+    def __enter__(self) -> "ThumbnailCache":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+
+    def path_for(self, image_path: Path) -> Path:
+        """
+        Where the thumbnail of an image is kept. It changes whenever the image is rewritten.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the image does not exist
+        """
+        stat = image_path.stat()
+        key = cache_key(str(image_path.resolve()), str(stat.st_size), str(stat.st_mtime_ns), str(self.size))
+        return self.directory / key[:2] / f"{key}.jpg"
+
+    def _generate(self, image_path: Path) -> Path | None:
+        try:
+            path = self.path_for(image_path)
+            if path.exists():
+                self.hits += 1
+                return path
+            with Image.open(image_path) as image:
+                # Reduces by an integer factor before resampling, which is much faster than resampling alone
+                image.thumbnail((self.size, self.size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+                image = image.convert("RGB")
+            path.parent.mkdir(exist_ok=True)
+            temporary = path.with_suffix(f".{os.getpid()}.tmp")
+            image.save(temporary, "JPEG", quality=DEFAULT_QUALITY)
+            os.replace(temporary, path)
+        except OSError as e:
+            print(f"Failed to create a thumbnail of {image_path}: {e}")
+            self.failed += 1
+            return None
+        self.generated += 1
+        return path
+
+    def prefetch(self, image_paths: Iterable[Path]):
+        """
+        Start generating thumbnails of images in the background, if they are not already being generated.
+        """
+        for image_path in image_paths:
+            if image_path not in self._futures:
+                self._futures[image_path] = self._pool.submit(self._generate, image_path)
+
+    def get_many(self, image_paths: list[Path]) -> list[Path | None]:
+        """
+        The thumbnail of each image, generating any which are missing in parallel. None is given for images which
+        could not be read.
+        """
+        self.prefetch(image_paths)
+        thumbnails = [self._futures[image_path].result() for image_path in image_paths]
+        for image_path in image_paths:
+            self._futures.pop(image_path, None)
+        return thumbnails
+
+    def summary(self) -> str:
+        return f"Thumbnails: {self.hits} reused, {self.generated} generated, {self.failed} failed in {self.directory}"
+
+
+def contact_sheet(
+        thumbnails: list[Path | None],
+        captions: list[list[str]],
+        columns: int,
+        size: int = DEFAULT_THUMBNAIL_SIZE,
+) -> Image.Image:
+    """
+    Tile thumbnails into a single image with lines of caption beneath each. Missing thumbnails leave a blank tile.
+
+    Parameters
+    ----------
+    thumbnails
+        Thumbnail files, in the order they are tiled left to right then top to bottom
+    captions
+        The lines of caption for each thumbnail
+    columns
+        The number of thumbnails in each row
+    size
+        The longest edge of the thumbnails
+    """
+    images = []
+    for path in thumbnails:
+        if path is None:
+            images.append(None)
+            continue
+        with Image.open(path) as image:
+            images.append(image.convert("RGB"))
+
+    caption_height = max(map(len, captions), default=0) * _CAPTION_LINE_HEIGHT
+    image_height = max((image.height for image in images if image is not None), default=size)
+    cell_width = size + _PADDING
+    cell_height = image_height + caption_height + _PADDING
+    rows = -(-len(images) // columns)
+
+    sheet = Image.new("RGB", (max(columns * cell_width, 1), max(rows * cell_height, 1)), "white")
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default()
+    for index, (image, lines) in enumerate(zip(images, captions)):
+        x = (index % columns) * cell_width
+        y = (index // columns) * cell_height
+        if image is not None:
+            sheet.paste(image, (x, y))
+        for line_number, line in enumerate(lines):
+            draw.text((x, y + image_height + line_number * _CAPTION_LINE_HEIGHT), line, fill="black", font=font)
+    return sheet
+
+
+def _gallery_page_name(page: int) -> str:
+    return "index.html" if page == 0 else f"page-{page + 1}.html"
+
+
+def write_gallery(
+        directory: Path,
+        title: str,
+        images: list[Path],
+        thumbnails: list[Path | None],
+        captions: list[list[str]],
+        page_size: int,
+) -> int:
+    """
+    Write a static, paged HTML gallery of thumbnails, each linking to its full image, returning the number of pages.
+
+    Each page asks the browser to prefetch the next page and its thumbnails, so paging does not wait on the disk.
+
+    Parameters
+    ----------
+    directory
+        Where the pages are written, starting with index.html. Created if required.
+    title
+        The heading of each page
+    images
+        The full resolution images
+    thumbnails
+        The thumbnail of each image, linked relative to the pages so the gallery moves with the thumbnail cache
+    captions
+        The lines of caption for each image. The first is shown in bold.
+    page_size
+        The number of images on each page
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    pages = max(-(-len(images) // page_size), 1)
+
+    def source(path: Path) -> str:
+        return html.escape(Path(os.path.relpath(path.resolve(), directory.resolve())).as_posix())
+
+    for page in range(pages):
+        start = page * page_size
+        next_start = start + page_size
+        links = []
+        if page > 0:
+            links.append(f'<a href="{_gallery_page_name(page - 1)}">Previous</a>')
+        links.append(f"Page {page + 1} of {pages}")
+        if page + 1 < pages:
+            links.append(f'<a href="{_gallery_page_name(page + 1)}">Next</a>')
+
+        prefetch = []
+        if page + 1 < pages:
+            prefetch.append(f'<link rel="prefetch" href="{_gallery_page_name(page + 1)}">')
+            prefetch.extend(
+                f'<link rel="prefetch" href="{source(thumbnail)}">'
+                for thumbnail in thumbnails[next_start:next_start + page_size] if thumbnail is not None
+            )
+
+        figures = []
+        for image, thumbnail, lines in zip(
+                images[start:next_start], thumbnails[start:next_start], captions[start:next_start]
+        ):
+            caption = "<br>".join(
+                [f"<b>{html.escape(lines[0])}</b>", *map(html.escape, lines[1:])] if lines else []
+            )
+            picture = (
+                f'<img src="{source(thumbnail)}" loading="lazy">' if thumbnail is not None else "[missing image]"
+            )
+            figures.append(
+                f'<figure><a href="{html.escape(image.resolve().as_uri())}">{picture}</a>'
+                f"<figcaption>{caption}</figcaption></figure>"
+            )
+
+        navigation = f"<nav>{' | '.join(links)}</nav>"
+        (directory / _gallery_page_name(page)).write_text(
+            "<!DOCTYPE html>\n"
+            f'<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>{"".join(prefetch)}'
+            "<style>body{font-family:sans-serif}figure{display:inline-block;vertical-align:top;margin:4px;"
+            "max-width:660px}img{max-width:100%}figcaption{font-size:12px}</style></head>\n"
+            f"<body><h1>{html.escape(title)}</h1>{navigation}\n{''.join(figures)}\n{navigation}</body></html>\n",
+            encoding="utf-8",
+        )
+    return pages
+
+
+def add_thumbnail_arguments(parser: ArgumentParser):
+    """
+    Add options controlling how thumbnails are generated and cached to a script's argument parser.
+    """
+    parser.add_argument(
+        "--thumbnail-cache",
+        type=Path,
+        default=DEFAULT_THUMBNAIL_DIRECTORY,
+        help=f"Directory caching thumbnails between runs (default: {DEFAULT_THUMBNAIL_DIRECTORY})",
+    )
+    parser.add_argument(
+        "--thumbnail-size",
+        type=int,
+        default=DEFAULT_THUMBNAIL_SIZE,
+        help=f"Longest edge of a thumbnail in pixels (default: {DEFAULT_THUMBNAIL_SIZE})",
+    )
+    parser.add_argument(
+        "--thumbnail-workers",
+        type=int,
+        default=8,
+        help="Threads generating thumbnails",
+    )
+
+
+def thumbnails_from_arguments(args: Namespace) -> ThumbnailCache:
+    """
+    Open the thumbnail cache described by arguments added with `add_thumbnail_arguments`.
+    """
+    return ThumbnailCache(args.thumbnail_cache, args.thumbnail_size, args.thumbnail_workers)
@@ -0,0 +1,324 @@
+"""
+Cheap local triage of lens modelling outputs before they are sent to the VLM.
+
+Statistics are computed from the "VIS Lens Light Subtracted" panel. Pixel colours are mapped back to values using the
+panel's own colorbar so values are relative to the colour scale of each image. Images whose statistics clearly pass or
+fail thresholds calibrated against ground truth are given a category without calling the VLM, and the rest are
+forwarded.
+"""
+import threading
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from pydantic import BaseModel
+
+from aggregator_agent.preprocessing import PANEL_NAMES
+from aggregator_agent.schema import Category, LensFitAnalysis
+
+# Pixels inside the axes are assumed to be plotted where at least half of a column or row is not white
+_PLOTTED_FRACTION = 0.5
+# Pixels at or above this fraction of the colour scale count as saturated
+_SATURATION_LEVEL = 0.98
+# The annulus inside the mask edge, as fractions of the mask radius, used to measure brightness at the edge
+_EDGE_ANNULUS = (0.8, 0.95)
+
+# The statistic that must exceed a threshold for a failing category to be assigned
+FAIL_STATISTICS = {
+    Category.DataIssue: "saturation_fraction",
+    Category.Fixable: "edge_brightness",
+}
+
+
+class ResidualStatistics(BaseModel):
+    """
+    Statistics of the lens light subtracted image within the mask, in units of the colour scale maximum.
+
+    Attributes
+    ----------
+    masked_flux - the mean value within the mask
+    residual_rms - the root mean square value within the mask
+    edge_brightness - the mean value in an annulus just inside the edge of the mask
+    saturation_fraction - the fraction of pixels within the mask at the top of the colour scale
+    """
+
+    masked_flux: float
+    residual_rms: float
+    edge_brightness: float
+    saturation_fraction: float
+
+    @classmethod
+    def from_path(cls, image_path: Path) -> "ResidualStatistics":
+        """
+        Compute statistics for the image output by lens modelling at the given path.
+        """
+        with Image.open(image_path) as image:
+            pixels = np.asarray(image.convert("RGB"), dtype=np.int32)
+        panel = pixels[:, :pixels.shape[1] // len(PANEL_NAMES)]
+        return cls.from_panel(panel)
+
+    @classmethod
+    def from_panel(cls, panel: np.ndarray) -> "ResidualStatistics":
+        """
+        Compute statistics for a single (height, width, RGB) panel comprising a plot and its colorbar.
+        """
+        plotted = panel.sum(axis=-1) < 3 * 240
+        columns = _runs(plotted.mean(axis=0) > _PLOTTED_FRACTION)
+        if len(columns) < 2:
+            raise ValueError("Could not find the plot and colorbar in the panel")
+        (axes_left, axes_right), (colorbar_left, colorbar_right) = columns[:2]
+        rows = _runs(plotted[:, axes_left:axes_right].mean(axis=1) > _PLOTTED_FRACTION)
+        top, bottom = max(rows, key=lambda run: run[1] - run[0])
+
+        # Trim the frames drawn around the plot and colorbar
+        frame = 3
+        axes = panel[top + frame:bottom - frame, axes_left + frame:axes_right - frame]
+        colorbar = panel[top + frame:bottom - frame, (colorbar_left + colorbar_right) // 2]
+
+        values, black = _invert_colours(axes, colorbar[::-1])
+        distance, radius = _mask_geometry(black)
+        inside = distance < radius
+
+        masked = values[inside & ~black]
+        if masked.size == 0:
+            raise ValueError("No data found within the mask")
+        edge = inside & ~black & (distance >= _EDGE_ANNULUS[0] * radius) & (distance <= _EDGE_ANNULUS[1] * radius)
+        return cls(
+            masked_flux=float(masked.mean()),
+            residual_rms=float(np.sqrt((masked ** 2).mean())),
+            edge_brightness=float(values[edge].mean()) if edge.any() else 0.0,
+            saturation_fraction=float((masked >= _SATURATION_LEVEL).mean()),
+        )
+
+
+def _runs(flags: np.ndarray) -> list[tuple[int, int]]:
+    """
+    The (start, stop) indices of each run of True values.
+    """
+    padded = np.concatenate([[False], flags, [False]]).astype(np.int8)
+    changes = np.flatnonzero(np.diff(padded))
+    return list(zip(changes[::2].tolist(), changes[1::2].tolist()))
+
+
+def _invert_colours(axes: np.ndarray, colorbar: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Map each pixel to the position of its nearest colorbar colour, from 0 (bottom) to 1 (top).
+
+    Returns
+    -------
+    The values, and a boolean array flagging black pixels (mask edges) which are not part of the data
+    """
+    colours, inverse = np.unique(axes.reshape(-1, 3), axis=0, return_inverse=True)
+    distances = ((colours[:, None, :] - colorbar[None, :, :]) ** 2).sum(axis=-1)
+    levels = distances.argmin(axis=1) / max(len(colorbar) - 1, 1)
+    values = levels[inverse.reshape(-1)].reshape(axes.shape[:2])
+    black = axes.sum(axis=-1) < 3 * 40
+    return values, black
+
+
+def _mask_geometry(black: np.ndarray) -> tuple[np.ndarray, float]:
+    """
+    Locate the circular mask from the black markers drawn along its edge.
+
+    Returns
+    -------
+    The distance of each pixel from the centre of the mask, and the radius of the mask
+    """
+    ys, xs = np.nonzero(black)
+    if len(xs) == 0:
+        centre_y, centre_x = (black.shape[0] - 1) / 2, (black.shape[1] - 1) / 2
+    else:
+        centre_y, centre_x = ys.mean(), xs.mean()
+    grid_y, grid_x = np.indices(black.shape)
+    distance = np.hypot(grid_y - centre_y, grid_x - centre_x)
+    radius = float(np.median(distance[black])) if len(xs) else min(black.shape) / 2
+    return distance, radius
+
+
+class TriageThresholds(BaseModel):
+    """
+    Thresholds deciding which images are triaged locally.
+
+    Attributes
+    ----------
+    good - upper limits on each statistic; an image below all of them is Good
+    fail - for each failing category, the lower limit on its statistic (see FAIL_STATISTICS) above which an image is
+        assigned that category
+    """
+
+    good: dict[str, float] | None = None
+    fail: dict[Category, float] = {}
+
+    def categorise(self, statistics: ResidualStatistics) -> Category | None:
+        """
+        The category of an image with the given statistics, or None if it is ambiguous and should be forwarded.
+        """
+        for category, threshold in self.fail.items():
+            if getattr(statistics, FAIL_STATISTICS[category]) >= threshold:
+                return category
+        if self.good is not None and all(
+                getattr(statistics, name) <= limit for name, limit in self.good.items()
+        ):
+            return Category.Good
+        return None
+
+
+def _precision(predicted: np.ndarray, actual: np.ndarray) -> float:
+    return float(actual[predicted].mean()) if predicted.any() else 0.0
+
+
+def calibrate(
+        statistics: list[ResidualStatistics],
+        categories: list[Category],
+        target_precision: float = 0.95,
+        min_support: int = 3,
+) -> TriageThresholds:
+    """
+    Choose the most permissive thresholds whose decisions reach the target precision on labelled images.
+
+    The Good limits are a common quantile of each statistic over the Good images, taking the highest quantile that
+    is precise enough. Each failing threshold is the lowest value of its statistic that is precise enough.
+
+    Parameters
+    ----------
+    statistics
+        Statistics for each labelled image
+    categories
+        The ground truth category of each image
+    target_precision
+        The fraction of triaged decisions that must be correct
+    min_support
+        The minimum number of labelled images a decision must apply to
+    """
+    table = {
+        name: np.array([getattr(statistic, name) for statistic in statistics])
+        for name in ResidualStatistics.model_fields
+    }
+    categories = np.array(categories)
+
+    fail = {}
+    for category, name in FAIL_STATISTICS.items():
+        for threshold in np.sort(np.unique(table[name])):
+            predicted = table[name] >= threshold
+            if predicted.sum() >= min_support and _precision(predicted, categories == category) >= target_precision:
+                fail[category] = float(threshold)
+                break
+
+    good = None
+    is_good = categories == Category.Good
+    if is_good.any():
+        for quantile in np.linspace(1.0, 0.05, 20):
+            limits = {name: float(np.quantile(values[is_good], quantile)) for name, values in table.items()}
+            predicted = np.all([table[name] <= limit for name, limit in limits.items()], axis=0)
+            if predicted.sum() >= min_support and _precision(predicted, is_good) >= target_precision:
+                good = limits
+                break
+
+    return TriageThresholds(good=good, fail=fail)
+
+
+def cross_validate(
+        statistics: list[ResidualStatistics],
+        categories: list[Category],
+        folds: int = 5,
+        target_precision: float = 0.95,
+        min_support: int = 3,
+        seed: int | None = None,
+) -> list[Category | None]:
+    """
+    Decide each labelled image with thresholds calibrated on the other folds, so accuracy can be measured on images
+    the thresholds were not chosen to fit.
+
+    Images are split into folds stratified by category, so each fold holds every category in proportion.
+
+    Parameters
+    ----------
+    statistics
+        Statistics for each labelled image
+    categories
+        The ground truth category of each image
+    folds
+        The number of folds; each image is held out of exactly one
+    target_precision
+        Passed to `calibrate`
+    min_support
+        Passed to `calibrate`
+    seed
+        Seeds the assignment of images to folds
+
+    Returns
+    -------
+    The held out decision for each image, or None where it would be forwarded to the VLM
+    """
+    if folds < 2:
+        raise ValueError("Cross validation needs at least two folds")
+    rng = np.random.default_rng(seed)
+    fold_of = np.empty(len(categories), dtype=int)
+    for category in set(categories):
+        members = rng.permutation([i for i, image_category in enumerate(categories) if image_category == category])
+        fold_of[members] = (np.arange(len(members)) + rng.integers(folds)) % folds
+
+    decisions: list[Category | None] = [None] * len(categories)
+    for fold in range(folds):
+        training = np.flatnonzero(fold_of != fold)
+        thresholds = calibrate(
+            [statistics[i] for i in training],
+            [categories[i] for i in training],
+            target_precision=target_precision,
+            min_support=min_support,
+        )
+        for i in np.flatnonzero(fold_of == fold):
+            decisions[i] = thresholds.categorise(statistics[i])
+    return decisions
+
+
+class Triage:
+    """
+    Triages images locally, counting how many are decided and how many are forwarded to the VLM.
+
+    Images may be triaged from several threads at once.
+    """
+
+    def __init__(self, thresholds: TriageThresholds):
+        self.thresholds = thresholds
+        self.triaged = 0
+        self.forwarded = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_path(cls, path: Path) -> "Triage":
+        """
+        Load thresholds saved as JSON, e.g. by scripts/calibrate_triage.py.
+        """
+        return cls(TriageThresholds.model_validate_json(path.read_text()))
+
+    def categorise(self, image_path: Path) -> LensFitAnalysis | None:
+        """
+        Categorise the image locally, or return None if it should be forwarded to the VLM.
+
+        Images whose statistics cannot be computed are forwarded.
+        """
+        try:
+            statistics = ResidualStatistics.from_path(image_path)
+        except (ValueError, OSError):
+            category = None
+        else:
+            category = self.thresholds.categorise(statistics)
+
+        with self._lock:
+            if category is None:
+                self.forwarded += 1
+            else:
+                self.triaged += 1
+
+        if category is None:
+            return None
+        return LensFitAnalysis(
+            category=category,
+            description=f"Triaged locally from residual statistics: {statistics.model_dump()}",
+        )
+
+    def summary(self) -> str:
+        total = self.triaged + self.forwarded
+        rate = self.triaged / total if total else 0.0
+        return f"Triage: {self.triaged} decided locally ({rate:.0%} of calls avoided), {self.forwarded} forwarded"
@@ -0,0 +1,120 @@
+"""
+Self-consistency voting: several independent runs per image, with the majority category winning.
+
+Runs are issued concurrently and the rest are cancelled as soon as one category has a majority the remaining runs
+cannot overturn. Voting can be limited to borderline categories, in which case a single run is made first and only
+images it places in one of those categories get the remaining runs.
+"""
+from argparse import ArgumentParser, Namespace
+from collections import Counter
+
+from pydantic import BaseModel
+
+from aggregator_agent.schema import Category, LensFitAnalysis
+
+
+class VoteOutcome(BaseModel):
+    """
+    The result of categorising an image by vote.
+
+    Attributes
+    ----------
+    analysis - an analysis from the winning category
+    first - the first analysis returned, i.e. what a single run would have given
+    votes - the number of runs which returned each category
+    runs - the number of runs which completed, including any that failed
+    """
+
+    analysis: LensFitAnalysis
+    first: LensFitAnalysis
+    votes: dict[Category, int]
+    runs: int
+
+    @property
+    def agreement(self) -> float:
+        """
+        The fraction of votes cast for the winning category.
+        """
+        total = sum(self.votes.values())
+        return self.votes[self.analysis.category] / total if total else 0.0
+
+
+def is_decided(votes: Counter, remaining: int) -> bool:
+    """
+    Whether the leading category cannot be caught by the runs still outstanding.
+    """
+    if not votes:
+        return False
+    ranked = votes.most_common(2)
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    return ranked[0][1] > runner_up + remaining
+
+
+class Voting:
+    """
+    How many runs to make per image and for which categories, counting the runs made and avoided.
+    """
+
+    def __init__(self, votes: int = 5, borderline: tuple[Category, ...] | None = None):
+        """
+        Parameters
+        ----------
+        votes
+            The most runs made for an image
+        borderline
+            If given, only images whose first run returns one of these categories get further runs
+        """
+        if votes < 1:
+            raise ValueError(f"votes must be at least 1, got {votes}")
+        self.votes = votes
+        self.borderline = tuple(borderline) if borderline is not None else None
+        self.images = 0
+        self.runs = 0
+        self.voted = 0
+        self.avoided = 0
+
+    def needs_vote(self, first: LensFitAnalysis) -> bool:
+        return self.borderline is None or first.category in self.borderline
+
+    def record(self, outcome: VoteOutcome):
+        self.images += 1
+        self.runs += outcome.runs
+        # Images outside the borderline categories were never due more than their first run
+        if self.needs_vote(outcome.first):
+            self.voted += 1
+            self.avoided += self.votes - outcome.runs
+
+    def summary(self) -> str:
+        extra = self.runs - self.images
+        return (
+            f"Voting: {self.runs} runs for {self.images} images ({extra} extra), {self.voted} voted on, "
+            f"{self.avoided} avoided by stopping early"
+        )
+
+
+def add_voting_arguments(parser: ArgumentParser):
+    """
+    Add options controlling self-consistency voting to a script's argument parser.
+    """
+    parser.add_argument(
+        "--votes",
+        type=int,
+        default=1,
+        help="Categorise each image up to this many times concurrently and take the majority",
+    )
+    parser.add_argument(
+        "--vote-categories",
+        type=Category,
+        nargs="+",
+        default=None,
+        help="Only vote on images whose first run returns one of these categories",
+    )
+
+
+def voting_from_arguments(args: Namespace) -> Voting | None:
+    """
+    Create the voting described by arguments added with `add_voting_arguments`, or None for a single run per image.
+    """
+    if args.votes <= 1:
+        return None
+    return Voting(votes=args.votes, borderline=args.vote_categories)
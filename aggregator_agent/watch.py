@@ -0,0 +1,303 @@
+"""
+Watch a directory for images as lens modelling writes them, so they can be categorised within seconds.
+
+On Linux the kernel reports files closed after writing or moved into the directory through inotify, which is bound
+here with ctypes. Elsewhere, or on network filesystems where other nodes' writes are not reported, the directory is
+scanned on an interval and files are compared with the modification time and size they had when last reported.
+
+Either way an image is only reported once it has finished being written: its modification time and size must be
+unchanged for a settling period, and a PNG must end with its IEND chunk. An image which is later rewritten is reported
+again.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import AsyncIterator
+
+DEFAULT_SETTLE_SECONDS = 1.0
+DEFAULT_POLL_INTERVAL = 1.0
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+# wd, mask, cookie and the length of the name which follows
+_EVENT = struct.Struct("iIII")
+
+# The final chunk of every PNG: zero length, type and CRC
+_PNG_END = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+
+def is_written(path: Path) -> bool:
+    """
+    Whether the image looks completely written. A PNG must end with its IEND chunk, other formats are assumed complete.
+    """
+    if path.suffix.lower() != ".png":
+        return True
+    try:
+        with path.open("rb") as f:
+            f.seek(-len(_PNG_END), os.SEEK_END)
+            return f.read() == _PNG_END
+    except OSError:
+        return False
+
+
+class Inotify:
+    """
+    A minimal binding to Linux inotify which reports the names of files written to, or moved into, a directory.
+    """
+
+    def __init__(self, directory: Path):
+        """
+        Raises
+        ------
+        OSError
+            If inotify is unavailable or the directory cannot be watched
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError as e:
+            raise OSError("inotify is not supported by this C library") from e
+
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        if add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"Cannot watch {directory}: {os.strerror(errno)}")
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self) -> tuple[list[str], bool]:
+        """
+        Read every event waiting without blocking.
+
+        Returns
+        -------
+        The names of files reported, and whether the kernel's queue overflowed so that events were lost
+        """
+        names = []
+        overflowed = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflowed = True
+                elif name:
+                    names.append(os.fsdecode(name))
+        return names, overflowed
+
+
+class DirectoryWatcher:
+    """
+    Reports images in a directory once they have finished being written, and again whenever they are rewritten.
+    """
+
+    def __init__(
+            self,
+            directory: Path,
+            settle: float = DEFAULT_SETTLE_SECONDS,
+            poll_interval: float = DEFAULT_POLL_INTERVAL,
+            use_inotify: bool = True,
+            suffixes: tuple[str, ...] = (".png",),
+    ):
+        """
+        Parameters
+        ----------
+        directory
+            The directory written to by lens modelling
+        settle
+            Seconds an image's modification time and size must be unchanged before it is reported
+        poll_interval
+            Seconds between scans of the directory when polling, and between checks on images still being written
+        use_inotify
+            Whether to use inotify where available. Pass False for network filesystems written to by other nodes.
+        suffixes
+            Only files with these suffixes are reported. Temporary files written before a rename are ignored.
+        """
+        self.directory = directory
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.suffixes = suffixes
+        self.inotify: Inotify | None = None
+        # The modification time and size of each image when it was last reported
+        self._reported: dict[str, tuple[int, int]] = {}
+        # Images which may have changed, with their modification time and size and when they were first seen so
+        self._pending: dict[Path, tuple[tuple[int, int], float] | None] = {}
+        self.reports = 0
+
+    def __enter__(self) -> "DirectoryWatcher":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    @property
+    def method(self) -> str:
+        return "inotify" if self.inotify is not None else f"polling every {self.poll_interval:g}s"
+
+    def _matches(self, name: str) -> bool:
+        return not name.startswith(".") and name.lower().endswith(self.suffixes)
+
+    def _scan(self):
+        """
+        Mark every image whose modification time or size differs from when it was last reported as pending.
+        """
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not self._matches(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if self._reported.get(entry.name) != (stat.st_mtime_ns, stat.st_size):
+                    self._pending.setdefault(Path(entry.path), None)
+
+    def _settled(self) -> list[Path]:
+        """
+        Remove and return the pending images which have finished being written.
+        """
+        now = time.monotonic()
+        ready = []
+        for path, observed in list(self._pending.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            key = (stat.st_mtime_ns, stat.st_size)
+            if self._reported.get(path.name) == key:
+                del self._pending[path]
+                continue
+            if observed is None or observed[0] != key:
+                observed = self._pending[path] = (key, now)
+
+            # Files untouched for the settling period when first seen need not wait for it again
+            stable = now - observed[1] >= self.settle or time.time() - stat.st_mtime >= self.settle
+            if stable and is_written(path):
+                del self._pending[path]
+                self._reported[path.name] = key
+                ready.append(path)
+
+        self.reports += len(ready)
+        return sorted(ready)
+
+    def start(self) -> list[Path]:
+        """
+        Start watching and return the images already in the directory which have finished being written.
+
+        Watching starts before the directory is listed so nothing written in between is missed. Images still being
+        written are reported by `changes` once they are complete.
+        """
+        if self.use_inotify and sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify(self.directory)
+            except OSError as e:
+                print(f"{e}, polling {self.directory} instead")
+        self._scan()
+        return self._settled()
+
+    async def changes(self) -> AsyncIterator[list[Path]]:
+        """
+        Yield batches of images as they finish being written, until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        if self.inotify is not None:
+            loop.add_reader(self.inotify.fd, woken.set)
+        try:
+            while True:
+                # With inotify there is nothing to do until an event arrives unless images are still being written
+                timeout = self.poll_interval if self.inotify is None or self._pending else None
+                try:
+                    await asyncio.wait_for(woken.wait(), timeout)
+                except TimeoutError:
+                    pass
+                woken.clear()
+
+                if self.inotify is None:
+                    self._scan()
+                else:
+                    names, overflowed = self.inotify.read()
+                    if overflowed:
+                        self._scan()
+                    for name in filter(self._matches, names):
+                        self._pending.setdefault(self.directory / name, None)
+
+                if ready := self._settled():
+                    yield ready
+        finally:
+            if self.inotify is not None:
+                loop.remove_reader(self.inotify.fd)
+
+    def summary(self) -> str:
+        return f"Watch: {self.reports} images reported using {self.method}, {len(self._pending)} still being written"
+
+
+def add_watch_arguments(parser: ArgumentParser):
+    """
+    Add options for watching a directory for new images to a script's argument parser.
+    """
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="After categorising the images present, keep categorising new or changed images until interrupted",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=DEFAULT_SETTLE_SECONDS,
+        help="Seconds an image must be unchanged before it is categorised",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="Scan the directory on an interval rather than using inotify, e.g. on a network filesystem",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between scans when polling",
+    )
+
+
+def watcher_from_arguments(args: Namespace, directory: Path) -> DirectoryWatcher | None:
+    """
+    Create a watcher for the directory as described by arguments added with `add_watch_arguments`, or None if the
+    directory is not watched.
+    """
+    if not args.watch:
+        return None
+    return DirectoryWatcher(
+        directory,
+        settle=args.settle,
+        poll_interval=args.poll_interval,
+        use_inotify=not args.poll,
+    )
@@ -0,0 +1,208 @@
+"""
+A work queue shared by several workers, possibly on different nodes, through a SQLite file on a shared filesystem.
+
+Workers claim batches of images by taking a lease on them. Leases are extended by heartbeats while a worker is busy,
+and the leases of workers that die are returned to the queue once they expire. Results are written to the same file
+keyed by image ID, so an image completed twice after a lease expired is still only stored once.
+
+SQLite relies on file locks, so the shared filesystem must support them (NFSv4 and Lustre with flock do). The
+rollback journal is used rather than WAL because WAL requires shared memory between processes on the same host.
+"""
+import csv
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from aggregator_agent.schema import LensFitAnalysis
+
+DEFAULT_LEASE_SECONDS = 300.0
+
+
+class WorkQueue:
+    """
+    A lease-based queue of images to categorise and a store of their results.
+    """
+
+    def __init__(self, path: Path, lease_seconds: float = DEFAULT_LEASE_SECONDS, max_attempts: int = 3):
+        """
+        Parameters
+        ----------
+        path
+            The SQLite database file, on a filesystem shared by every worker
+        lease_seconds
+            How long a claim lasts without a heartbeat before the images are returned to the queue
+        max_attempts
+            How many times an image is tried before it is marked as failed
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        # Wait on locks held by other workers rather than failing immediately. Workers call the queue from a thread so
+        # waiting does not block their event loop, so transactions on the connection are serialised by a lock.
+        self._connection = sqlite3.connect(path, timeout=60.0, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._connection.execute("PRAGMA journal_mode=DELETE")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_expires);
+            CREATE TABLE IF NOT EXISTS results (
+                id TEXT PRIMARY KEY,
+                category TEXT NOT NULL,
+                description TEXT NOT NULL,
+                worker TEXT NOT NULL,
+                completed_at REAL NOT NULL
+            );
+            """
+        )
+
+    def __enter__(self) -> "WorkQueue":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        A write transaction which takes the lock up front, so concurrent claims from other workers cannot overlap.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def enqueue(self, image_paths: Iterable[Path]) -> int:
+        """
+        Add images to the queue, ignoring any whose ID is already queued. Returns the number added.
+        """
+        with self._transaction() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO items (id, path) VALUES (?, ?)",
+                ((path.stem, str(path)) for path in image_paths),
+            )
+            return connection.total_changes - before
+
+    def claim(self, worker: str, batch_size: int) -> list[Path]:
+        """
+        Lease up to batch_size pending images to the worker, first returning expired leases to the queue.
+
+        An expired lease counts as a failed attempt, so an image which kills every worker that takes it, e.g. by
+        running out of memory, is eventually marked as failed rather than leased forever.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                """
+                UPDATE items SET
+                    attempts = attempts + 1,
+                    error = 'Lease expired',
+                    worker = NULL,
+                    state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+                WHERE state = 'leased' AND lease_expires < ?
+                """,
+                (self.max_attempts, now),
+            )
+            rows = connection.execute(
+                "SELECT id, path FROM items WHERE state = 'pending' LIMIT ?", (batch_size,)
+            ).fetchall()
+            connection.executemany(
+                "UPDATE items SET state = 'leased', worker = ?, lease_expires = ? WHERE id = ?",
+                ((worker, now + self.lease_seconds, image_id) for image_id, _ in rows),
+            )
+        return [Path(path) for _, path in rows]
+
+    def heartbeat(self, worker: str) -> int:
+        """
+        Extend every lease held by the worker. Returns the number of leases extended.
+        """
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE items SET lease_expires = ? WHERE state = 'leased' AND worker = ?",
+                (time.time() + self.lease_seconds, worker),
+            ).rowcount
+
+    def complete(self, worker: str, image_id: str, analysis: LensFitAnalysis):
+        """
+        Store the result for an image. If another worker already stored one, the first result is kept.
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO results (id, category, description, worker, completed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (image_id, analysis.category, analysis.description, worker, time.time()),
+            )
+            connection.execute(
+                "UPDATE items SET state = 'done', worker = ?, error = NULL WHERE id = ?", (worker, image_id)
+            )
+
+    def fail(self, worker: str, image_id: str, error: str):
+        """
+        Record a failed attempt, returning the image to the queue unless it has run out of attempts.
+
+        Nothing is recorded if the lease has since passed to another worker.
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                """
+                UPDATE items SET
+                    attempts = attempts + 1,
+                    error = ?,
+                    worker = NULL,
+                    state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+                WHERE id = ? AND state = 'leased' AND worker = ?
+                """,
+                (error, self.max_attempts, image_id, worker),
+            )
+
+    def release(self, worker: str):
+        """
+        Return every image leased by the worker to the queue, e.g. when it is interrupted.
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE items SET state = 'pending', worker = NULL WHERE state = 'leased' AND worker = ?",
+                (worker,),
+            )
+
+    def progress(self) -> dict[str, int]:
+        """
+        The number of images in each state.
+        """
+        with self._lock:
+            counts = dict(self._connection.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in ["pending", "leased", "done", "failed"]}
+
+    def export(self, output_filename: Path) -> int:
+        """
+        Write every result to a CSV in the same format as predict_directory.py. Returns the number of rows.
+        """
+        rows = self._connection.execute("SELECT id, category, description FROM results ORDER BY id").fetchall()
+        with output_filename.open("w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "category", "description"])
+            writer.writerows(rows)
+        return len(rows)
+
+    def summary(self) -> str:
+        return "Queue: " + ", ".join(f"{count} {state}" for state, count in self.progress().items())
@@ -0,0 +1,34 @@
+"""
+__Analysis__
+
+The analysis of each simulated dataset. It is kept in its own module, rather than defined where it is used, so that
+autofit, which is slow to import, is only imported by the processes which fit, and so that the class can be pickled
+by reference when the search copies or sends its analysis between processes.
+"""
+import autofit as af
+
+
+class Analysis(af.ex.Analysis):
+    """
+    Counts the likelihood evaluations made in this process, for searches which do not report their own.
+    """
+
+    likelihood_evaluations = 0
+
+    def log_likelihood_function(self, instance):
+        self.likelihood_evaluations += 1
+        return super().log_likelihood_function(instance)
+
+
+def likelihood_evaluations(result, analysis: Analysis) -> int:
+    """
+    The number of likelihood evaluations made by a fit.
+
+    The search's own count is preferred, e.g. dynesty's total number of likelihood calls, as the analysis also counts
+    evaluations made outside the search, such as the checks made before it starts, and misses any made in other
+    processes. The analysis's count is used if the search does not report one.
+    """
+    samples_info = getattr(result.samples, "samples_info", None) or {}
+    if (total := samples_info.get("total_samples")) is not None:
+        return int(total)
+    return analysis.likelihood_evaluations
@@ -0,0 +1,184 @@
+"""
+__Datasets__
+
+Simulated 1D Gaussian datasets are stored together in a single NumPy `.npy` file holding a structured array, with one
+record per dataset. Each record holds the dataset's index, the true `Gaussian` parameters it was simulated from, its
+data and its noise-map.
+
+The file is written and read as a memory map, so datasets are simulated and written a chunk at a time however many
+there are, and loading dataset `i` reads only its record from disk, rather than parsing JSON files.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+
+import numpy as np
+
+DEFAULT_DATASETS_PATH = path.join("dataset", "datasets.npy")
+
+PIXELS = 100
+SIGNAL_TO_NOISE_RATIO = 25.0
+
+# The uniform priors the true parameters of each dataset are drawn from, as (lower_limit, upper_limit)
+PARAMETER_RANGES = {
+    "centre": (40.0, 60.0),
+    "normalization": (1.0, 1e2),
+    "sigma": (1.0, 10.0),
+}
+
+# Datasets simulated in each array operation, bounding the memory used
+DEFAULT_CHUNK_SIZE = 10_000
+
+
+def dataset_dtype(pixels: int = PIXELS) -> np.dtype:
+    """
+    The structured dtype of a record in a datasets file.
+    """
+    return np.dtype(
+        [("index", np.int64)]
+        + [(name, np.float64) for name in PARAMETER_RANGES]
+        + [("data", np.float64, (pixels,)), ("noise_map", np.float64, (pixels,))]
+    )
+
+
+def gaussian_profiles(
+        xvalues: np.ndarray,
+        centre: np.ndarray,
+        normalization: np.ndarray,
+        sigma: np.ndarray,
+) -> np.ndarray:
+    """
+    Evaluate many `Gaussian` profiles at once, giving an array with a row per profile and a column per x value.
+
+    This is the profile of `af.ex.Gaussian.model_data_from`, broadcast over arrays of parameters.
+    """
+    centre, normalization, sigma = (
+        np.asarray(value, dtype=np.float64)[:, None] for value in (centre, normalization, sigma)
+    )
+    return normalization / (sigma * np.sqrt(2.0 * np.pi)) * np.exp(-0.5 * np.square((xvalues - centre) / sigma))
+
+
+def simulate_datasets(
+        total_datasets: int,
+        datasets_path: str = DEFAULT_DATASETS_PATH,
+        seed: int | None = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        pixels: int = PIXELS,
+) -> np.memmap:
+    """
+    Simulate datasets and write them to a datasets file, returning it opened read only.
+
+    The true parameters of every dataset in a chunk are drawn from their priors, and the noise added to their data,
+    as single array operations. The file is written alongside and moved into place once complete, so an interrupted
+    simulation does not leave a partial file to be fitted.
+
+    Parameters
+    ----------
+    total_datasets
+        The number of datasets simulated
+    datasets_path
+        The `.npy` file written. Parent directories are created if required.
+    seed
+        Seeds the random number generator, so the same datasets can be simulated again
+    chunk_size
+        The number of datasets simulated in each array operation
+    pixels
+        The number of data points in each dataset
+    """
+    rng = np.random.default_rng(seed)
+    xvalues = np.arange(pixels)
+    noise_map = np.full(pixels, 1.0 / SIGNAL_TO_NOISE_RATIO)
+
+    os.makedirs(path.dirname(datasets_path) or ".", exist_ok=True)
+    temporary_path = f"{datasets_path}.tmp.npy"
+    datasets = np.lib.format.open_memmap(
+        temporary_path, mode="w+", dtype=dataset_dtype(pixels), shape=(total_datasets,)
+    )
+    for start in range(0, total_datasets, chunk_size):
+        chunk = datasets[start:start + chunk_size]
+        count = len(chunk)
+        chunk["index"] = np.arange(start, start + count)
+        for name, (lower_limit, upper_limit) in PARAMETER_RANGES.items():
+            chunk[name] = rng.uniform(lower_limit, upper_limit, count)
+        chunk["data"] = gaussian_profiles(xvalues, chunk["centre"], chunk["normalization"], chunk["sigma"])
+        chunk["data"] += rng.normal(0.0, 1.0 / SIGNAL_TO_NOISE_RATIO, (count, pixels))
+        chunk["noise_map"] = noise_map
+    datasets.flush()
+    del datasets
+    os.replace(temporary_path, datasets_path)
+    return load_datasets(datasets_path)
+
+
+def load_datasets(datasets_path: str = DEFAULT_DATASETS_PATH) -> np.memmap:
+    """
+    Open a datasets file as a read only memory map, so records are only read from disk when they are used.
+    """
+    return np.load(datasets_path, mmap_mode="r")
+
+
+def load_dataset(index: int, datasets_path: str = DEFAULT_DATASETS_PATH) -> tuple[np.ndarray, np.ndarray, dict]:
+    """
+    The data, noise-map and true parameters of a single dataset.
+    """
+    record = load_datasets(datasets_path)[index]
+    parameters = {name: float(record[name]) for name in PARAMETER_RANGES}
+    return np.array(record["data"]), np.array(record["noise_map"]), parameters
+
+
+def _plot_datasets(datasets_path: str, indices: range, output_path: str):
+    # The object oriented API avoids pyplot's global figure state, which is slow to set up and not needed here
+    from matplotlib.figure import Figure
+
+    datasets = load_datasets(datasets_path)
+    xvalues = np.arange(datasets.dtype["data"].shape[0])
+    for index in indices:
+        figure = Figure()
+        axes = figure.subplots()
+        axes.errorbar(
+            x=xvalues,
+            y=datasets[index]["data"],
+            yerr=datasets[index]["noise_map"],
+            linestyle="",
+            color="k",
+            ecolor="k",
+            elinewidth=1,
+            capsize=2,
+        )
+        axes.set_title("1D Gaussian Dataset.")
+        axes.set_xlabel("x values of profile")
+        axes.set_ylabel("Profile normalization")
+        figure.savefig(path.join(output_path, f"dataset_{index}.png"))
+
+
+def plot_datasets(
+        datasets_path: str = DEFAULT_DATASETS_PATH,
+        output_path: str = path.join("dataset", "images"),
+        indices: range | None = None,
+        workers: int | None = None,
+):
+    """
+    Plot the data and noise-map of datasets as `dataset_<index>.png`, splitting them between processes.
+
+    Parameters
+    ----------
+    datasets_path
+        The datasets file
+    output_path
+        The directory plots are written to. Created if required.
+    indices
+        The datasets plotted, by default all of them
+    workers
+        Processes plotting, by default one per CPU
+    """
+    os.makedirs(output_path, exist_ok=True)
+    if indices is None:
+        indices = range(len(load_datasets(datasets_path)))
+    workers = workers or os.cpu_count() or 1
+    step = max(-(-len(indices) // workers), 1)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(_plot_datasets, datasets_path, indices[start:start + step], output_path)
+            for start in range(0, len(indices), step)
+        ]
+        for future in futures:
+            future.result()
@@ -0,0 +1,206 @@
+"""
+__Fits__
+
+Fit the simulated 1D Gaussian datasets to produce the posteriors used to train the aggregator agent.
+
+Fits are made with one of two prior configurations: "good", whose priors contain the true parameters, and "bad", whose
+centre prior deliberately excludes them so that the fits are poor. Each fit uses a single core, so fits are spread
+over a process pool with one dataset per task and the labelled corpus is produced using every core.
+
+A summary of each fit, including its wall time and the number of likelihood evaluations the search reports making, is
+written next to its results. Fits with a summary are skipped, so an interrupted run can be restarted without refitting datasets.
+
+Usage:
+
+    python -m posterior.fit good --workers 8
+    python -m posterior.fit bad --total-datasets 1000
+    python posterior/fit.py good
+"""
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import path
+
+if __package__ in (None, ""):
+    # Run as a script, e.g. `python posterior/fit.py`, so make the posterior package importable
+    sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from posterior.dataset import DEFAULT_DATASETS_PATH, load_dataset, load_datasets  # noqa: E402
+
+DEFAULT_OUTPUT_PATH = "output"
+SUMMARY_FILENAME = "fit_summary.json"
+
+# The uniform priors, as (lower_limit, upper_limit), and the search settings of each configuration
+PRIOR_CONFIGS = {
+    "good": {
+        "priors": {
+            "centre": (0.0, 100.0),
+            "normalization": (0.0, 1e2),
+            "sigma": (0.0, 30.0),
+        },
+        "nlive": 50,
+    },
+    "bad": {
+        "priors": {
+            # Ruins the fit, as every true centre is between 40 and 60
+            "centre": (0.0, 35.0),
+            "normalization": (0.0, 1e2),
+            "sigma": (0.0, 30.0),
+        },
+        "nlive": 50,
+    },
+}
+
+
+def summary_path(config: str, index: int, output_path: str = DEFAULT_OUTPUT_PATH) -> str:
+    """
+    Where the summary of the fit of a dataset with a configuration is written.
+    """
+    return path.join(output_path, f"fit_{config}", f"dataset_{index}_fit", SUMMARY_FILENAME)
+
+
+def fit_dataset(
+        config: str,
+        index: int,
+        datasets_path: str = DEFAULT_DATASETS_PATH,
+        output_path: str = DEFAULT_OUTPUT_PATH,
+) -> dict:
+    """
+    Fit a dataset with a prior configuration, writing and returning a summary of the fit.
+
+    The summary holds the dataset's index and true parameters, the configuration, the wall time of the fit, the number
+    of likelihood evaluations and the maximum log likelihood found.
+    """
+    # autofit is slow to import, so it is only imported by the processes which fit
+    import autofit as af
+
+    from posterior.analysis import Analysis, likelihood_evaluations
+
+    data, noise_map, true_parameters = load_dataset(index=index, datasets_path=datasets_path)
+
+    model = af.Model(af.ex.Gaussian)
+    for name, (lower_limit, upper_limit) in PRIOR_CONFIGS[config]["priors"].items():
+        setattr(model, name, af.UniformPrior(lower_limit=lower_limit, upper_limit=upper_limit))
+
+    analysis = Analysis(data=data, noise_map=noise_map)
+
+    search = af.DynestyStatic(
+        nlive=PRIOR_CONFIGS[config]["nlive"],
+        path_prefix=f"fit_{config}",
+        name=f"dataset_{index}_fit",
+        number_of_cores=1,
+    )
+
+    start = time.perf_counter()
+    result = search.fit(model=model, analysis=analysis)
+    summary = {
+        "index": index,
+        "config": config,
+        "true_parameters": true_parameters,
+        "wall_time": time.perf_counter() - start,
+        "likelihood_evaluations": likelihood_evaluations(result, analysis),
+        "max_log_likelihood": float(result.samples.max_log_likelihood_sample.log_likelihood),
+    }
+
+    file_path = summary_path(config, index, output_path)
+    os.makedirs(path.dirname(file_path), exist_ok=True)
+    with open(f"{file_path}.tmp", "w") as f:
+        json.dump(summary, f, indent=4)
+    os.replace(f"{file_path}.tmp", file_path)
+    return summary
+
+
+def fit_datasets(
+        config: str,
+        indices: range,
+        datasets_path: str = DEFAULT_DATASETS_PATH,
+        output_path: str = DEFAULT_OUTPUT_PATH,
+        workers: int | None = None,
+) -> list[dict]:
+    """
+    Fit datasets with a prior configuration in a process pool, skipping those already fitted, and return the summary
+    of each fit made.
+
+    A dataset whose fit fails is reported and the others carry on.
+
+    Parameters
+    ----------
+    config
+        The name of the configuration in PRIOR_CONFIGS
+    indices
+        The datasets fitted
+    datasets_path
+        The datasets file written by `simulator.py`
+    output_path
+        The directory summaries are written beneath. The search writes its results under autofit's output path.
+    workers
+        Processes fitting, by default one per CPU
+    """
+    remaining = [index for index in indices if not path.exists(summary_path(config, index, output_path))]
+    print(f"Fitting {len(remaining)} datasets with the {config} priors, {len(indices) - len(remaining)} already fitted")
+
+    summaries = []
+    with ProcessPoolExecutor(workers or os.cpu_count() or 1) as pool:
+        futures = {
+            pool.submit(fit_dataset, config, index, datasets_path, output_path): index
+            for index in remaining
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                print(f"Failed to fit dataset {index}: {e!r}")
+                continue
+            summaries.append(summary)
+            print(
+                f"Fitted dataset {index} in {summary['wall_time']:.1f}s with "
+                f"{summary['likelihood_evaluations']} likelihood evaluations ({len(summaries)}/{len(remaining)})"
+            )
+    return summaries
+
+
+def main(argv: list[str] | None = None):
+    parser = ArgumentParser("Fit the simulated datasets with good or bad priors, in parallel")
+    parser.add_argument("config", choices=list(PRIOR_CONFIGS))
+    parser.add_argument(
+        "--datasets",
+        default=DEFAULT_DATASETS_PATH,
+        help=f"The datasets file written by simulator.py (default: {DEFAULT_DATASETS_PATH})",
+    )
+    parser.add_argument(
+        "--total-datasets",
+        type=int,
+        default=None,
+        help="Fit only the first this many datasets (default: all)",
+    )
+    parser.add_argument(
+        "--output",
+        default=DEFAULT_OUTPUT_PATH,
+        help=f"Directory fit summaries are written beneath (default: {DEFAULT_OUTPUT_PATH})",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Processes fitting (default: one per CPU)")
+
+    args = parser.parse_args(argv)
+
+    total = len(load_datasets(args.datasets))
+    if args.total_datasets is not None:
+        total = min(total, args.total_datasets)
+
+    start = time.perf_counter()
+    summaries = fit_datasets(args.config, range(total), args.datasets, args.output, args.workers)
+    elapsed = time.perf_counter() - start
+
+    fit_time = sum(summary["wall_time"] for summary in summaries)
+    evaluations = sum(summary["likelihood_evaluations"] for summary in summaries)
+    print(
+        f"Fitted {len(summaries)} datasets in {elapsed:.1f}s, {fit_time:.1f}s of fitting "
+        f"({fit_time / elapsed if elapsed else 0.0:.1f}x parallel speedup), {evaluations} likelihood evaluations"
+    )
+
+
+if __name__ == "__main__":
+    main()
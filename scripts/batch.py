@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Categorise or segment a directory of images through the OpenAI Batch API.
+
+Batches can take up to 24 hours. If the script is interrupted, run it again with the same work directory to resume
+polling the batches already submitted.
+"""
+import csv
+from argparse import ArgumentParser
+from pathlib import Path
+
+from aggregator_agent.cache import add_cache_arguments, cache_from_arguments
+from aggregator_agent.manifest import add_manifest_arguments, find_images, manifest_from_arguments
+from aggregator_agent.preprocessing import add_preprocessing_arguments, preprocessing_from_arguments
+
+
+def main():
+    parser = ArgumentParser("Submit images to the OpenAI Batch API")
+    parser.add_argument(
+        "--base-url",
+        default=None,
+        help="Send requests to another OpenAI compatible server, e.g. a local fake batch endpoint",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between checks on the status of a batch",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    categorise_parser = subparsers.add_parser("categorise", help="Categorise each image in a directory")
+    categorise_parser.add_argument("directory", type=Path)
+    categorise_parser.add_argument("--output", type=Path, default=None)
+    categorise_parser.add_argument(
+        "--work-directory",
+        type=Path,
+        default=None,
+        help="Directory for batch input files and submitted batch IDs",
+    )
+    add_cache_arguments(categorise_parser)
+    add_preprocessing_arguments(categorise_parser)
+    add_manifest_arguments(categorise_parser)
+
+    segment_parser = subparsers.add_parser("segment", help="Segment rgb_zoom.png in each subdirectory of a directory")
+    segment_parser.add_argument("directory", type=Path)
+    segment_parser.add_argument(
+        "--work-directory",
+        type=Path,
+        default=None,
+        help="Directory for batch input files and submitted batch IDs",
+    )
+
+    args = parser.parse_args()
+
+    # Slow to import, so only once the arguments are known to be valid
+    from openai import OpenAI
+
+    from aggregator_agent.batch_api import categorise_via_batch, segment_via_batch
+
+    client = OpenAI(base_url=args.base_url)
+    work_directory = args.work_directory or args.directory.with_name(f"{args.directory.stem}_{args.command}_batch")
+
+    if args.command == "categorise":
+        output_filename = args.output or args.directory.with_name(f"{args.directory.stem}_categorised.csv")
+        cache = cache_from_arguments(args)
+        manifest = manifest_from_arguments(args)
+        image_paths = find_images(args.directory, manifest, args.pattern, args.recursive)
+        if manifest is not None:
+            manifest.close()
+        results = categorise_via_batch(
+            image_paths,
+            work_directory,
+            client=client,
+            cache=cache,
+            preprocessing=preprocessing_from_arguments(args),
+            poll_interval=args.poll_interval,
+        )
+        errors_filename = output_filename.with_name(f"{output_filename.stem}_errors.csv")
+        with output_filename.open("w", newline="") as f, errors_filename.open("w", newline="") as errors_file:
+            writer = csv.writer(f)
+            writer.writerow(["id", "category", "description"])
+            errors_writer = csv.writer(errors_file)
+            errors_writer.writerow(["id", "error"])
+            for image_id, result in results:
+                if isinstance(result, Exception):
+                    print(f"Error categorising {image_id}: {result!r}")
+                    errors_writer.writerow([image_id, repr(result)])
+                else:
+                    writer.writerow([image_id, result.category, result.description])
+        if cache is not None:
+            print(cache.summary())
+            cache.close()
+    else:
+        image_paths = [path / "rgb_zoom.png" for path in sorted(args.directory.iterdir()) if path.is_dir()]
+        for image_id, result in segment_via_batch(
+                image_paths,
+                work_directory,
+                client=client,
+                poll_interval=args.poll_interval,
+        ):
+            if isinstance(result, Exception):
+                print(f"Error segmenting {image_id}: {result!r}")
+
+
+if __name__ == "__main__":
+    main()
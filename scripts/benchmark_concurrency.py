@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Measure how categorisation throughput scales with concurrency using a local stand-in model with injected latency.
+"""
+import asyncio
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+directory = Path(__file__).parents[1]
+example_image = directory / "images" / "102160611_2740328687682808789.png"
+
+
+async def run(count: int, concurrency: int, latency: float) -> float:
+    """
+    Categorise the example image `count` times and return the number of images categorised per second.
+    """
+    from aggregator_agent.image_agent import categorise_many
+    from aggregator_agent.stub_model import stub_model
+
+    model = stub_model(latency=latency)
+    start = time.perf_counter()
+    async for _ in categorise_many([example_image] * count, concurrency=concurrency, model=model):
+        pass
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = ArgumentParser("Measure categorisation throughput against a stub model")
+
+    parser.add_argument("--count", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds each stub request takes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+
+    args = parser.parse_args()
+
+    baseline = None
+    for concurrency in args.concurrency:
+        throughput = asyncio.run(run(args.count, concurrency, args.latency))
+        baseline = baseline or throughput
+        print(
+            f"concurrency={concurrency:>4} throughput={throughput:8.2f} images/s speedup={throughput / baseline:6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
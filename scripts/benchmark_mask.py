@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Compare the per-pixel loop previously used to make mask backgrounds transparent with the channel based transform in
+segmentation.make_translucent, on a synthetic mask.
+"""
+import random
+import time
+from argparse import ArgumentParser
+
+from PIL import Image, ImageDraw
+
+from aggregator_agent.segmentation import TARGET_SIZE, TRANSLUCENT_ALPHA, make_translucent
+
+
+def make_translucent_loop(mask: Image.Image) -> Image.Image:
+    """
+    The original implementation, looping over every pixel in Python.
+    """
+    image = mask.convert("RGBA")
+    pixels = []
+    for r, g, b, _ in image.getdata():
+        if r == 0 and g == 0 and b == 0:
+            pixels.append((r, g, b, 0))
+        else:
+            pixels.append((r, g, b, TRANSLUCENT_ALPHA))
+    image.putdata(pixels)
+    return image
+
+
+def synthetic_mask() -> Image.Image:
+    """
+    A black mask with red, green and blue blobs, similar to those generated by the model.
+    """
+    mask = Image.new("RGB", TARGET_SIZE)
+    draw = ImageDraw.Draw(mask)
+    rng = random.Random(0)
+    for colour in [(255, 0, 0), (0, 255, 0), (0, 0, 255)] * 5:
+        x, y = rng.randrange(TARGET_SIZE[0]), rng.randrange(TARGET_SIZE[1])
+        radius = rng.randrange(20, 200)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=colour)
+    return mask
+
+
+def best_time(function, mask: Image.Image, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(mask)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = ArgumentParser("Benchmark making mask backgrounds transparent")
+    parser.add_argument("--repeats", type=int, default=5)
+
+    args = parser.parse_args()
+
+    mask = synthetic_mask()
+    if make_translucent_loop(mask).tobytes() != make_translucent(mask).tobytes():
+        raise SystemExit("Outputs differ")
+
+    loop = best_time(make_translucent_loop, mask, args.repeats)
+    channels = best_time(make_translucent, mask, args.repeats)
+    print(f"{TARGET_SIZE[0]}x{TARGET_SIZE[1]} mask")
+    print(f"loop:     {loop * 1000:8.2f} ms")
+    print(f"channels: {channels * 1000:8.2f} ms")
+    print(f"speedup:  {loop / channels:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
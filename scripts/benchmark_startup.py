@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Measure how long each script and package module takes to start, so imports which slow down short-lived invocations are
+caught.
+
+Every entry point is run in a fresh interpreter without OpenAI credentials: scripts with --help, so nothing is sent, and
+modules by importing them. The fastest of several runs is reported along with the import time `python -X importtime`
+attributes to packages which are slow to import and only needed once a request is made. Save the timings with
+`--output` and compare against them later with `--baseline`. The exit status is non-zero if any entry point fails, is
+more than `--tolerance` slower than its baseline, or imports a slow package it did not import in the baseline.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+directory = Path(__file__).resolve().parents[1]
+scripts_directory = directory / "scripts"
+package_directory = directory / "aggregator_agent"
+
+# Packages which should only be imported once a request is made
+SLOW_PACKAGES = ("pydantic_ai", "openai", "matplotlib")
+# Modules which do their work when imported, so are not measured
+SCRIPT_MODULES = ("generate_zoomed",)
+
+
+def entry_points() -> dict[str, list[str]]:
+    """
+    The arguments, after the interpreter, which start each script and import each module.
+    """
+    commands = {
+        path.name: [str(path), "--help"]
+        for path in sorted(scripts_directory.glob("*.py"))
+        if path.name != Path(__file__).name
+    }
+    for path in sorted(package_directory.glob("*.py")):
+        if path.stem in SCRIPT_MODULES:
+            continue
+        module = "aggregator_agent" if path.stem == "__init__" else f"aggregator_agent.{path.stem}"
+        commands[module] = ["-c", f"import {module}"]
+    return commands
+
+
+def parse_import_times(stderr: str) -> tuple[float, dict[str, float]]:
+    """
+    The total import time in seconds, and the cumulative import time of each slow package imported, from the output of
+    `python -X importtime`.
+    """
+    total = 0.0
+    slow = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        seconds = int(cumulative) / 1_000_000
+        if not name.startswith("  "):
+            total += seconds
+        if (package := name.strip()) in SLOW_PACKAGES:
+            slow[package] = seconds
+    return total, slow
+
+
+def measure(arguments: list[str], repeats: int) -> dict:
+    """
+    Run an entry point several times, returning the fastest wall and import times and the slow packages it imported.
+    """
+    environment = {key: value for key, value in os.environ.items() if key != "OPENAI_API_KEY"}
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [str(directory), environment.get("PYTHONPATH")]))
+
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", *arguments],
+            env=environment,
+            capture_output=True,
+            text=True,
+        )
+        seconds = time.perf_counter() - start
+        if process.returncode != 0:
+            error = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "no output"
+            return {"seconds": seconds, "import_seconds": 0.0, "slow_imports": {}, "error": error}
+        import_seconds, slow_imports = parse_import_times(process.stderr)
+        if best is None or seconds < best["seconds"]:
+            best = {"seconds": seconds, "import_seconds": import_seconds, "slow_imports": slow_imports, "error": None}
+    return best
+
+
+def regressions(name: str, result: dict, baseline: dict, tolerance: float, slack: float) -> list[str]:
+    """
+    How an entry point has regressed against its baseline, if it has.
+    """
+    found = []
+    if result["seconds"] > baseline["seconds"] * (1 + tolerance) + slack:
+        found.append(f"{name} took {result['seconds']:.3f}s, baseline {baseline['seconds']:.3f}s")
+    for package in sorted(result["slow_imports"].keys() - baseline["slow_imports"].keys()):
+        found.append(f"{name} now imports {package} at startup")
+    return found
+
+
+def main():
+    parser = ArgumentParser("Measure the startup time of each script and module")
+    parser.add_argument(
+        "entry_points",
+        nargs="*",
+        help="Script filenames or module names to measure (default: all)",
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of each entry point, of which the fastest is kept")
+    parser.add_argument("--output", type=Path, default=None, help="Save the timings as JSON, e.g. as a baseline")
+    parser.add_argument("--baseline", type=Path, default=None, help="Timings saved by --output to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction by which an entry point may be slower than its baseline",
+    )
+    parser.add_argument(
+        "--slack",
+        type=float,
+        default=0.05,
+        help="Seconds by which an entry point may be slower than its baseline on top of the tolerance, to absorb noise",
+    )
+
+    args = parser.parse_args()
+
+    commands = entry_points()
+    unknown = set(args.entry_points) - commands.keys()
+    if unknown:
+        parser.error(f"Unknown entry points: {', '.join(sorted(unknown))}")
+    names = args.entry_points or list(commands)
+    baseline = json.loads(args.baseline.read_text()) if args.baseline is not None else {}
+
+    results = {}
+    failures = []
+    width = max(map(len, names))
+    print(f"{'entry point':<{width}}  {'wall':>7}  {'imports':>7}  slow packages imported")
+    for name in names:
+        result = results[name] = measure(commands[name], args.repeats)
+        if result["error"] is not None:
+            failures.append(f"{name} failed: {result['error']}")
+        elif name in baseline and baseline[name]["error"] is None:
+            failures.extend(regressions(name, result, baseline[name], args.tolerance, args.slack))
+        slow = ", ".join(f"{package} {seconds:.3f}s" for package, seconds in result["slow_imports"].items())
+        print(f"{name:<{width}}  {result['seconds']:>6.3f}s  {result['import_seconds']:>6.3f}s  {slow or '-'}")
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+        print(f"Saved timings to {args.output}")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Categorise and segment images in priority order within a monthly budget.
+
+Submit images with a priority, e.g. giving candidate lenses flagged upstream a higher one, then `run` as often as
+needed. Each run starts the highest priority jobs first and stops starting jobs once the budget would be exceeded.
+Jobs left over stay in the backlog for the next run.
+"""
+import asyncio
+import csv
+from argparse import ArgumentParser
+from functools import partial
+from pathlib import Path
+
+from aggregator_agent.budget import CATEGORISE, OPERATIONS, SEGMENT, BudgetScheduler, Job, current_period
+from aggregator_agent.cache import add_cache_arguments, cache_from_arguments
+from aggregator_agent.preprocessing import add_preprocessing_arguments, preprocessing_from_arguments
+from aggregator_agent.rate_limit import add_rate_limit_arguments, rate_limiter_from_arguments
+from aggregator_agent.segmentation import process_image
+from aggregator_agent.telemetry import add_call_log_arguments, call_log_from_arguments
+
+
+def read_priorities(path: Path) -> dict[str, float]:
+    """
+    Priorities by image ID from a CSV with id and priority columns.
+    """
+    with path.open(newline="") as f:
+        return {row["id"]: float(row["priority"]) for row in csv.DictReader(f)}
+
+
+def find_jobs(operation: str, directory: Path, priority: float, priorities: dict[str, float]) -> list[Job]:
+    """
+    A job for every image in the directory, or for segmentation every rgb_zoom.png in its subdirectories.
+    """
+    if operation == SEGMENT:
+        paths = [path / "rgb_zoom.png" for path in sorted(directory.iterdir()) if path.is_dir()]
+    else:
+        paths = sorted(path for path in directory.iterdir() if path.is_file())
+    jobs = [Job(operation=operation, path=path) for path in paths]
+    for job in jobs:
+        job.priority = priorities.get(job.image_id, priority)
+    return jobs
+
+
+async def run(scheduler: BudgetScheduler, handlers: dict, output: Path):
+    """
+    Run jobs from the backlog, appending categorisations to the output CSV as they complete.
+    """
+    with output.open("a", newline="") as f:
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(["id", "category", "description", "priority"])
+        async for job, result in scheduler.run(handlers):
+            if isinstance(result, Exception):
+                print(f"Error running {job.operation} for {job.path}: {result!r}")
+            elif job.operation == CATEGORISE:
+                writer.writerow([job.image_id, result.category, result.description, job.priority])
+                f.flush()
+
+
+def main():
+    parser = ArgumentParser("Categorise and segment images in priority order within a monthly budget")
+    parser.add_argument("ledger", type=Path, help="SQLite file holding the backlog and the record of spending")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="Add images to the backlog")
+    submit_parser.add_argument("operation", choices=OPERATIONS)
+    submit_parser.add_argument(
+        "directory",
+        type=Path,
+        help="Images to categorise, or for segmentation a directory of subdirectories containing rgb_zoom.png",
+    )
+    submit_parser.add_argument(
+        "--priority",
+        type=float,
+        default=0.0,
+        help="Priority of images not given one by --priorities. Higher priorities run first.",
+    )
+    submit_parser.add_argument(
+        "--priorities",
+        type=Path,
+        default=None,
+        help="CSV with id and priority columns, e.g. candidate lenses flagged upstream",
+    )
+
+    run_parser = subparsers.add_parser("run", help="Run jobs in priority order until the backlog or budget runs out")
+    run_parser.add_argument(
+        "--limit",
+        type=float,
+        required=True,
+        help="The most to spend this month in US dollars, including previous runs",
+    )
+    run_parser.add_argument(
+        "--soft-limit",
+        type=float,
+        default=None,
+        help="Past this spend only jobs with at least --soft-priority start",
+    )
+    run_parser.add_argument(
+        "--soft-priority",
+        type=float,
+        default=1.0,
+        help="Priority needed to start a job once spending is past the soft limit",
+    )
+    run_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of jobs running at once",
+    )
+    run_parser.add_argument(
+        "--output",
+        type=Path,
+        default=Path("budget_categorised.csv"),
+        help="CSV to which categorisations are appended. Masks are saved next to each image.",
+    )
+    run_parser.add_argument(
+        "--black-tolerance",
+        type=int,
+        default=0,
+        help="Mask pixels within this tolerance of black are made transparent",
+    )
+    add_cache_arguments(run_parser)
+    add_preprocessing_arguments(run_parser)
+    add_rate_limit_arguments(run_parser)
+    add_call_log_arguments(run_parser)
+
+    subparsers.add_parser("status", help="Print spending this month and the backlog")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        # pydantic-ai is slow to import and only needed to run jobs
+        from aggregator_agent.image_agent import _model_name, categorise_async, get_agent
+        from aggregator_agent.rate_limited_model import RateLimitedModel
+
+        scheduler = BudgetScheduler(
+            args.ledger,
+            limit=args.limit,
+            soft_limit=args.soft_limit,
+            soft_priority=args.soft_priority,
+            concurrency=args.concurrency,
+            model=_model_name(None),
+        )
+    else:
+        scheduler = BudgetScheduler(args.ledger, limit=float("inf"))
+
+    with scheduler:
+        if args.command == "submit":
+            priorities = read_priorities(args.priorities) if args.priorities is not None else {}
+            added = scheduler.submit(find_jobs(args.operation, args.directory, args.priority, priorities))
+            print(f"Added {added} jobs to {args.ledger}")
+        elif args.command == "run":
+            cache = cache_from_arguments(args)
+            limiter = rate_limiter_from_arguments(args, max_concurrency=args.concurrency)
+            call_log = call_log_from_arguments(args)
+            handlers = {
+                CATEGORISE: partial(
+                    categorise_async,
+                    model=RateLimitedModel(get_agent().model, limiter),
+                    cache=cache,
+                    preprocessing=preprocessing_from_arguments(args),
+                    call_log=call_log,
+                ),
+                SEGMENT: lambda path: asyncio.to_thread(
+                    process_image,
+                    path,
+                    black_tolerance=args.black_tolerance,
+                    limiter=limiter,
+                    call_log=call_log,
+                ),
+            }
+            asyncio.run(run(scheduler, handlers, args.output))
+            print(scheduler.summary())
+            print(limiter.summary())
+            if call_log is not None:
+                call_log.close()
+            if cache is not None:
+                print(cache.summary())
+                cache.close()
+        elif args.command == "status":
+            backlog = scheduler.backlog()
+            print(f"${scheduler.spent():.2f} spent in {current_period()}, {len(backlog)} jobs in the backlog")
+            for operation in OPERATIONS:
+                jobs = [job for job in backlog if job.operation == operation]
+                if jobs:
+                    print(f"{operation}: {len(jobs)} jobs, priorities {jobs[-1].priority:g} to {jobs[0].priority:g}")
+
+
+if __name__ == "__main__":
+    main()
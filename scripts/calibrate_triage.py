@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Calibrate local triage thresholds against the ground truth in image_analysis.csv.
+
+Only labelled images are used unless --assume-good is given, when images in data/initial_lens_model which are not in
+image_analysis.csv are counted as Good. The thresholds are fitted to every image and written as JSON for use with
+`predict_directory.py --triage`. How many VLM calls triage would avoid and how accurate it is are measured by k-fold
+cross validation, deciding each image with thresholds calibrated without it. If a results CSV from performance_test.py
+is given, held out triage accuracy is compared to the VLM on the same images.
+"""
+import csv
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from aggregator_agent.schema import Category
+from aggregator_agent.triage import ResidualStatistics, calibrate, cross_validate
+
+directory = Path(__file__).parents[1]
+data_directory = directory / "data"
+initial_lens_model_directory = data_directory / "initial_lens_model"
+
+
+def load_ground_truth(assume_good: bool = False) -> dict[str, Category]:
+    """
+    The category of every labelled image, keyed by ID, and of every unlabelled image as Good if `assume_good`.
+    """
+    with open(directory / "image_analysis.csv") as f:
+        categories = {row["id"]: Category(row["category"]) for row in csv.DictReader(f)}
+    if assume_good:
+        for path in initial_lens_model_directory.iterdir():
+            categories.setdefault(path.stem, Category.Good)
+    return categories
+
+
+def statistics_for(image_id: str) -> ResidualStatistics | None:
+    try:
+        return ResidualStatistics.from_path((initial_lens_model_directory / image_id).with_suffix(".png"))
+    except (ValueError, OSError):
+        return None
+
+
+def main():
+    parser = ArgumentParser("Calibrate local triage thresholds against ground truth")
+    parser.add_argument("--output", type=Path, default=directory / "triage.json")
+    parser.add_argument(
+        "--target-precision",
+        type=float,
+        default=0.95,
+        help="Fraction of triaged decisions which must be correct on the ground truth",
+    )
+    parser.add_argument(
+        "--min-support",
+        type=int,
+        default=3,
+        help="Minimum number of labelled images a decision must apply to",
+    )
+    parser.add_argument(
+        "--folds",
+        type=int,
+        default=5,
+        help="Folds of cross validation used to measure triage on images it was not calibrated on",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Seeds the assignment of images to folds")
+    parser.add_argument(
+        "--assume-good",
+        action="store_true",
+        help="Also calibrate on images in data/initial_lens_model which are not in image_analysis.csv, counting "
+             "them as Good",
+    )
+    parser.add_argument(
+        "--results",
+        type=Path,
+        default=None,
+        help="A results CSV from performance_test.py to compare triage against",
+    )
+
+    args = parser.parse_args()
+
+    categories = load_ground_truth(args.assume_good)
+    with ProcessPoolExecutor() as pool:
+        statistics = dict(zip(categories, pool.map(statistics_for, categories, chunksize=16)))
+
+    usable = [image_id for image_id, statistic in statistics.items() if statistic is not None]
+    print(f"Computed statistics for {len(usable)} of {len(categories)} images")
+
+    thresholds = calibrate(
+        [statistics[image_id] for image_id in usable],
+        [categories[image_id] for image_id in usable],
+        target_precision=args.target_precision,
+        min_support=args.min_support,
+    )
+    args.output.write_text(thresholds.model_dump_json(indent=4))
+    print(f"Saved thresholds to {args.output}")
+
+    held_out = cross_validate(
+        [statistics[image_id] for image_id in usable],
+        [categories[image_id] for image_id in usable],
+        folds=args.folds,
+        target_precision=args.target_precision,
+        min_support=args.min_support,
+        seed=args.seed,
+    )
+    decisions = {image_id: category for image_id, category in zip(usable, held_out) if category is not None}
+    correct = sum(category == categories[image_id] for image_id, category in decisions.items())
+    print(
+        f"Held out over {args.folds} folds, triage decides {len(decisions)} of {len(categories)} images "
+        f"({len(decisions) / len(categories):.0%} of calls avoided)"
+    )
+    if decisions:
+        print(f"Held out triage accuracy on decided images: {correct}/{len(decisions)} ({correct / len(decisions):.1%})")
+
+    if args.results is not None:
+        with args.results.open(newline="") as f:
+            predicted = {row["id"]: row["predicted_category"] for row in csv.DictReader(f)}
+        compared = [image_id for image_id in decisions if image_id in predicted]
+        if compared:
+            llm_correct = sum(predicted[image_id] == categories[image_id] for image_id in compared)
+            triage_correct = sum(decisions[image_id] == categories[image_id] for image_id in compared)
+            print(
+                f"On {len(compared)} triaged images also in {args.results}, held out: "
+                f"triage {triage_correct / len(compared):.1%}, VLM {llm_correct / len(compared):.1%}"
+            )
+        else:
+            print(f"No triaged images appear in {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Summarise a call log written with --call-log: latency percentiles, throughput, tokens and cost.
+"""
+from argparse import ArgumentParser
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from aggregator_agent.telemetry import DEFAULT_CALL_LOG_PATH, CallRecord, read_call_log
+
+
+def summarise_calls(records: list[CallRecord]) -> list[str]:
+    """
+    One line per operation and model. Latency percentiles exclude cache hits, which send nothing.
+    """
+    groups = defaultdict(list)
+    for record in records:
+        groups[record.operation, record.model].append(record)
+
+    lines = [
+        f"{'operation':<17} {'model':<12} {'calls':>6} {'cached':>6} {'errors':>6} {'retries':>7} "
+        f"{'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8} {'ttfb (s)':>8} {'queue (s)':>9} "
+        f"{'images/s':>8} {'in tokens':>10} {'out tokens':>10} {'cost ($)':>9}"
+    ]
+    for (operation, model), group in sorted(groups.items()):
+        sent = [record for record in group if not record.cache_hit]
+        latencies = np.array([record.latency for record in sent]) if sent else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        first_bytes = [record.time_to_first_byte for record in sent if record.time_to_first_byte is not None]
+        ttfb = np.mean(first_bytes) if first_bytes else float("nan")
+        queue_wait = np.mean([record.queue_wait for record in sent]) if sent else 0.0
+
+        span = max(record.started_at + record.latency for record in group) - min(record.started_at for record in group)
+        images = sum(len(record.image_ids) for record in group)
+        throughput = images / span if span > 0 else float("nan")
+
+        lines.append(
+            f"{operation:<17} {model:<12} {len(group):>6} {len(group) - len(sent):>6} "
+            f"{sum(record.error is not None for record in group):>6} {sum(record.retries for record in group):>7} "
+            f"{p50:>8.2f} {p95:>8.2f} {p99:>8.2f} {ttfb:>8.2f} {queue_wait:>9.2f} {throughput:>8.2f} "
+            f"{sum(record.input_tokens for record in group):>10} {sum(record.output_tokens for record in group):>10} "
+            f"{sum(record.cost for record in group):>9.4f}"
+        )
+    return lines
+
+
+def summarise_categories(records: list[CallRecord]) -> list[str]:
+    """
+    One line per category with the cost of categorising its images. The cost of a call is shared equally between
+    the images in it.
+    """
+    images = defaultdict(int)
+    costs = defaultdict(float)
+    for record in records:
+        for category in record.categories:
+            images[category] += 1
+            costs[category] += record.cost / len(record.categories)
+
+    lines = [f"{'category':<20} {'images':>7} {'cost ($)':>9} {'per image ($)':>13}"]
+    for category in sorted(images):
+        lines.append(
+            f"{category:<20} {images[category]:>7} {costs[category]:>9.4f} {costs[category] / images[category]:>13.5f}"
+        )
+    return lines
+
+
+def main():
+    parser = ArgumentParser("Summarise per-call telemetry")
+    parser.add_argument("call_log", type=Path, nargs="?", default=DEFAULT_CALL_LOG_PATH)
+
+    args = parser.parse_args()
+
+    records = read_call_log(args.call_log)
+    print(f"{len(records)} calls in {args.call_log}")
+    print("\n".join(summarise_calls(records)))
+    print()
+    print("\n".join(summarise_categories(records)))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,6 @@
 from pathlib import Path
 from argparse import ArgumentParser
 
-from aggregator_agent.image_agent import categorise
-
 directory = Path(__file__).parents[1]
 data_directory = directory / "data"
 initial_lens_model_directory = data_directory / "initial_lens_model"
@@ -15,4 +13,7 @@ parser.add_argument("id")
 
 args = parser.parse_args()
 
+# Imported once the arguments are parsed so --help is quick
+from aggregator_agent.image_agent import categorise
+
 print(categorise((initial_lens_model_directory / args.id).with_suffix(".png")))
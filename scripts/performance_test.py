@@ -1,16 +1,148 @@
+import asyncio
 import csv
+import itertools
+import math
 import random
+import time
+from argparse import ArgumentParser
 from pathlib import Path
 from csv import DictReader
 import datetime as dt
 
-from aggregator_agent.image_agent import categorise
+from aggregator_agent.cache import add_cache_arguments, cache_from_arguments
+from aggregator_agent.cascade import CascadeOutcome, add_cascade_arguments, cascade_from_arguments
+from aggregator_agent.evaluation import PairedComparison, SequentialEvaluation, stratified
+from aggregator_agent.manifest import add_manifest_arguments, find_images, manifest_from_arguments
+from aggregator_agent.preprocessing import add_preprocessing_arguments, preprocess_file, preprocessing_from_arguments
+from aggregator_agent.rate_limit import add_rate_limit_arguments, rate_limiter_from_arguments
+from aggregator_agent.results import (
+    CallAttribution,
+    ResultRecord,
+    add_store_arguments,
+    default_run_name,
+    store_from_arguments,
+)
+from aggregator_agent.telemetry import CallRecord, add_call_log_arguments, call_log_from_arguments, collect_records
 from aggregator_agent.schema import LensFitAnalysis, Category
+from aggregator_agent.triage import Triage
+from aggregator_agent.voting import VoteOutcome, add_voting_arguments, voting_from_arguments
 
 directory = Path(__file__).parents[1]
 data_directory = directory / "data"
 initial_lens_model_directory = data_directory / "initial_lens_model"
 
+parser = ArgumentParser("Compare predicted categories against the ground truth in image_analysis.csv")
+add_cache_arguments(parser)
+add_preprocessing_arguments(parser)
+add_cascade_arguments(parser)
+add_voting_arguments(parser)
+add_rate_limit_arguments(parser)
+add_call_log_arguments(parser)
+add_manifest_arguments(parser, listing=False)
+add_store_arguments(parser)
+parser.add_argument(
+    "--group-size",
+    type=int,
+    nargs="+",
+    default=[1],
+    help="Number of images sent together in each request. Give several values to compare them.",
+)
+parser.add_argument(
+    "--triage",
+    type=Path,
+    default=None,
+    help="Thresholds written by calibrate_triage.py. Images they decide are not sent to the VLM.",
+)
+parser.add_argument(
+    "--sequential",
+    action="store_true",
+    help="Sample ground truth stratified by category and stop once the results are conclusive",
+)
+parser.add_argument(
+    "--max-width",
+    type=float,
+    default=0.3,
+    help="With --sequential, stop once every per-class accuracy and confusion interval is at most this wide",
+)
+parser.add_argument(
+    "--min-per-class",
+    type=int,
+    default=5,
+    help="With --sequential, the fewest images of each category evaluated before stopping",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=8,
+    help="With --sequential, the number of images categorised concurrently between checks",
+)
+parser.add_argument(
+    "--compare-model",
+    default=None,
+    help="With --sequential, also categorise each image with this model and stop once the two differ significantly",
+)
+parser.add_argument(
+    "--compare-prompt",
+    type=Path,
+    default=None,
+    help="With --sequential, also categorise each image with the instructions in this file and stop once the two "
+         "differ significantly. Combine with --compare-model to change both.",
+)
+parser.add_argument(
+    "--alpha",
+    type=float,
+    default=0.05,
+    help="Significance level for --compare-model",
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=None,
+    help="Seed for the order in which --sequential samples images",
+)
+
+args = parser.parse_args()
+
+if args.sequential:
+    unsupported = [
+        option
+        for option, given in [
+            ("--group-size", args.group_size != [1]),
+            ("--triage", args.triage is not None),
+            ("--cascade", args.cascade),
+            ("--votes", args.votes > 1),
+            ("--store", args.store is not None),
+        ]
+        if given
+    ]
+    if unsupported:
+        parser.error(f"{', '.join(unsupported)} cannot be combined with --sequential")
+elif args.compare_model is not None or args.compare_prompt is not None:
+    parser.error("--compare-model and --compare-prompt require --sequential")
+
+# pydantic-ai is slow to import, so it is left until the arguments are parsed
+from aggregator_agent.image_agent import (
+    SYSTEM_PROMPT,
+    categorise_async,
+    categorise_cascade,
+    categorise_group,
+    categorise_vote,
+    get_agent,
+)
+from aggregator_agent.rate_limited_model import RateLimitedModel
+
+cache = cache_from_arguments(args)
+preprocessing = preprocessing_from_arguments(args)
+triage = Triage.from_path(args.triage) if args.triage is not None else None
+limiter = rate_limiter_from_arguments(args)
+call_log = call_log_from_arguments(args)
+store = store_from_arguments(args)
+model = RateLimitedModel(get_agent().model, limiter)
+voting = voting_from_arguments(args)
+cascade = cascade_from_arguments(args)
+if cascade is not None:
+    cascade.small_model = RateLimitedModel(cascade.small_model, limiter)
+
 
 class GroundTruth(LensFitAnalysis):
     """
@@ -27,22 +159,29 @@ class GroundTruth(LensFitAnalysis):
         return (initial_lens_model_directory / self.id).with_suffix(".png")
 
 
+manifest = manifest_from_arguments(args)
+available_ids = {path.stem for path in find_images(initial_lens_model_directory, manifest)}
+if manifest is not None:
+    manifest.close()
+
 with open(directory / "image_analysis.csv") as f:
     ground_truths = [GroundTruth.model_validate(row) for row in DictReader(f)]
+labelled_ids = {ground_truth.id for ground_truth in ground_truths}
 
-ground_truth_paths = {
-    ground_truth.image_path for ground_truth in ground_truths
-}
-
-good_ground_truths = []
+missing = [ground_truth.id for ground_truth in ground_truths if ground_truth.id not in available_ids]
+if missing:
+    print(f"Skipping {len(missing)} ground truths without a valid image: {', '.join(missing)}")
+ground_truths = [ground_truth for ground_truth in ground_truths if ground_truth.id in available_ids]
+labelled_ground_truths = list(ground_truths)
 
-for file in initial_lens_model_directory.iterdir():
-    if file not in ground_truth_paths:
-        good_ground_truths.append(GroundTruth(
-            id=file.stem,
-            category=Category.Good,
-            description="Good",
-        ))
+good_ground_truths = [
+    GroundTruth(
+        id=image_id,
+        category=Category.Good,
+        description="Good",
+    )
+    for image_id in sorted(available_ids - labelled_ids)
+]
 
 random.shuffle(good_ground_truths)
 ground_truths.extend(good_ground_truths[:len(ground_truths)])
@@ -51,24 +190,344 @@ random.shuffle(ground_truths)
 
 timestamp = dt.datetime.now().isoformat()
 
-with open(f"results-{timestamp}.csv", "w+") as f:
-    writer = csv.writer(f)
-    writer.writerow(
-        [
-            "id",
-            "expected_category",
-            "predicted_category",
-            "expected_description",
-            "predicted_description",
-        ]
+
+async def categorise_chunk(
+        chunk: list[GroundTruth],
+        group_size: int,
+) -> list[LensFitAnalysis | CascadeOutcome | VoteOutcome]:
+    """
+    Categorise a chunk of images, together if the group size is more than one.
+
+    With a cascade or voting each image in the chunk is categorised separately and its full outcome is returned.
+    """
+    if voting is not None:
+        return await asyncio.gather(*(
+            categorise_vote(
+                ground_truth.image_path,
+                voting,
+                model=model,
+                preprocessing=preprocessing,
+                call_log=call_log,
+            )
+            for ground_truth in chunk
+        ))
+
+    if cascade is not None:
+        return await asyncio.gather(*(
+            categorise_cascade(
+                ground_truth.image_path,
+                cascade,
+                model=model,
+                cache=cache,
+                preprocessing=preprocessing,
+                call_log=call_log,
+            )
+            for ground_truth in chunk
+        ))
+
+    if group_size == 1:
+        return [await categorise_async(
+            chunk[0].image_path,
+            cache=cache,
+            preprocessing=preprocessing,
+            model=model,
+            call_log=call_log,
+        )]
+
+    results = await categorise_group(
+        [ground_truth.image_path for ground_truth in chunk],
+        model=model,
+        cache=cache,
+        preprocessing=preprocessing,
+        call_log=call_log,
     )
-    for ground_truth in ground_truths:
-        predicted = categorise(ground_truth.image_path)
-        print(f"Expected: {ground_truth} ; Predicted {predicted}")
-        writer.writerow([
-            ground_truth.id,
-            ground_truth.category,
-            predicted.category,
-            ground_truth.description,
-            predicted.description,
-        ])
+    for _, result in results:
+        if isinstance(result, Exception):
+            raise result
+    return [result for _, result in results]
+
+
+async def evaluate(output_filename: str, group_size: int, run: str):
+    """
+    Categorise every ground truth, writing each prediction to a CSV, and to the result store under the given run if
+    there is one, and printing a summary.
+
+    When images are categorised together each is assigned an equal share of the request's latency. If triage is
+    enabled, images it decides are not sent to the VLM and its accuracy is reported separately. With a cascade the
+    escalation rate is reported, along with accuracy on accepted and escalated images. With voting the accuracy of the
+    first run of each image is compared with the majority, against the extra runs made.
+    """
+    correct = {"triage": 0, "vlm": 0}
+    counts = {"triage": 0, "vlm": 0}
+    escalated = {False: [0, 0], True: [0, 0]}
+    # Correct first runs, correct majorities and runs made
+    voted = [0, 0, 0]
+    total_latency = 0.0
+    bytes_saved = 0
+    tokens_saved = 0
+
+    with open(output_filename, "w+") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "id",
+                "expected_category",
+                "predicted_category",
+                "expected_description",
+                "predicted_description",
+                "latency",
+                "original_bytes",
+                "processed_bytes",
+                "original_tokens",
+                "processed_tokens",
+                "source",
+                "confidence",
+                "escalated",
+                "votes",
+                "agreement",
+            ]
+        )
+
+        def record(
+                ground_truth: GroundTruth,
+                predicted: LensFitAnalysis | CascadeOutcome | VoteOutcome,
+                latency: float,
+                source: str,
+                calls: list[CallRecord] | None = None,
+        ):
+            nonlocal total_latency, bytes_saved, tokens_saved
+            outcome = None
+            if isinstance(predicted, CascadeOutcome):
+                outcome, predicted = predicted, predicted.analysis
+                escalated[outcome.escalated][0] += predicted.category == ground_truth.category
+                escalated[outcome.escalated][1] += 1
+            vote = None
+            if isinstance(predicted, VoteOutcome):
+                vote, predicted = predicted, predicted.analysis
+                voted[0] += vote.first.category == ground_truth.category
+                voted[1] += predicted.category == ground_truth.category
+                voted[2] += vote.runs
+
+            report = None
+            if preprocessing is not None and source == "vlm":
+                _, report = preprocess_file(ground_truth.image_path, preprocessing)
+                bytes_saved += report.bytes_saved
+                tokens_saved += report.tokens_saved
+
+            total_latency += latency
+            counts[source] += 1
+            correct[source] += predicted.category == ground_truth.category
+
+            print(f"Expected: {ground_truth} ; Predicted {predicted}")
+            if report is not None:
+                print(
+                    f"Sent {report.processed_bytes} of {report.original_bytes} bytes, "
+                    f"~{report.processed_tokens} of {report.original_tokens} image tokens"
+                )
+            writer.writerow([
+                ground_truth.id,
+                ground_truth.category,
+                predicted.category,
+                ground_truth.description,
+                predicted.description,
+                f"{latency:.3f}",
+                *(
+                    [report.original_bytes, report.processed_bytes, report.original_tokens, report.processed_tokens]
+                    if report is not None else ["", "", "", ""]
+                ),
+                source,
+                *([f"{outcome.screening.confidence:.2f}", outcome.escalated] if outcome is not None else ["", ""]),
+                *(
+                    [" ".join(f"{category}:{n}" for category, n in vote.votes.items()), f"{vote.agreement:.2f}"]
+                    if vote is not None else ["", ""]
+                ),
+            ])
+            if store is not None:
+                result = ResultRecord.from_analysis(
+                    run,
+                    ground_truth.id,
+                    predicted,
+                    calls,
+                    expected=ground_truth.category,
+                )
+                result.latency = latency
+                store.append(result)
+
+        forwarded = []
+        for ground_truth in ground_truths:
+            start = time.perf_counter()
+            triaged = triage.categorise(ground_truth.image_path) if triage is not None else None
+            if triaged is None:
+                forwarded.append(ground_truth)
+            else:
+                record(ground_truth, triaged, time.perf_counter() - start, "triage")
+
+        for i in range(0, len(forwarded), group_size):
+            chunk = forwarded[i:i + group_size]
+
+            start = time.perf_counter()
+            with collect_records() as records:
+                predictions = await categorise_chunk(chunk, group_size)
+            latency = (time.perf_counter() - start) / len(chunk)
+
+            calls = CallAttribution(records)
+            for ground_truth, predicted in zip(chunk, predictions):
+                record(ground_truth, predicted, latency, "vlm", calls.pop(ground_truth.id))
+
+    count = len(ground_truths)
+    total_correct = sum(correct.values())
+    print(f"Group size {group_size}")
+    print(f"Accuracy: {total_correct}/{count} ({total_correct / count:.1%})")
+    print(f"Mean latency: {total_latency / count:.2f}s")
+    if preprocessing is not None:
+        print(f"Saved {bytes_saved / count:.0f} bytes and ~{tokens_saved / count:.0f} image tokens per image")
+    if triage is not None:
+        for source in ["triage", "vlm"]:
+            if counts[source]:
+                print(f"{source} accuracy: {correct[source]}/{counts[source]} ({correct[source] / counts[source]:.1%})")
+        print(f"Triage avoided {counts['triage']} of {count} VLM calls")
+    if cascade is not None:
+        total = sum(n for _, n in escalated.values())
+        if total:
+            print(f"Escalation rate: {escalated[True][1]}/{total} ({escalated[True][1] / total:.1%})")
+        for is_escalated, (n_correct, n) in escalated.items():
+            if n:
+                label = "Escalated" if is_escalated else "Accepted"
+                print(f"{label} accuracy: {n_correct}/{n} ({n_correct / n:.1%})")
+    if voting is not None and counts["vlm"]:
+        single, majority, runs = voted
+        images = counts["vlm"]
+        print(
+            f"Voting accuracy: {majority}/{images} ({majority / images:.1%}) against {single}/{images} "
+            f"({single / images:.1%}) for a single run, {majority - single:+d} correct for {runs - images} extra runs"
+        )
+
+
+async def evaluate_sequential(output_filename: str):
+    """
+    Categorise ground truths sampled round-robin across categories, in concurrent batches, until every class's
+    intervals are narrow enough or, with --compare-model or --compare-prompt, until the two configurations differ
+    significantly.
+
+    Every labelled image and every unlabelled (Good) image may be drawn, so classes are sampled at similar rates. Images
+    which fail to be categorised by either configuration are reported and left out of the evaluation.
+    """
+    pool = labelled_ground_truths + good_ground_truths
+    remaining = {category: sum(ground_truth.category == category for ground_truth in pool) for category in Category}
+    order = stratified(pool, key=lambda ground_truth: ground_truth.category, seed=args.seed)
+
+    # Each configuration is a model and the instructions it is given
+    configurations = [(model, SYSTEM_PROMPT, "baseline")]
+    comparing = args.compare_model is not None or args.compare_prompt is not None
+    if comparing:
+        configurations.append((
+            RateLimitedModel(args.compare_model, limiter) if args.compare_model is not None else model,
+            args.compare_prompt.read_text() if args.compare_prompt is not None else SYSTEM_PROMPT,
+            "compared",
+        ))
+    evaluations = [SequentialEvaluation() for _ in configurations]
+    comparison = PairedComparison(args.alpha, max_looks=math.ceil(len(pool) / args.batch_size))
+
+    async def categorise_batch(batch: list[GroundTruth]) -> list[list[LensFitAnalysis | Exception]]:
+        results = await asyncio.gather(
+            *(
+                categorise_async(
+                    ground_truth.image_path,
+                    model=configuration_model,
+                    cache=cache,
+                    preprocessing=preprocessing,
+                    call_log=call_log,
+                    instructions=instructions,
+                )
+                for configuration_model, instructions, _ in configurations
+                for ground_truth in batch
+            ),
+            return_exceptions=True,
+        )
+        return [results[i * len(batch):(i + 1) * len(batch)] for i in range(len(configurations))]
+
+    evaluated = 0
+    failed = 0
+    reason = "ran out of ground truth"
+    with open(output_filename, "w+") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "expected_category", "predicted_category", "compared_category"])
+
+        while batch := list(itertools.islice(order, args.batch_size)):
+            predictions = await categorise_batch(batch)
+            for i, ground_truth in enumerate(batch):
+                remaining[ground_truth.category] -= 1
+                errors = [predicted[i] for predicted in predictions if isinstance(predicted[i], BaseException)]
+                if errors:
+                    print(f"Error categorising {ground_truth.id}: {errors[0]!r}")
+                    failed += 1
+                    continue
+                for evaluation, predicted in zip(evaluations, predictions):
+                    evaluation.update(ground_truth.category, predicted[i].category)
+                if comparing:
+                    comparison.update(
+                        predictions[0][i].category == ground_truth.category,
+                        predictions[1][i].category == ground_truth.category,
+                    )
+                writer.writerow([
+                    ground_truth.id,
+                    ground_truth.category,
+                    predictions[0][i].category,
+                    predictions[1][i].category if comparing else "",
+                ])
+                evaluated += 1
+            f.flush()
+            if evaluations[0].count:
+                print(f"Evaluated {evaluated} images: accuracy {evaluations[0].correct / evaluations[0].count:.1%}")
+
+            exhausted = {category for category, count in remaining.items() if count == 0}
+            if comparing and comparison.is_significant():
+                reason = "the configurations differ significantly"
+                break
+            if all(
+                    evaluation.is_converged(args.max_width, args.min_per_class, exhausted)
+                    for evaluation in evaluations
+            ):
+                reason = f"every interval is at most {args.max_width:.0%} wide"
+                break
+
+    drawn = evaluated + failed
+    print(f"Stopped after {drawn} of {len(pool)} images because {reason}, {failed} failed")
+    print(f"{drawn * len(configurations)} calls made, {(len(pool) - drawn) * len(configurations)} saved")
+    for (configuration_model, instructions, name), evaluation in zip(configurations, evaluations):
+        prompt = "default instructions" if instructions == SYSTEM_PROMPT else f"instructions from {args.compare_prompt}"
+        print(f"{name.capitalize()}, model {configuration_model.model_name} with {prompt}:")
+        print("\n".join(evaluation.report()))
+    if comparing:
+        print(comparison.summary())
+
+
+async def main():
+    """
+    Run every evaluation in one event loop, so pooled connections to the provider stay usable between requests.
+    """
+    if args.sequential:
+        await evaluate_sequential(f"results-{timestamp}-sequential.csv")
+        return
+
+    run = args.run or default_run_name("performance")
+    for group_size in args.group_size:
+        if len(args.group_size) == 1:
+            await evaluate(f"results-{timestamp}.csv", group_size, run)
+        else:
+            await evaluate(f"results-{timestamp}-group-{group_size}.csv", group_size, f"{run}-group-{group_size}")
+
+
+asyncio.run(main())
+
+print(limiter.summary())
+if call_log is not None:
+    call_log.close()
+
+if store is not None:
+    store.close()
+    print(store.summary())
+
+if cache is not None:
+    print(cache.summary())
+    cache.close()
@@ -2,11 +2,204 @@
 """
 Use a VLM to categorise images produced by lens modelling in a given directory.
 """
+import asyncio
 import csv
 from argparse import ArgumentParser
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from aggregator_agent.image_agent import categorise
+from aggregator_agent.cache import ResultCache, add_cache_arguments, cache_from_arguments
+from aggregator_agent.cascade import Cascade, add_cascade_arguments, cascade_from_arguments
+from aggregator_agent.dedup import DEFAULT_MAX_DISTANCE, DuplicateIndex
+from aggregator_agent.manifest import (
+    DEFAULT_PATTERN,
+    Manifest,
+    add_manifest_arguments,
+    find_images,
+    manifest_from_arguments,
+)
+from aggregator_agent.preprocessing import Preprocessing, add_preprocessing_arguments, preprocessing_from_arguments
+from aggregator_agent.rate_limit import add_rate_limit_arguments, rate_limiter_from_arguments
+from aggregator_agent.results import (
+    CallAttribution,
+    ResultRecord,
+    ResultStore,
+    add_store_arguments,
+    default_run_name,
+    store_from_arguments,
+)
+from aggregator_agent.telemetry import CallLog, add_call_log_arguments, call_log_from_arguments, collect_records
+from aggregator_agent.triage import Triage
+from aggregator_agent.voting import Voting, add_voting_arguments, voting_from_arguments
+from aggregator_agent.watch import DirectoryWatcher, add_watch_arguments, watcher_from_arguments
+
+# pydantic-ai is slow to import, so it is not imported until images are categorised
+if TYPE_CHECKING:
+    from pydantic_ai.models import Model
+
+
+def read_completed_ids(output_filename: Path) -> set[str]:
+    """
+    The IDs of images already categorised in an existing output CSV.
+
+    If the previous run was killed part way through writing a row then that row is removed.
+    """
+    if not output_filename.exists():
+        return set()
+
+    with output_filename.open("rb+") as f:
+        contents = f.read()
+        if contents and not contents.endswith(b"\n"):
+            f.truncate(contents.rfind(b"\n") + 1)
+
+    with output_filename.open(newline="") as f:
+        return {row["id"] for row in csv.DictReader(f)}
+
+
+async def categorise_directory(
+        directory: Path,
+        output_filename: Path,
+        concurrency: int,
+        cache: ResultCache | None = None,
+        preprocessing: Preprocessing | None = None,
+        group_size: int = 1,
+        triage: Triage | None = None,
+        cascade: Cascade | None = None,
+        dedup: DuplicateIndex | None = None,
+        model: "Model | str | None" = None,
+        call_log: CallLog | None = None,
+        voting: Voting | None = None,
+        watcher: DirectoryWatcher | None = None,
+        manifest: Manifest | None = None,
+        pattern: str = DEFAULT_PATTERN,
+        recursive: bool = False,
+        resume: bool = False,
+        store: ResultStore | None = None,
+        run: str = "predict",
+):
+    """
+    Categorise every image in the directory, writing rows to the output CSV as they complete.
+
+    Each row is flushed as soon as it is written so an interrupted run loses at most the requests in flight. Images
+    which fail are recorded in a separate errors CSV rather than stopping the run. With deduplication each row also
+    gives the ID of the image whose analysis it inherited, or is empty if the image was categorised itself.
+
+    With a watcher, images are then categorised as they are written until the task is cancelled. An image which is
+    rewritten is categorised again and a new row appended, so the last row for an ID is the current one.
+
+    Parameters
+    ----------
+    directory
+        The directory containing images to categorise
+    output_filename
+        The CSV to which results are written
+    concurrency
+        The maximum number of images being categorised at once
+    cache
+        If given previous answers for identical requests are reused
+    preprocessing
+        If given each image is transformed before it is sent
+    group_size
+        The number of images sent together in each request
+    triage
+        If given images are first triaged locally and only those it cannot decide are sent to the VLM
+    cascade
+        If given a small model categorises each image first and only doubtful results are sent to the large model
+    dedup
+        If given near-duplicates of images already indexed reuse their analysis rather than calling the VLM
+    model
+        Optionally override the model used by the agents, e.g. with a rate limited model
+    call_log
+        If given telemetry for each call is appended to it
+    voting
+        If given each image is categorised by a majority of concurrent runs
+    watcher
+        If given only images that have finished being written are categorised, and the directory is then watched
+    manifest
+        If given images are listed from it after it is brought up to date, and invalid images are skipped
+    pattern
+        Only images whose filenames match this glob pattern are categorised
+    recursive
+        If True images in subdirectories are categorised too. Ignored with a watcher, as are the manifest and
+        pattern.
+    resume
+        If True, append to an existing output and skip images it already contains. Images that previously failed
+        are retried, and the errors CSV is rewritten so it only holds failures from this run.
+    store
+        If given each result is also recorded in it, with its model, latency and tokens
+    run
+        The name of the run results are recorded under in the store
+    """
+    from aggregator_agent.image_agent import categorise_many
+
+    columns = ["id", "category", "description"] + (["inherited_from"] if dedup is not None else [])
+    completed_ids = read_completed_ids(output_filename) if resume else set()
+    if completed_ids:
+        with output_filename.open(newline="") as f:
+            existing_columns = next(csv.reader(f))
+        if existing_columns != columns:
+            raise ValueError(
+                f"{output_filename} has columns {existing_columns}, not {columns}, so cannot be resumed with these "
+                f"options. Resume with --dedup only if the output was written with it."
+            )
+    errors_filename = output_filename.with_name(f"{output_filename.stem}_errors.csv")
+
+    existing = watcher.start() if watcher is not None else find_images(directory, manifest, pattern, recursive)
+    paths = [path for path in existing if path.stem not in completed_ids]
+    if completed_ids:
+        print(f"Skipping {len(completed_ids)} images already in {output_filename}")
+
+    # Every image missing from the output is tried again, so failures from earlier runs are out of date
+    output_mode = "a" if resume else "w"
+    with output_filename.open(output_mode, newline="") as f, errors_filename.open("w", newline="") as errors_file:
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(columns)
+        errors_writer = csv.writer(errors_file)
+        errors_writer.writerow(["id", "path", "error"])
+
+        async def write(image_paths: list[Path]):
+            # Calls are collected so each stored result carries its own latency and tokens
+            with collect_records() as records:
+                calls = CallAttribution(records)
+                async for path, result in categorise_many(
+                        image_paths,
+                        concurrency=concurrency,
+                        cache=cache,
+                        preprocessing=preprocessing,
+                        group_size=group_size,
+                        triage=triage,
+                        cascade=cascade,
+                        dedup=dedup,
+                        model=model,
+                        call_log=call_log,
+                        voting=voting,
+                        return_exceptions=True,
+                ):
+                    if isinstance(result, Exception):
+                        print(f"Error categorising {path}: {result!r}")
+                        errors_writer.writerow([path.stem, path, repr(result)])
+                        errors_file.flush()
+                        calls.pop(path.stem)
+                    else:
+                        row = [path.stem, result.category, result.description]
+                        if dedup is not None:
+                            row.append(dedup.inherited_from(path.stem) or "")
+                        writer.writerow(row)
+                        f.flush()
+                        image_calls = calls.pop(path.stem)
+                        if store is not None:
+                            store.append(ResultRecord.from_analysis(run, path.stem, result, image_calls))
+            if store is not None:
+                store.flush()
+
+        await write(paths)
+
+        if watcher is not None:
+            print(f"Watching {directory} for new images using {watcher.method}")
+            async for written in watcher.changes():
+                await write(written)
+                print(f"Categorised {len(written)} new or changed images")
 
 
 def main():
@@ -21,17 +214,149 @@ def main():
         type=Path,
         default=None,
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of images being categorised at once",
+    )
+    parser.add_argument(
+        "--group-size",
+        type=int,
+        default=1,
+        help="Number of images sent together in each request",
+    )
+    parser.add_argument(
+        "--triage",
+        type=Path,
+        default=None,
+        help="Thresholds written by calibrate_triage.py. Images they decide are not sent to the VLM.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Append to an existing output, skipping images it already contains",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Reuse the analysis of near-identical images, indexed by perceptual hash in <output>_hashes.sqlite",
+    )
+    parser.add_argument(
+        "--dedup-distance",
+        type=int,
+        default=DEFAULT_MAX_DISTANCE,
+        help="Maximum number of differing bits, out of 256, for images to count as near-duplicates",
+    )
+    add_cache_arguments(parser)
+    add_preprocessing_arguments(parser)
+    add_cascade_arguments(parser)
+    add_voting_arguments(parser)
+    add_watch_arguments(parser)
+    add_manifest_arguments(parser)
+    add_rate_limit_arguments(parser)
+    add_call_log_arguments(parser)
+    add_store_arguments(parser)
 
     args = parser.parse_args()
 
+    if args.watch:
+        # The watcher lists the directory itself, reporting every settled PNG directly within it
+        unsupported = [
+            option
+            for option, given in [
+                ("--pattern", args.pattern != DEFAULT_PATTERN),
+                ("--recursive", args.recursive),
+                ("--manifest", args.manifest is not None),
+            ]
+            if given
+        ]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} cannot be combined with --watch")
+
+    from aggregator_agent.image_agent import get_agent
+    from aggregator_agent.rate_limited_model import RateLimitedModel
+
     output_filename = args.output or args.directory.with_name(f"{args.directory.stem}_categorised.csv")
 
-    with output_filename.open("w") as f:
-        writer = csv.writer(f)
-        writer.writerow(["id", "category", "description"])
-        for path in args.directory.iterdir():
-            result = categorise(path)
-            writer.writerow([path.stem, result.category, result.description])
+    cache = cache_from_arguments(args)
+    triage = Triage.from_path(args.triage) if args.triage is not None else None
+    limiter = rate_limiter_from_arguments(args, max_concurrency=args.concurrency)
+    call_log = call_log_from_arguments(args)
+    voting = voting_from_arguments(args)
+    cascade = cascade_from_arguments(args)
+    if cascade is not None:
+        cascade.small_model = RateLimitedModel(cascade.small_model, limiter)
+    dedup = None
+    if args.dedup:
+        dedup = DuplicateIndex(
+            output_filename.with_name(f"{output_filename.stem}_hashes.sqlite"),
+            max_distance=args.dedup_distance,
+        )
+
+    watcher = watcher_from_arguments(args, args.directory)
+    manifest = manifest_from_arguments(args)
+    store = store_from_arguments(args)
+
+    try:
+        asyncio.run(categorise_directory(
+            args.directory,
+            output_filename,
+            args.concurrency,
+            cache=cache,
+            preprocessing=preprocessing_from_arguments(args),
+            group_size=args.group_size,
+            triage=triage,
+            cascade=cascade,
+            dedup=dedup,
+            model=RateLimitedModel(get_agent().model, limiter),
+            call_log=call_log,
+            voting=voting,
+            watcher=watcher,
+            manifest=manifest,
+            pattern=args.pattern,
+            recursive=args.recursive,
+            resume=args.resume,
+            store=store,
+            run=args.run or default_run_name(args.directory.name),
+        ))
+    except KeyboardInterrupt:
+        if watcher is None:
+            raise
+        print("Stopped watching")
+
+    print(limiter.summary())
+    if call_log is not None:
+        print(f"Call telemetry appended to {call_log.path}")
+        call_log.close()
+
+    if triage is not None:
+        print(triage.summary())
+
+    if cascade is not None:
+        print(cascade.summary())
+
+    if voting is not None:
+        print(voting.summary())
+
+    if watcher is not None:
+        print(watcher.summary())
+        watcher.close()
+
+    if dedup is not None:
+        print(dedup.summary())
+        dedup.close()
+
+    if manifest is not None:
+        manifest.close()
+
+    if store is not None:
+        store.close()
+        print(store.summary())
+
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Inspect the result store: list runs, look up an image, filter a run, compare two runs or export a run as a CSV.
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+
+from aggregator_agent.results import ResultRecord, ResultStore
+from aggregator_agent.schema import Category
+
+
+def describe(record: ResultRecord) -> str:
+    expected = f" (expected {record.expected})" if record.expected is not None else ""
+    return f"{record.run} {record.id}: {record.category}{expected} - {record.description}"
+
+
+def main():
+    parser = ArgumentParser("Query the results recorded with --store")
+    parser.add_argument("store", type=Path, help="The result store directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("runs", help="List runs and how many results each has")
+
+    show = subparsers.add_parser("show", help="Every result for an image")
+    show.add_argument("id")
+    show.add_argument("--run", default=None, help="Only results from this run")
+
+    select = subparsers.add_parser("list", help="The results of a run")
+    select.add_argument("run")
+    select.add_argument("--category", type=Category, choices=list(Category), default=None)
+    select.add_argument("--mismatched", action="store_true", help="Only results which do not match the ground truth")
+
+    diff = subparsers.add_parser("diff", help="Images categorised differently by two runs")
+    diff.add_argument("before")
+    diff.add_argument("after")
+
+    export = subparsers.add_parser("export", help="Write the results of a run as a CSV")
+    export.add_argument("run")
+    export.add_argument("output", type=Path)
+    export.add_argument("--expected", action="store_true", help="Include the ground truth category")
+
+    subparsers.add_parser("reindex", help="Rebuild the index from the partitions")
+
+    args = parser.parse_args()
+
+    with ResultStore(args.store) as store:
+        if args.command == "runs":
+            for run, count in store.runs().items():
+                print(f"{run}: {count} results")
+        elif args.command == "show":
+            for record in store.lookup(args.id, args.run):
+                tokens = (
+                    f", {record.input_tokens} input and {record.output_tokens} output tokens"
+                    if record.input_tokens is not None else ""
+                )
+                latency = f" in {record.latency:.2f}s" if record.latency is not None else ""
+                print(f"{describe(record)} [{record.model or 'no model'}{latency}{tokens}]")
+        elif args.command == "list":
+            count = 0
+            for record in store.select(args.run, args.category, args.mismatched):
+                print(describe(record))
+                count += 1
+            print(f"{count} results")
+        elif args.command == "diff":
+            changes = list(store.diff(args.before, args.after))
+            for change in changes:
+                print(f"{change.id}: {change.before or '-'} -> {change.after or '-'}")
+            print(f"{len(changes)} images differ between {args.before} and {args.after}")
+        elif args.command == "export":
+            count = store.export_csv(args.run, args.output, args.expected)
+            print(f"Wrote {count} results to {args.output}")
+        elif args.command == "reindex":
+            store.rebuild_index()
+            print(f"Indexed {len(store)} results")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Index the images in a directory into the manifest, reporting invalid images and exact duplicates.
+"""
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from pathlib import Path
+
+from aggregator_agent.manifest import Manifest, add_manifest_arguments
+
+
+def main():
+    parser = ArgumentParser("Index images into the manifest, reading only new and changed files")
+    parser.add_argument("directory", type=Path)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Threads reading new and changed files",
+    )
+    add_manifest_arguments(parser, listing=True, optional=False)
+
+    args = parser.parse_args()
+
+    with Manifest(args.manifest, workers=args.workers) as manifest:
+        start = time.perf_counter()
+        result = manifest.update(args.directory, args.pattern, args.recursive)
+        print(f"Scanned {args.directory} in {time.perf_counter() - start:.2f}s: {result}")
+
+        entries = manifest.entries(args.directory, args.recursive)
+        for entry in entries:
+            if entry.error is not None:
+                print(f"Invalid: {entry.path}: {entry.error}")
+
+        by_hash = defaultdict(list)
+        for entry in entries:
+            by_hash[entry.hash].append(entry.path)
+        for paths in by_hash.values():
+            if len(paths) > 1:
+                print(f"Identical: {', '.join(map(str, paths))}")
+
+        print(f"{len(entries)} images indexed in {args.directory}, {len(manifest)} in {args.manifest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,187 @@
+"""
+Segment rgb_zoom.png in every subdirectory of data/segmentation.
+
+CPU bound stages (resizing, encoding and compositing) run in a process pool while mask generation requests run
+concurrently, so network waits and CPU work overlap.
+"""
+import asyncio
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from aggregator_agent.segmentation import process_image
+from aggregator_agent import segmentation
+from aggregator_agent.rate_limit import RateLimiter, add_rate_limit_arguments, rate_limiter_from_arguments
+from aggregator_agent.telemetry import CallLog, add_call_log_arguments, call_log_from_arguments
 
 directory = Path(__file__).parents[1]
 segmentation_directory = directory / "data/segmentation"
 
-for path in list(segmentation_directory.iterdir()):
-    print("Processing:", path)
-    try:
-        process_image(path / "rgb_zoom.png")
-    except Exception as e:
-        print("Error processing", path, ":", e)
+
+def _timed(function, *args):
+    """
+    Call a function, returning its result and how long it took. Runs in worker processes.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def is_up_to_date(image_path: Path) -> bool:
+    """
+    Whether a mask has already been generated since the image was last modified.
+    """
+    mask_path = image_path.parent / "mask.png"
+    return (
+        mask_path.exists()
+        and image_path.exists()
+        and mask_path.stat().st_mtime >= image_path.stat().st_mtime
+    )
+
+
+class Pipeline:
+    """
+    Segments images in three stages, recording how long is spent in each.
+    """
+
+    def __init__(
+            self,
+            pool: ProcessPoolExecutor,
+            concurrency: int,
+            black_tolerance: int = 0,
+            limiter: RateLimiter | None = None,
+            call_log: CallLog | None = None,
+    ):
+        """
+        Parameters
+        ----------
+        pool
+            Runs the CPU bound stages
+        concurrency
+            The maximum number of mask generation requests in flight
+        black_tolerance
+            Mask pixels with all channels at most this value are made transparent
+        limiter
+            If given paces requests within rate limits and retries rate limited and transient failures
+        call_log
+            If given telemetry for each request is appended to it
+        """
+        self.pool = pool
+        self.black_tolerance = black_tolerance
+        self.limiter = limiter
+        self.call_log = call_log
+        self.requests = asyncio.Semaphore(concurrency)
+        # Limit how far preparation runs ahead of requests so encoded and resized images do not pile up in memory
+        self.admission = asyncio.Semaphore(2 * concurrency)
+
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.errors = []
+
+    async def _in_pool(self, stage: str, function, *args):
+        result, seconds = await asyncio.get_running_loop().run_in_executor(self.pool, _timed, function, *args)
+        self.timings[stage] += seconds
+        self.counts[stage] += 1
+        return result
+
+    async def segment(self, image_path: Path):
+        async with self.admission:
+            try:
+                body, original_image = await self._in_pool("prepare", segmentation.prepare, image_path)
+
+                async with self.requests:
+                    start = time.perf_counter()
+                    mask_b64 = await segmentation.request_mask_async(
+                        body,
+                        self.limiter,
+                        call_log=self.call_log,
+                        image_id=image_path.parent.name,
+                    )
+                    self.timings["request"] += time.perf_counter() - start
+                    self.counts["request"] += 1
+
+                await self._in_pool(
+                    "finalise",
+                    segmentation.finalise,
+                    image_path,
+                    original_image,
+                    mask_b64,
+                    self.black_tolerance,
+                )
+            except Exception as e:
+                print("Error processing", image_path.parent, ":", e)
+                self.errors.append(image_path)
+
+    async def run(self, image_paths: list[Path]):
+        await asyncio.gather(*(self.segment(image_path) for image_path in image_paths))
+
+    def summary(self, wall_time: float) -> str:
+        lines = [f"{'stage':<10} {'count':>6} {'total (s)':>10} {'mean (s)':>9}"]
+        for stage in ["prepare", "request", "finalise"]:
+            count = self.counts[stage]
+            total = self.timings[stage]
+            mean = total / count if count else 0.0
+            lines.append(f"{stage:<10} {count:>6} {total:>10.1f} {mean:>9.2f}")
+        lines.append(f"Wall time {wall_time:.1f}s, {len(self.errors)} errors")
+        lines.extend(f"Failed: {image_path}" for image_path in self.errors)
+        return "\n".join(lines)
+
+
+def main():
+    parser = ArgumentParser("Segment every image in data/segmentation")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of mask generation requests in flight",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes for resizing, encoding and compositing (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate masks even if they are newer than their input",
+    )
+    parser.add_argument(
+        "--black-tolerance",
+        type=int,
+        default=0,
+        help="Mask pixels with all channels at most this value are made transparent",
+    )
+    add_rate_limit_arguments(parser)
+    add_call_log_arguments(parser)
+
+    args = parser.parse_args()
+
+    image_paths = [path / "rgb_zoom.png" for path in sorted(segmentation_directory.iterdir()) if path.is_dir()]
+    pending = [image_path for image_path in image_paths if args.force or not is_up_to_date(image_path)]
+    print(f"Processing {len(pending)} images, skipping {len(image_paths) - len(pending)} with up to date masks")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        limiter = rate_limiter_from_arguments(args, max_concurrency=args.concurrency)
+        call_log = call_log_from_arguments(args)
+        pipeline = Pipeline(
+            pool,
+            args.concurrency,
+            black_tolerance=args.black_tolerance,
+            limiter=limiter,
+            call_log=call_log,
+        )
+        asyncio.run(pipeline.run(pending))
+
+    print(pipeline.summary(time.perf_counter() - start))
+    print(limiter.summary())
+    if call_log is not None:
+        call_log.close()
+    if pipeline.errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
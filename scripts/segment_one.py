@@ -1,11 +1,27 @@
 import argparse
 from pathlib import Path
 
+from aggregator_agent.rate_limit import add_rate_limit_arguments, rate_limiter_from_arguments
 from aggregator_agent.segmentation import process_image
+from aggregator_agent.telemetry import add_call_log_arguments, call_log_from_arguments
 
 parser = argparse.ArgumentParser(description="Segment One Script")
 parser.add_argument("image_path", type=Path, help="Input file path")
+parser.add_argument(
+    "--black-tolerance",
+    type=int,
+    default=0,
+    help="Mask pixels with all channels at most this value are made transparent",
+)
+
+add_rate_limit_arguments(parser)
+add_call_log_arguments(parser)
 
 args = parser.parse_args()
 
-process_image(args.image_path)
+process_image(
+    args.image_path,
+    black_tolerance=args.black_tolerance,
+    limiter=rate_limiter_from_arguments(args),
+    call_log=call_log_from_arguments(args),
+)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Run a long-lived local service which categorises and segments images for pipeline processes.
+
+Clients submit jobs with `aggregator_agent.service.ServiceClient`. Categorisation jobs arriving together are coalesced
+into grouped requests, and every job shares the service's rate limits.
+"""
+import asyncio
+from argparse import ArgumentParser
+from pathlib import Path
+
+from aggregator_agent.cache import add_cache_arguments, cache_from_arguments
+from aggregator_agent.preprocessing import add_preprocessing_arguments, preprocessing_from_arguments
+from aggregator_agent.rate_limit import add_rate_limit_arguments, rate_limiter_from_arguments
+from aggregator_agent.service import DEFAULT_HOST, DEFAULT_MAX_WAIT, DEFAULT_PORT, Service
+from aggregator_agent.telemetry import add_call_log_arguments, call_log_from_arguments
+
+
+def main():
+    parser = ArgumentParser("Serve categorisation and segmentation jobs from a warm process")
+
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        default=None,
+        help="Listen on this Unix socket rather than a TCP port",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of requests in flight at once across all clients",
+    )
+    parser.add_argument(
+        "--group-size",
+        type=int,
+        default=4,
+        help="Maximum number of images coalesced into one categorisation request",
+    )
+    parser.add_argument(
+        "--max-wait",
+        type=float,
+        default=DEFAULT_MAX_WAIT,
+        help="Seconds to wait after a job arrives for others to join its request",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="The most to spend, in US dollars, while serving. Jobs which would pass it are refused.",
+    )
+    parser.add_argument(
+        "--stub-latency",
+        type=float,
+        default=None,
+        help="Categorise with a local stand-in model taking this many seconds, for testing without calling the provider",
+    )
+    add_cache_arguments(parser)
+    add_preprocessing_arguments(parser)
+    add_rate_limit_arguments(parser)
+    add_call_log_arguments(parser)
+
+    args = parser.parse_args()
+
+    # pydantic-ai is slow to import, so it is left until the arguments are parsed
+    from aggregator_agent.image_agent import get_agent
+    from aggregator_agent.rate_limited_model import RateLimitedModel
+    from aggregator_agent.stub_model import stub_model
+
+    cache = cache_from_arguments(args)
+    limiter = rate_limiter_from_arguments(args, max_concurrency=args.concurrency)
+    call_log = call_log_from_arguments(args)
+    model = stub_model(args.stub_latency) if args.stub_latency is not None else get_agent().model
+
+    service = Service(
+        model=RateLimitedModel(model, limiter),
+        limiter=limiter,
+        cache=cache,
+        preprocessing=preprocessing_from_arguments(args),
+        call_log=call_log,
+        max_batch=args.group_size,
+        max_wait=args.max_wait,
+        concurrency=args.concurrency,
+        budget=args.budget,
+    )
+
+    print(f"Serving on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        print("Stopped serving")
+
+    print(service.summary())
+    print(limiter.summary())
+    if call_log is not None:
+        call_log.close()
+
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,14 +5,32 @@ Reads a CSV (default: results.csv) and for every row where either
 categories/descriptions and displays the associated image
 (`data/initial_lens_model/{id}.png`). The image window waits for a button
 press before closing and advancing to the next result.
+
+Alternatively, with --store and --run, the results of a run in the result
+store whose category does not match the ground truth are shown.
+
+For reviewing many results, --sheets pages through contact sheets of cached
+thumbnails, building the next sheet while the current one is looked at,
+--sheet-output writes the sheets as files and --html writes a static gallery
+with a page per category pair.
 """
 
 import argparse
 import csv
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterable
+from typing import Callable, Dict, Iterable, List
 
-import matplotlib.pyplot as plt
+from PIL import Image
+
+from aggregator_agent.thumbnails import (
+    ThumbnailCache,
+    add_thumbnail_arguments,
+    contact_sheet,
+    thumbnails_from_arguments,
+    write_gallery,
+)
 
 
 def read_rows(csv_path: Path) -> Iterable[Dict[str, str]]:
@@ -22,8 +40,46 @@ def read_rows(csv_path: Path) -> Iterable[Dict[str, str]]:
             yield row
 
 
+def read_store(store_path: Path, run: str) -> Iterable[Dict[str, str]]:
+    """Rows in the same shape as the CSV for the mismatched results of a run."""
+    from aggregator_agent.results import ResultStore
+
+    with ResultStore(store_path) as store:
+        if run not in store.runs():
+            raise SystemExit(f"Run not found in {store_path}: {run}")
+        for record in store.select(run=run, mismatched=True):
+            yield {
+                "id": record.id,
+                "expected_category": record.expected or "",
+                "predicted_category": record.category,
+                "predicted_description": record.description,
+            }
+
+
+def parse_pair(value: str) -> tuple[str, str]:
+    """An EXPECTED:PREDICTED category pair, where either may be * to match any category."""
+    expected, separator, predicted = value.partition(":")
+    if not separator or not expected or not predicted:
+        raise argparse.ArgumentTypeError(f"Expected EXPECTED:PREDICTED, got {value!r}")
+    return expected, predicted
+
+
+def pair_of(row: Dict[str, str]) -> tuple[str, str]:
+    return row.get("expected_category", ""), row.get("predicted_category", "")
+
+
+def matches(row: Dict[str, str], pairs: List[tuple[str, str]]) -> bool:
+    expected, predicted = pair_of(row)
+    return any(
+        pattern_expected in ("*", expected) and pattern_predicted in ("*", predicted)
+        for pattern_expected, pattern_predicted in pairs
+    )
+
+
 def show_image(image_path: Path, title: str) -> None:
     """Display an image and wait until user presses a key or clicks to continue."""
+    import matplotlib.pyplot as plt
+
     img = plt.imread(image_path)
     fig, ax = plt.subplots(figsize=(8, 8))
     ax.imshow(img)
@@ -41,6 +97,174 @@ def show_image(image_path: Path, title: str) -> None:
     plt.show()
 
 
+def view_rows(rows: List[Dict[str, str]], image_root: Path) -> None:
+    """Show each result in turn in its own window."""
+    for row in rows:
+        expected = row.get("expected_category", "")
+        predicted = row.get("predicted_category", "")
+        expected_desc = row.get("expected_description", "").strip()
+        predicted_desc = row.get("predicted_description", "").strip()
+        sample_id = row.get("id", "").strip()
+
+        print("-" * 60)
+        print(f"ID: {sample_id}")
+        print(f"Expected: {expected}")
+        print(f"Predicted: {predicted}")
+        print(f"Expected description: {expected_desc}")
+        print(f"Predicted description: {predicted_desc}")
+
+        image_path = image_root / f"{sample_id}.png"
+        if not image_path.exists():
+            print(f"[missing image] {image_path}")
+            continue
+
+        try:
+            show_image(image_path, title=sample_id)
+        except Exception as exc:  # pragma: no cover - convenience for runtime issues
+            print(f"Failed to display {image_path}: {exc}")
+
+
+def caption(row: Dict[str, str]) -> List[str]:
+    expected, predicted = pair_of(row)
+    return [row.get("id", "").strip(), f"{expected or '?'} -> {predicted or '?'}"]
+
+
+class SheetBuilder:
+    """Builds the contact sheet for each page, one at a time in the background."""
+
+    def __init__(
+            self,
+            rows: List[Dict[str, str]],
+            image_root: Path,
+            thumbnails: ThumbnailCache,
+            page_size: int,
+            columns: int,
+    ):
+        self.rows = rows
+        self.image_root = image_root
+        self.thumbnails = thumbnails
+        self.page_size = page_size
+        self.columns = columns
+        self.pages = max(-(-len(rows) // page_size), 1)
+        self._builder = ThreadPoolExecutor(1)
+        self._sheets: Dict[int, Future] = {}
+
+    def close(self) -> None:
+        self._builder.shutdown(cancel_futures=True)
+
+    def _build(self, page: int) -> Image.Image:
+        chunk = self.rows[page * self.page_size:(page + 1) * self.page_size]
+        paths = [self.image_root / f"{row.get('id', '').strip()}.png" for row in chunk]
+        return contact_sheet(
+            self.thumbnails.get_many(paths),
+            [caption(row) for row in chunk],
+            self.columns,
+            self.thumbnails.size,
+        )
+
+    def sheet(self, page: int) -> Image.Image:
+        """The sheet for a page, after which the next is built and sheets far from the page are forgotten."""
+        if page not in self._sheets:
+            self._sheets[page] = self._builder.submit(self._build, page)
+        sheet = self._sheets[page].result()
+        if page + 1 < self.pages and page + 1 not in self._sheets:
+            self._sheets[page + 1] = self._builder.submit(self._build, page + 1)
+        for other in list(self._sheets):
+            if abs(other - page) > 1:
+                del self._sheets[other]
+        return sheet
+
+
+def browse_sheets(builder: SheetBuilder, start: int) -> None:
+    """Show contact sheets in one window, paging with the arrow keys or a click."""
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(16, 10))
+    page = start
+
+    def show() -> None:
+        ax.clear()
+        ax.imshow(builder.sheet(page))
+        ax.axis("off")
+        fig.suptitle(f"Page {page + 1} of {builder.pages}")
+        fig.canvas.draw_idle()
+
+    def turn(step: int) -> None:
+        nonlocal page
+        if 0 <= page + step < builder.pages:
+            page += step
+            show()
+
+    def _key_event(event) -> None:
+        if event.key in ("right", " ", "n", "pagedown"):
+            turn(1)
+        elif event.key in ("left", "p", "backspace", "pageup"):
+            turn(-1)
+
+    fig.canvas.mpl_connect("key_press_event", _key_event)
+    fig.canvas.mpl_connect("button_press_event", lambda _event: turn(1))
+    fig.tight_layout()
+    show()
+
+    print("Right, space or click for the next page, left for the previous page, q to quit")
+    plt.show()
+
+
+def write_sheets(builder: SheetBuilder, directory: Path) -> None:
+    """Write every contact sheet as a JPEG."""
+    directory.mkdir(parents=True, exist_ok=True)
+    width = len(str(builder.pages))
+    for page in range(builder.pages):
+        path = directory / f"page-{page + 1:0{width}d}.jpg"
+        builder.sheet(page).save(path, "JPEG", quality=90)
+        print(f"Wrote {path}")
+
+
+def write_galleries(
+        rows: List[Dict[str, str]],
+        image_root: Path,
+        thumbnails: ThumbnailCache,
+        directory: Path,
+        page_size: int,
+) -> None:
+    """Write a gallery of every result and one for each category pair, linked from an index."""
+    images = [image_root / f"{row.get('id', '').strip()}.png" for row in rows]
+    paths = thumbnails.get_many(images)
+    captions = [
+        caption(row) + [
+            f"Expected: {row.get('expected_description', '').strip()}",
+            f"Predicted: {row.get('predicted_description', '').strip()}",
+        ]
+        for row in rows
+    ]
+
+    def gallery(name: str, title: str, keep: Callable[[Dict[str, str]], bool]) -> str:
+        indices = [index for index, row in enumerate(rows) if keep(row)]
+        write_gallery(
+            directory / name,
+            title,
+            [images[index] for index in indices],
+            [paths[index] for index in indices],
+            [captions[index] for index in indices],
+            page_size,
+        )
+        return f'<li><a href="{name}/index.html">{title}</a> ({len(indices)})</li>'
+
+    items = [gallery("all", "All results", lambda row: True)]
+    for (expected, predicted), _ in sorted(Counter(map(pair_of, rows)).items()):
+        items.append(gallery(
+            f"{expected or 'none'}-{predicted or 'none'}",
+            f"Expected {expected or '?'}, predicted {predicted or '?'}",
+            lambda row, pair=(expected, predicted): pair_of(row) == pair,
+        ))
+    (directory / "index.html").write_text(
+        "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Results</title></head>\n"
+        f"<body><h1>Results</h1><ul>{''.join(items)}</ul></body></html>\n",
+        encoding="utf-8",
+    )
+    print(f"Wrote gallery of {len(rows)} results to {directory / 'index.html'}")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         description="View results where either category is not 'Good'."
@@ -50,42 +274,91 @@ def main() -> None:
         type=Path,
         help="Path to results CSV (default: results.csv)",
     )
+    parser.add_argument(
+        "--store",
+        type=Path,
+        help="Result store directory to read instead of a CSV, with --run",
+    )
+    parser.add_argument(
+        "--run",
+        help="Run in the result store whose mismatched results are shown",
+    )
     parser.add_argument(
         "--image-root",
         type=Path,
         help="Root directory containing <id>.png images.",
     )
+    parser.add_argument(
+        "--mismatched",
+        action="store_true",
+        help="Only show results whose predicted category differs from the expected one",
+    )
+    parser.add_argument(
+        "--pair",
+        type=parse_pair,
+        action="append",
+        default=None,
+        help="Only show results with this EXPECTED:PREDICTED category pair, either of which may be *. Repeatable.",
+    )
+    parser.add_argument(
+        "--sheets",
+        action="store_true",
+        help="Page through contact sheets of thumbnails instead of one image at a time",
+    )
+    parser.add_argument(
+        "--sheet-output",
+        type=Path,
+        help="Write the contact sheets as JPEGs to this directory instead of showing them",
+    )
+    parser.add_argument(
+        "--html",
+        type=Path,
+        help="Write a static HTML gallery to this directory instead of showing results",
+    )
+    parser.add_argument("--page-size", type=int, default=24, help="Results on each contact sheet or gallery page")
+    parser.add_argument("--columns", type=int, default=3, help="Thumbnails in each row of a contact sheet")
+    parser.add_argument("--start-page", type=int, default=1, help="The contact sheet shown first")
+    add_thumbnail_arguments(parser)
     args = parser.parse_args()
 
     csv_path: Path = args.csv
     image_root: Path = args.image_root
 
-    if not csv_path.exists():
-        raise SystemExit(f"CSV not found: {csv_path}")
+    if args.store is not None:
+        if args.run is None:
+            parser.error("--run is required with --store")
+        rows = read_store(args.store, args.run)
+    else:
+        if not csv_path.exists():
+            raise SystemExit(f"CSV not found: {csv_path}")
+        rows = read_rows(csv_path)
 
-    for row in read_rows(csv_path):
-        expected = row.get("expected_category", "")
-        predicted = row.get("predicted_category", "")
-        expected_desc = row.get("expected_description", "").strip()
-        predicted_desc = row.get("predicted_description", "").strip()
-        sample_id = row.get("id", "").strip()
+    if args.mismatched:
+        rows = (row for row in rows if row.get("expected_category") != row.get("predicted_category"))
+    if args.pair is not None:
+        rows = (row for row in rows if matches(row, args.pair))
+    rows = list(rows)
 
-        print("-" * 60)
-        print(f"ID: {sample_id}")
-        print(f"Expected: {expected}")
-        print(f"Predicted: {predicted}")
-        print(f"Expected description: {expected_desc}")
-        print(f"Predicted description: {predicted_desc}")
+    for (expected, predicted), count in Counter(map(pair_of, rows)).most_common():
+        print(f"{expected or '?'} -> {predicted or '?'}: {count}")
 
-        image_path = image_root / f"{sample_id}.png"
-        if not image_path.exists():
-            print(f"[missing image] {image_path}")
-            continue
+    if not (args.sheets or args.sheet_output or args.html):
+        view_rows(rows, image_root)
+        return
 
-        try:
-            show_image(image_path, title=sample_id)
-        except Exception as exc:  # pragma: no cover - convenience for runtime issues
-            print(f"Failed to display {image_path}: {exc}")
+    with thumbnails_from_arguments(args) as thumbnails:
+        if args.html is not None:
+            write_galleries(rows, image_root, thumbnails, args.html, args.page_size)
+        else:
+            builder = SheetBuilder(rows, image_root, thumbnails, args.page_size, args.columns)
+            try:
+                if args.sheet_output is not None:
+                    write_sheets(builder, args.sheet_output)
+                else:
+                    browse_sheets(builder, min(max(args.start_page, 1), builder.pages) - 1)
+            finally:
+                builder.close()
+        print(thumbnails.summary())
 
 
 if __name__ == "__main__":
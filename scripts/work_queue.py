@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Spread categorisation of a catalogue across many workers through a queue on a shared filesystem.
+
+Enqueue a directory once, start `work` on as many nodes as the API quota allows, all pointing at the same queue file,
+then `export` the merged results. Workers that die have their leases returned to the queue once they expire.
+"""
+import asyncio
+import os
+import socket
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from aggregator_agent.cache import ResultCache, add_cache_arguments, cache_from_arguments
+from aggregator_agent.manifest import add_manifest_arguments, find_images, manifest_from_arguments
+from aggregator_agent.preprocessing import Preprocessing, add_preprocessing_arguments, preprocessing_from_arguments
+from aggregator_agent.rate_limit import add_rate_limit_arguments, rate_limiter_from_arguments
+from aggregator_agent.telemetry import CallLog, add_call_log_arguments, call_log_from_arguments
+from aggregator_agent.work_queue import DEFAULT_LEASE_SECONDS, WorkQueue
+
+# pydantic-ai is slow to import and only workers need it, so it is imported where it is used
+if TYPE_CHECKING:
+    from pydantic_ai.models import Model
+
+
+async def heartbeat(queue: WorkQueue, worker: str):
+    """
+    Extend the worker's leases at a third of the lease duration until cancelled.
+    """
+    while True:
+        await asyncio.sleep(queue.lease_seconds / 3)
+        await asyncio.to_thread(queue.heartbeat, worker)
+
+
+async def work(
+        queue: WorkQueue,
+        worker: str,
+        batch_size: int,
+        concurrency: int,
+        cache: ResultCache | None = None,
+        preprocessing: Preprocessing | None = None,
+        group_size: int = 1,
+        model: "Model | str | None" = None,
+        call_log: CallLog | None = None,
+):
+    """
+    Claim and categorise batches of images until every image is done or failed.
+
+    Once there is nothing left to claim the worker keeps polling while other workers hold leases, so images leased by
+    a worker which dies are picked up once its leases expire. Queue operations run in a thread, as they may wait on
+    locks held by other workers.
+
+    Parameters
+    ----------
+    queue
+        The shared queue
+    worker
+        A name unique to this worker, used to hold leases
+    batch_size
+        The number of images claimed at once
+    concurrency
+        The maximum number of images being categorised at once
+    cache
+        If given previous answers for identical requests are reused
+    preprocessing
+        If given each image is transformed before it is sent
+    group_size
+        The number of images sent together in each request
+    model
+        Optionally override the model used by the agents, e.g. with a rate limited model
+    call_log
+        If given telemetry for each call is appended to it
+    """
+    from aggregator_agent.image_agent import categorise_many
+
+    heartbeat_task = asyncio.create_task(heartbeat(queue, worker))
+    try:
+        while True:
+            batch = await asyncio.to_thread(queue.claim, worker, batch_size)
+            if not batch:
+                if (await asyncio.to_thread(queue.progress))["leased"] == 0:
+                    break
+                await asyncio.sleep(queue.lease_seconds / 2)
+                continue
+
+            async for path, result in categorise_many(
+                    batch,
+                    concurrency=concurrency,
+                    cache=cache,
+                    preprocessing=preprocessing,
+                    group_size=group_size,
+                    model=model,
+                    call_log=call_log,
+                    return_exceptions=True,
+            ):
+                if isinstance(result, Exception):
+                    print(f"Error categorising {path}: {result!r}")
+                    await asyncio.to_thread(queue.fail, worker, path.stem, repr(result))
+                else:
+                    await asyncio.to_thread(queue.complete, worker, path.stem, result)
+            print(queue.summary())
+    finally:
+        heartbeat_task.cancel()
+        queue.release(worker)
+
+
+def main():
+    parser = ArgumentParser("Categorise images through a work queue shared by several workers")
+    parser.add_argument("queue", type=Path, help="SQLite file holding the queue and results, on a shared filesystem")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add every image in a directory to the queue")
+    enqueue_parser.add_argument("directory", type=Path)
+    add_manifest_arguments(enqueue_parser)
+
+    work_parser = subparsers.add_parser("work", help="Claim and categorise images until every image is done or failed")
+    work_parser.add_argument(
+        "--worker",
+        default=f"{socket.gethostname()}-{os.getpid()}",
+        help="A name unique to this worker (default: hostname and process ID)",
+    )
+    work_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=64,
+        help="Number of images claimed at once",
+    )
+    work_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of images being categorised at once by this worker",
+    )
+    work_parser.add_argument(
+        "--group-size",
+        type=int,
+        default=1,
+        help="Number of images sent together in each request",
+    )
+    work_parser.add_argument(
+        "--lease",
+        type=float,
+        default=DEFAULT_LEASE_SECONDS,
+        help="Seconds a claim lasts without a heartbeat before its images are returned to the queue",
+    )
+    work_parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="Number of times an image is tried before it is marked as failed",
+    )
+    add_cache_arguments(work_parser)
+    add_preprocessing_arguments(work_parser)
+    add_rate_limit_arguments(work_parser)
+    add_call_log_arguments(work_parser)
+
+    export_parser = subparsers.add_parser("export", help="Write the merged results to a CSV")
+    export_parser.add_argument("output", type=Path)
+
+    subparsers.add_parser("status", help="Print the number of images in each state")
+
+    args = parser.parse_args()
+
+    if args.command == "work":
+        queue = WorkQueue(args.queue, lease_seconds=args.lease, max_attempts=args.max_attempts)
+    else:
+        queue = WorkQueue(args.queue)
+
+    with queue:
+        if args.command == "enqueue":
+            manifest = manifest_from_arguments(args)
+            added = queue.enqueue(find_images(args.directory, manifest, args.pattern, args.recursive))
+            if manifest is not None:
+                manifest.close()
+            print(f"Added {added} images to {args.queue}")
+        elif args.command == "work":
+            from aggregator_agent.image_agent import get_agent
+            from aggregator_agent.rate_limited_model import RateLimitedModel
+
+            cache = cache_from_arguments(args)
+            limiter = rate_limiter_from_arguments(args, max_concurrency=args.concurrency)
+            call_log = call_log_from_arguments(args)
+            asyncio.run(work(
+                queue,
+                args.worker,
+                args.batch_size,
+                args.concurrency,
+                cache=cache,
+                preprocessing=preprocessing_from_arguments(args),
+                group_size=args.group_size,
+                model=RateLimitedModel(get_agent().model, limiter),
+                call_log=call_log,
+            ))
+            print(limiter.summary())
+            if call_log is not None:
+                call_log.close()
+            if cache is not None:
+                print(cache.summary())
+                cache.close()
+        elif args.command == "export":
+            rows = queue.export(args.output)
+            print(f"Wrote {rows} results to {args.output}")
+
+        print(queue.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Local stand-ins for the OpenAI API, served through httpx mock transports so tests send nothing over the network.
+
+`sleep` is imported by name so that tests which patch `asyncio.sleep` to record backoff do not also record the
+latency of these stand-ins.
+"""
+import json
+import re
+from asyncio import sleep
+from typing import Callable
+
+import httpx
+
+
+def chat_completion(arguments: dict, model: str = "gpt-5", tool_name: str = "final_result") -> dict:
+    """
+    The body of a chat completion whose reply is a call to the output tool with the given arguments.
+    """
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": 0,
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "tool_calls",
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [
+                        {
+                            "id": "call_fake",
+                            "type": "function",
+                            "function": {"name": tool_name, "arguments": json.dumps(arguments)},
+                        }
+                    ],
+                },
+            }
+        ],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+    }
+
+
+def _multipart_file(request: httpx.Request) -> bytes:
+    """
+    The contents of the part named "file" of a multipart upload.
+    """
+    boundary = re.search(r"boundary=([^;]+)", request.headers["content-type"]).group(1).encode()
+    for part in request.content.split(b"--" + boundary):
+        headers, _, body = part.partition(b"\r\n\r\n")
+        if b'name="file"' in headers:
+            return body.removesuffix(b"\r\n")
+    raise ValueError("No file in upload")
+
+
+class FakeBatchAPI:
+    """
+    The files and batches endpoints of the Batch API. Each batch is reported in progress for `polls` retrievals and
+    then finishes, answering each request with `respond`.
+    """
+
+    def __init__(
+            self,
+            respond: Callable[[dict], dict],
+            polls: int = 1,
+            fail: bool = False,
+            drop: frozenset[str] = frozenset(),
+    ):
+        """
+        Parameters
+        ----------
+        respond
+            Gives the response body for a request body
+        polls
+            Retrievals of a batch which report it in progress before it finishes
+        fail
+            If True every batch fails, without output or error files, as when its input fails validation
+        drop
+            Custom IDs left out of the output
+        """
+        self.respond = respond
+        self.polls = polls
+        self.fail = fail
+        self.drop = drop
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self.retrievals = 0
+
+    def client(self):
+        from openai import OpenAI
+
+        return OpenAI(
+            api_key="test",
+            base_url="http://fake/v1",
+            http_client=httpx.Client(transport=httpx.MockTransport(self.handle)),
+        )
+
+    def _add_file(self, content: bytes) -> dict:
+        file_id = f"file-{len(self.files)}"
+        self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": 0,
+            "filename": f"{file_id}.jsonl",
+            "purpose": "batch",
+        }
+
+    def _finish(self, batch: dict):
+        output = []
+        for line in self.files[batch["input_file_id"]].decode().splitlines():
+            request = json.loads(line)
+            if request["custom_id"] in self.drop:
+                continue
+            output.append(json.dumps({
+                "id": f"response-{request['custom_id']}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": self.respond(request["body"])},
+                "error": None,
+            }))
+        batch["status"] = "completed"
+        batch["output_file_id"] = self._add_file("\n".join(output).encode())["id"]
+        batch["request_counts"]["completed"] = len(output)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/v1")
+        if request.method == "POST" and path == "/files":
+            return httpx.Response(200, json=self._add_file(_multipart_file(request)))
+        if request.method == "POST" and path == "/batches":
+            body = json.loads(request.content)
+            batch_id = f"batch-{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "status": "validating",
+                "created_at": 0,
+                "request_counts": {
+                    "total": len(self.files[body["input_file_id"]].splitlines()),
+                    "completed": 0,
+                    "failed": 0,
+                },
+                "polls": 0,
+            }
+            return httpx.Response(200, json=self.batches[batch_id])
+        if request.method == "GET" and (match := re.fullmatch(r"/batches/([^/]+)", path)):
+            self.retrievals += 1
+            batch = self.batches[match.group(1)]
+            if batch["status"] not in ("completed", "failed"):
+                batch["polls"] += 1
+                if batch["polls"] <= self.polls:
+                    batch["status"] = "in_progress"
+                elif self.fail:
+                    batch["status"] = "failed"
+                else:
+                    self._finish(batch)
+            return httpx.Response(200, json=batch)
+        if request.method == "GET" and (match := re.fullmatch(r"/files/([^/]+)/content", path)):
+            return httpx.Response(200, content=self.files[match.group(1)])
+        return httpx.Response(404, json={"error": {"message": f"No fake for {request.method} {path}"}})
+
+
+class ScriptedChatAPI:
+    """
+    The chat completions endpoint, answering each request with the next of a script of responses and then with
+    `respond` once the script runs out.
+    """
+
+    def __init__(self, script: list[httpx.Response], respond: Callable[[dict], dict], latency: float = 0.0):
+        """
+        Parameters
+        ----------
+        script
+            Responses given to the first requests, in order, such as rate limits and server errors
+        respond
+            Gives the response body for a request body once the script is exhausted
+        latency
+            Seconds each response takes
+        """
+        self.script = list(script)
+        self.respond = respond
+        self.latency = latency
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        if self.script:
+            return self.script.pop(0)
+        return httpx.Response(200, json=self.respond(json.loads(request.content)))
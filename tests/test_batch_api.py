@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from aggregator_agent import batch_api
+from aggregator_agent.batch_api import categorise_via_batch
+from aggregator_agent.cache import ResultCache
+from aggregator_agent.schema import LensFitAnalysis
+from tests.fake_openai import FakeBatchAPI, chat_completion
+
+
+def respond(_body: dict) -> dict:
+    return chat_completion({"category": "Good", "description": "A good fit"})
+
+
+def make_images(directory: Path, names: list[str]) -> list[Path]:
+    directory.mkdir(exist_ok=True)
+    paths = []
+    for name in names:
+        paths.append(directory / f"{name}.png")
+        Image.new("RGB", (8, 2)).save(paths[-1])
+    return paths
+
+
+def test_submit_poll_and_read_results(tmp_path):
+    api = FakeBatchAPI(respond, polls=2)
+    images = make_images(tmp_path / "images", ["a", "b", "c"])
+
+    results = dict(categorise_via_batch(images, tmp_path / "work", client=api.client(), poll_interval=0.0))
+
+    assert results == {name: LensFitAnalysis(category="Good", description="A good fit") for name in "abc"}
+    assert len(api.batches) == 1
+    assert api.retrievals == 3
+
+
+def test_failed_batch_gives_every_image_an_error(tmp_path):
+    api = FakeBatchAPI(respond, fail=True)
+    images = make_images(tmp_path / "images", ["a", "b"])
+
+    results = dict(categorise_via_batch(images, tmp_path / "work", client=api.client(), poll_interval=0.0))
+
+    assert results.keys() == {"a", "b"}
+    assert all(isinstance(result, RuntimeError) for result in results.values())
+
+
+def test_missing_result_gives_an_error(tmp_path):
+    api = FakeBatchAPI(respond, drop=frozenset({"b"}))
+    images = make_images(tmp_path / "images", ["a", "b"])
+
+    results = dict(categorise_via_batch(images, tmp_path / "work", client=api.client(), poll_interval=0.0))
+
+    assert isinstance(results["a"], LensFitAnalysis)
+    assert isinstance(results["b"], RuntimeError)
+
+
+def test_resume_reuses_submitted_batches(tmp_path):
+    api = FakeBatchAPI(respond)
+    images = make_images(tmp_path / "images", ["a", "b"])
+    list(categorise_via_batch(images, tmp_path / "work", client=api.client(), poll_interval=0.0))
+
+    results = dict(categorise_via_batch(images, tmp_path / "work", client=api.client(), poll_interval=0.0))
+
+    assert results.keys() == {"a", "b"}
+    assert len(api.batches) == 1
+
+
+def test_resume_refuses_other_images(tmp_path):
+    api = FakeBatchAPI(respond)
+    list(categorise_via_batch(
+        make_images(tmp_path / "images", ["a", "b"]), tmp_path / "work", client=api.client(), poll_interval=0.0
+    ))
+
+    with pytest.raises(ValueError, match="different set of requests"):
+        list(categorise_via_batch(
+            make_images(tmp_path / "other", ["c"]), tmp_path / "work", client=api.client(), poll_interval=0.0
+        ))
+
+
+def test_cached_images_are_read_once_and_not_submitted(tmp_path, monkeypatch):
+    api = FakeBatchAPI(respond)
+    images = make_images(tmp_path / "images", ["a", "b"])
+    # Identical images share a cache entry
+    Image.new("RGB", (8, 2), "white").save(images[1])
+    prompts = []
+
+    def prompt(image_path, preprocessing=None):
+        prompts.append(image_path.stem)
+        return original(image_path, preprocessing)
+
+    original = batch_api._prompt
+    monkeypatch.setattr(batch_api, "_prompt", prompt)
+
+    with ResultCache(tmp_path / "cache.sqlite") as cache:
+        list(categorise_via_batch(images[:1], tmp_path / "first", client=api.client(), cache=cache, poll_interval=0.0))
+        results = dict(categorise_via_batch(
+            images, tmp_path / "second", client=api.client(), cache=cache, poll_interval=0.0
+        ))
+
+    assert results.keys() == {"a", "b"}
+    assert prompts == ["a", "a", "b"]
+    # Only the uncached image was submitted the second time
+    assert len(api.batches) == 2
+    assert batch_api._custom_ids(tmp_path / "second" / "batch_input_0.jsonl") == ["b"]
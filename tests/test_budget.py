@@ -0,0 +1,52 @@
+import asyncio
+from pathlib import Path
+
+from PIL import Image
+
+from aggregator_agent.budget import CATEGORISE, BudgetScheduler, Job
+from aggregator_agent.telemetry import optional_record
+
+
+def make_jobs(directory: Path, count: int) -> list[Job]:
+    jobs = []
+    for i in range(count):
+        path = directory / f"image_{i}.png"
+        Image.new("RGB", (8, 2)).save(path)
+        jobs.append(Job(operation=CATEGORISE, path=path))
+    return jobs
+
+
+async def call(path: Path):
+    """
+    Images 0 and 1 call the model, image 2 is found in the cache and the rest fail before any call is made.
+    """
+    with optional_record(None, CATEGORISE, [path.stem], "gpt-5") as record:
+        if path.stem.endswith(("0", "1")):
+            record.input_tokens = 1_000_000
+            return "called"
+        if path.stem.endswith("2"):
+            record.cache_hit = True
+            return "cached"
+    raise RuntimeError("Failed before calling the model")
+
+
+def run(scheduler: BudgetScheduler) -> list:
+    async def run_all():
+        return [result async for _, result in scheduler.run({CATEGORISE: call})]
+
+    return asyncio.run(run_all())
+
+
+def test_only_jobs_which_called_the_model_inform_estimates(tmp_path):
+    jobs = make_jobs(tmp_path, 4)
+    with BudgetScheduler(tmp_path / "budget.sqlite", limit=100.0) as scheduler:
+        scheduler.submit(jobs)
+        results = run(scheduler)
+
+        assert len(results) == 4
+        assert scheduler.spent() == 2.5
+        # The cache hit and the failure, which cost nothing, would pull estimates down
+        assert list(scheduler._costs[CATEGORISE]) == [1.25, 1.25]
+
+    with BudgetScheduler(tmp_path / "budget.sqlite", limit=100.0) as scheduler:
+        assert list(scheduler._costs[CATEGORISE]) == [1.25, 1.25]
@@ -0,0 +1,48 @@
+from aggregator_agent.dedup import DuplicateIndex
+from aggregator_agent.schema import Category, LensFitAnalysis
+
+ANALYSIS = LensFitAnalysis(category=Category.Fixable, description="Residuals at the mask edge")
+
+
+def test_near_duplicates_inherit_from_the_original(tmp_path):
+    with DuplicateIndex(tmp_path / "hashes.sqlite", max_distance=2) as index:
+        index.add("original", 0b1111, ANALYSIS)
+
+        assert index.lookup("copy", 0b1110) == ANALYSIS
+        assert index.lookup("copy_of_copy", 0b1100) == ANALYSIS
+        assert index.lookup("different", 0b1111 << 8) is None
+
+        assert index.inherited_from("original") is None
+        assert index.inherited_from("copy") == "original"
+        assert index.inherited_from("copy_of_copy") == "original"
+        assert index.inherited_from("different") is None
+
+
+def test_index_is_reloaded_from_disk(tmp_path):
+    with DuplicateIndex(tmp_path / "hashes.sqlite") as index:
+        index.add("original", 0b1111, ANALYSIS)
+        index.lookup("copy", 0b1110)
+
+    with DuplicateIndex(tmp_path / "hashes.sqlite") as index:
+        assert len(index) == 2
+        assert index.lookup("another_copy", 0b0111) == ANALYSIS
+        assert index.inherited_from("another_copy") == "original"
+
+
+def test_rewritten_image_does_not_match_its_old_entry(tmp_path):
+    rewritten = LensFitAnalysis(category=Category.Good, description="Clean residuals")
+    with DuplicateIndex(tmp_path / "hashes.sqlite", max_distance=2) as index:
+        index.add("image", 0b1111, ANALYSIS)
+
+        assert index.lookup("image", 0b1110) is None
+        assert index.reused == 0
+
+        # Categorising the new contents replaces the old entry
+        index.add("image", 0b1110, rewritten)
+        assert len(index) == 1
+        assert index.lookup("copy", 0b1111) == rewritten
+
+    with DuplicateIndex(tmp_path / "hashes.sqlite", max_distance=2) as index:
+        assert len(index) == 2
+        assert index.lookup("image", 0b1110) == rewritten
+        assert index.inherited_from("image") == "copy"
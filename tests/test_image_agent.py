@@ -0,0 +1,163 @@
+import asyncio
+from pathlib import Path
+
+from PIL import Image
+from pydantic_ai.messages import ModelMessage, ModelResponse, ToolCallPart, UserPromptPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+
+from aggregator_agent.image_agent import (
+    GROUP_PROMPT_HASH,
+    OUTPUT_SCHEMA,
+    PROMPT_HASH,
+    categorise_async,
+    categorise_group,
+    get_agent,
+    get_group_agent,
+    prompt_hash,
+)
+from aggregator_agent.results import CallAttribution, ResultRecord, ResultStore
+from aggregator_agent.schema import Category, LensFitAnalysis
+from aggregator_agent.telemetry import collect_records, current_call
+
+
+def make_image(path: Path) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", (8, 2)).save(path)
+    return path
+
+
+class Model:
+    """
+    Answers single image requests with a Good analysis and grouped requests with `grouped`, counting requests in flight.
+    """
+
+    def __init__(self, grouped=None):
+        self.grouped = grouped
+        self.requests: list[list[str]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def respond(self, messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+
+        image_ids = [
+            content.removeprefix("Image ID: ")
+            for message in messages
+            for part in getattr(message, "parts", [])
+            if isinstance(part, UserPromptPart) and not isinstance(part.content, str)
+            for content in part.content
+            if isinstance(content, str) and content.startswith("Image ID: ")
+        ]
+        self.requests.append(image_ids)
+        tool = info.output_tools[0].name
+        if not image_ids:
+            return ModelResponse(parts=[ToolCallPart(tool, {"category": "Good", "description": "Alone"})])
+        if self.grouped is None:
+            raise RuntimeError("The grouped request failed")
+        return ModelResponse(parts=[ToolCallPart(tool, {"response": self.grouped(image_ids)})])
+
+
+def run(model: Model, paths: list[Path]) -> list[tuple[Path, LensFitAnalysis | Exception]]:
+    async def categorise():
+        function_model = FunctionModel(model.respond)
+        with get_agent().override(model=function_model), get_group_agent().override(model=function_model):
+            return await categorise_group(paths)
+
+    return asyncio.run(categorise())
+
+
+def grouped_analysis(image_id: str) -> dict:
+    return {"id": image_id, "category": "Fixable", "description": "Grouped"}
+
+
+def test_missing_images_are_requeued_one_at_a_time(tmp_path):
+    paths = [make_image(tmp_path / f"{name}.png") for name in "abcd"]
+    model = Model(grouped=lambda image_ids: [grouped_analysis(image_ids[0])])
+
+    results = run(model, paths)
+
+    assert [path for path, _ in results] == paths
+    assert results[0][1].category == Category.Fixable
+    assert [result.description for _, result in results[1:]] == ["Alone"] * 3
+    assert model.requests[0] == ["a", "b", "c", "d"]
+    assert len(model.requests) == 4
+    assert model.max_in_flight == 1
+
+
+def test_failed_group_falls_back_to_single_images(tmp_path):
+    paths = [make_image(tmp_path / f"{name}.png") for name in "ab"]
+    model = Model()
+
+    results = run(model, paths)
+
+    assert [result.description for _, result in results] == ["Alone", "Alone"]
+    assert model.requests == [["a", "b"], [], []]
+
+
+def test_images_sharing_an_id_are_categorised_separately(tmp_path):
+    first = make_image(tmp_path / "one" / "a.png")
+    second = make_image(tmp_path / "two" / "a.png")
+    other = make_image(tmp_path / "one" / "b.png")
+    model = Model(grouped=lambda image_ids: [grouped_analysis(image_id) for image_id in image_ids])
+
+    results = run(model, [first, second, other])
+
+    assert [path for path, _ in results] == [first, second, other]
+    assert [result.description for _, result in results] == ["Grouped", "Alone", "Grouped"]
+    assert model.requests[0] == ["a", "b"]
+
+
+def test_results_record_the_prompt_each_image_was_given(tmp_path):
+    paths = [make_image(tmp_path / f"{name}.png") for name in "abc"]
+    model = Model(grouped=lambda image_ids: [grouped_analysis(image_ids[0])])
+
+    async def categorise():
+        function_model = FunctionModel(model.respond)
+        with get_agent().override(model=function_model), get_group_agent().override(model=function_model):
+            with collect_records() as records:
+                grouped = await categorise_group(paths[:2])
+                alone = await categorise_async(paths[2], instructions="Other instructions")
+        calls = CallAttribution(records)
+        return [
+            ResultRecord.from_analysis("run", path.stem, analysis, calls.pop(path.stem))
+            for path, analysis in grouped + [(paths[2], alone)]
+        ]
+
+    results = asyncio.run(categorise())
+
+    assert [result.prompt_hash for result in results] == [
+        GROUP_PROMPT_HASH,
+        PROMPT_HASH,
+        prompt_hash("Other instructions", OUTPUT_SCHEMA),
+    ]
+    # A result decided without calling a model, e.g. by triage, has no prompt
+    triaged = LensFitAnalysis(category=Category.Good, description="Triaged")
+    assert ResultRecord.from_analysis("run", "d", triaged, []).prompt_hash is None
+
+
+def test_results_stored_without_a_call_log_are_timed(tmp_path):
+    path = make_image(tmp_path / "a.png")
+    model = Model()
+    current = []
+
+    async def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        # The rate limiter adds its queue wait and retries to the current record
+        current.append(current_call.get())
+        return await model.respond(messages, info)
+
+    async def categorise():
+        with get_agent().override(model=FunctionModel(respond)), collect_records() as records:
+            analysis = await categorise_async(path)
+        return ResultRecord.from_analysis("run", path.stem, analysis, CallAttribution(records).pop(path.stem))
+
+    with ResultStore(tmp_path / "store") as store:
+        store.append(asyncio.run(categorise()))
+        [stored] = store.lookup("a")
+
+    assert current[0] is not None
+    assert stored.latency > 0
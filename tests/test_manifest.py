@@ -0,0 +1,67 @@
+import os
+import shutil
+from argparse import ArgumentParser
+
+from PIL import Image
+
+from aggregator_agent.manifest import (
+    DEFAULT_MANIFEST_PATH,
+    Manifest,
+    ScanResult,
+    add_manifest_arguments,
+    manifest_from_arguments,
+)
+
+
+def make_image(path, colour=(0, 0, 0)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", (8, 2), colour).save(path)
+
+
+def test_update_reads_only_what_changed(tmp_path):
+    images = tmp_path / "images"
+    for name in ["a", "b", "nested/c", "nested/deeper/d"]:
+        make_image(images / f"{name}.png")
+    (images / "broken.png").write_bytes(b"not a png")
+
+    with Manifest(tmp_path / "manifest.sqlite") as manifest:
+        assert manifest.update(images, recursive=True) == ScanResult(added=5, invalid=1)
+        assert [path.stem for path in manifest.images(images, recursive=True)] == ["a", "b", "c", "d"]
+
+        make_image(images / "a.png", colour=(255, 0, 0))
+        os.utime(images / "a.png", ns=(0, 0))
+        (images / "b.png").unlink()
+        shutil.rmtree(images / "nested" / "deeper")
+
+        assert manifest.update(images, recursive=True) == ScanResult(changed=1, removed=2, unchanged=2)
+        assert [path.stem for path in manifest.images(images, recursive=True)] == ["a", "c"]
+        assert [path.name for path, _ in manifest.invalid(images)] == ["broken.png"]
+
+
+def test_update_of_a_directory_leaves_its_subdirectories(tmp_path):
+    images = tmp_path / "images"
+    make_image(images / "a.png")
+    make_image(images / "nested" / "b.png")
+
+    with Manifest(tmp_path / "manifest.sqlite") as manifest:
+        manifest.update(images, recursive=True)
+        (images / "a.png").unlink()
+
+        assert manifest.update(images) == ScanResult(removed=1)
+        assert [path.stem for path in manifest.images(images, recursive=True)] == ["b"]
+
+
+def test_manifest_is_only_used_when_asked_for():
+    parser = ArgumentParser()
+    add_manifest_arguments(parser)
+
+    assert manifest_from_arguments(parser.parse_args([])) is None
+    assert parser.parse_args(["--manifest"]).manifest == DEFAULT_MANIFEST_PATH
+
+
+def test_a_script_which_always_indexes_only_chooses_the_file(tmp_path):
+    parser = ArgumentParser()
+    add_manifest_arguments(parser, optional=False)
+
+    assert parser.parse_args([]).manifest == DEFAULT_MANIFEST_PATH
+    assert parser.parse_args(["--manifest", str(tmp_path / "m.sqlite")]).manifest == tmp_path / "m.sqlite"
@@ -0,0 +1,46 @@
+from argparse import ArgumentParser
+
+import pytest
+from PIL import Image
+from pydantic import ValidationError
+
+from aggregator_agent import preprocessing
+from aggregator_agent.preprocessing import Preprocessing, add_preprocessing_arguments, preprocess_file
+
+
+@pytest.mark.parametrize("panels", [(), (4,), (-1,), (0, 0)])
+def test_invalid_panels_are_refused(panels):
+    with pytest.raises(ValidationError):
+        Preprocessing(panels=panels)
+
+
+def test_panel_arguments_are_checked():
+    parser = ArgumentParser()
+    add_preprocessing_arguments(parser)
+
+    assert parser.parse_args(["--panels", "0", "3"]).panels == [0, 3]
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--panels", "4"])
+
+
+def test_each_file_is_only_preprocessed_once(tmp_path, monkeypatch):
+    calls = []
+    original = preprocessing.preprocess
+
+    def counted(image_bytes, settings):
+        calls.append(settings)
+        return original(image_bytes, settings)
+
+    monkeypatch.setattr(preprocessing, "preprocess", counted)
+    image_path = tmp_path / "a.png"
+    Image.new("RGB", (64, 16)).save(image_path)
+    settings = Preprocessing(panels=(0, 1))
+
+    first = preprocess_file(image_path, settings)
+    assert preprocess_file(image_path, settings) == first
+    assert len(calls) == 1
+
+    Image.new("RGB", (128, 32)).save(image_path)
+    preprocess_file(image_path, settings)
+    preprocess_file(image_path, Preprocessing(panels=(2,)))
+    assert len(calls) == 3
@@ -0,0 +1,158 @@
+import asyncio
+
+import httpx
+import pytest
+from pydantic_ai import Agent
+from pydantic_ai.exceptions import ModelHTTPError
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from aggregator_agent import rate_limit, rate_limited_model
+from aggregator_agent.rate_limit import RateLimiter
+from aggregator_agent.rate_limited_model import RateLimitedModel
+from aggregator_agent.schema import LensFitAnalysis
+from tests.fake_openai import ScriptedChatAPI, chat_completion
+
+
+def respond(_body: dict) -> dict:
+    return chat_completion({"category": "Good", "description": "A good fit"})
+
+
+def error(status_code: int, **headers: str) -> httpx.Response:
+    return httpx.Response(status_code, headers=headers, json={"error": {"message": "Scripted failure"}})
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list[float]:
+    """
+    The backoff delays waited by the limiter, which are recorded instead of slept, with jitter at its maximum.
+
+    With jitter at its maximum every backoff is positive, so the zero length sleeps libraries use to yield are passed
+    through unrecorded.
+    """
+    delays = []
+    sleep = asyncio.sleep
+
+    async def record(delay, *args, **kwargs):
+        if delay > 0:
+            delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(rate_limit.asyncio, "sleep", record)
+    monkeypatch.setattr(rate_limit.random, "uniform", lambda lower, upper: upper)
+    return delays
+
+
+def serve(monkeypatch, api: ScriptedChatAPI):
+    monkeypatch.setattr(rate_limited_model, "async_http_client", api.client)
+
+
+def categorise(limiter: RateLimiter, times: int = 1) -> list[LensFitAnalysis]:
+    model = RateLimitedModel(
+        OpenAIChatModel("gpt-5", provider=OpenAIProvider(api_key="test", base_url="http://fake/v1")),
+        limiter,
+    )
+    agent = Agent(output_type=LensFitAnalysis)
+
+    async def run_all():
+        results = await asyncio.gather(*(agent.run("Categorise", model=model) for _ in range(times)))
+        return [result.output for result in results]
+
+    return asyncio.run(run_all())
+
+
+def test_backs_off_exponentially_from_rate_limits_and_server_errors(monkeypatch, sleeps):
+    api = ScriptedChatAPI([error(429), error(503), error(429)], respond)
+    serve(monkeypatch, api)
+    limiter = RateLimiter(max_concurrency=8, base_delay=1.0, max_delay=60.0)
+
+    assert categorise(limiter) == [LensFitAnalysis(category="Good", description="A good fit")]
+
+    assert sleeps == [1.0, 2.0, 4.0]
+    assert (api.requests, limiter.calls, limiter.retries, limiter.rate_limited) == (4, 4, 3, 2)
+
+
+def test_backoff_is_capped(monkeypatch, sleeps):
+    serve(monkeypatch, ScriptedChatAPI([error(503)] * 4, respond))
+
+    categorise(RateLimiter(base_delay=1.0, max_delay=3.0))
+
+    assert sleeps == [1.0, 2.0, 3.0, 3.0]
+
+
+def test_honours_retry_after(monkeypatch, sleeps):
+    serve(monkeypatch, ScriptedChatAPI(
+        [error(429, **{"retry-after": "7"}), error(503, **{"retry-after-ms": "2500"}), error(429, **{"retry-after": "0"})],
+        respond,
+    ))
+
+    categorise(RateLimiter(base_delay=1.0))
+
+    # Retry-After only ever lengthens the backoff
+    assert sleeps == [7.0, 2.5, 4.0]
+
+
+def test_malformed_retry_after_falls_back_to_backoff(monkeypatch, sleeps):
+    api = ScriptedChatAPI([error(429, **{"retry-after": "soon"}), error(503, **{"retry-after-ms": "later"})], respond)
+    serve(monkeypatch, api)
+
+    assert categorise(RateLimiter(base_delay=1.0)) == [LensFitAnalysis(category="Good", description="A good fit")]
+
+    assert sleeps == [1.0, 2.0]
+    assert api.requests == 3
+
+
+def test_gives_up_after_max_retries(monkeypatch, sleeps):
+    api = ScriptedChatAPI([error(503)] * 3, respond)
+    serve(monkeypatch, api)
+
+    with pytest.raises(ModelHTTPError) as raised:
+        categorise(RateLimiter(max_retries=2))
+
+    assert raised.value.status_code == 503
+    assert api.requests == 3
+
+
+def test_does_not_retry_client_errors(monkeypatch, sleeps):
+    api = ScriptedChatAPI([error(400)], respond)
+    serve(monkeypatch, api)
+    limiter = RateLimiter()
+
+    with pytest.raises(ModelHTTPError):
+        categorise(limiter)
+
+    assert (api.requests, limiter.retries, sleeps) == (1, 0, [])
+
+
+def test_rate_limits_halve_concurrency_and_successes_raise_it(monkeypatch, sleeps):
+    serve(monkeypatch, ScriptedChatAPI([error(429), error(429)], respond))
+    limiter = RateLimiter(max_concurrency=16, initial_concurrency=8)
+
+    categorise(limiter)
+
+    # Halved twice to 2, then one success adds 1 / 2
+    assert limiter.concurrency == pytest.approx(2.5)
+    assert limiter.limit == 2
+
+    categorise(limiter, times=3)
+
+    assert limiter.concurrency == pytest.approx(2.5 + 1 / 2.5 + 1 / 2.9 + 1 / (2.9 + 1 / 2.9))
+
+
+def test_concurrency_never_falls_below_the_minimum(monkeypatch, sleeps):
+    serve(monkeypatch, ScriptedChatAPI([error(429)] * 4, respond))
+    limiter = RateLimiter(max_concurrency=8, min_concurrency=2)
+
+    categorise(limiter)
+
+    assert limiter.limit == 2
+
+
+def test_requests_in_flight_stay_within_the_limit(monkeypatch, sleeps):
+    api = ScriptedChatAPI([], respond, latency=0.01)
+    serve(monkeypatch, api)
+    limiter = RateLimiter(max_concurrency=3)
+
+    assert len(categorise(limiter, times=10)) == 10
+
+    assert api.max_in_flight == 3
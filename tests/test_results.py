@@ -0,0 +1,125 @@
+import csv
+
+import pytest
+
+from aggregator_agent.results import ResultDiff, ResultRecord, ResultStore
+from aggregator_agent.schema import Category, LensFitAnalysis
+from aggregator_agent.telemetry import CallRecord
+
+GOOD = Category.Good
+FIXABLE = Category.Fixable
+DATA_ISSUE = Category.DataIssue
+
+
+def result(run: str, image_id: str, category: Category, expected: Category | None = None, at: float = 0.0):
+    return ResultRecord(
+        run=run,
+        id=image_id,
+        category=category,
+        description=f"{image_id} is {category}",
+        expected=expected,
+        recorded_at=at,
+    )
+
+
+@pytest.fixture
+def store(tmp_path) -> ResultStore:
+    with ResultStore(tmp_path / "store", partition_rows=2) as store:
+        store.extend([
+            result("before", "a", GOOD, expected=GOOD, at=1.0),
+            result("before", "b", GOOD, expected=FIXABLE, at=2.0),
+            result("before", "c", DATA_ISSUE, at=3.0),
+            result("after", "a", FIXABLE, expected=GOOD, at=4.0),
+            result("after", "b", FIXABLE, expected=FIXABLE, at=5.0),
+            result("after", "d", GOOD, at=6.0),
+        ])
+        yield store
+
+
+def test_results_are_written_in_partitions_and_indexed(store):
+    # Each run writes a partition once it has two results buffered, and the rest on flush
+    assert store.partitions_written == 2
+    store.flush()
+
+    assert store.partitions_written == 4
+    assert store.runs() == {"before": 3, "after": 3}
+    assert len(store) == 6
+
+
+def test_lookup_finds_an_image_across_runs(store):
+    assert [(record.run, record.category) for record in store.lookup("a")] == [("before", GOOD), ("after", FIXABLE)]
+    assert [record.run for record in store.lookup("a", run="after")] == ["after"]
+    assert store.lookup("missing") == []
+
+
+def test_select_filters_by_category_and_ground_truth(store):
+    assert [record.id for record in store.select(run="before", category=GOOD)] == ["a", "b"]
+    # Results without a ground truth are never mismatched
+    assert [(record.run, record.id) for record in store.select(mismatched=True)] == [
+        ("before", "b"),
+        ("after", "a"),
+    ]
+
+
+def test_diff_compares_the_latest_result_of_each_image(store):
+    store.append(result("after", "c", DATA_ISSUE, at=7.0))
+
+    assert list(store.diff("before", "after")) == [
+        ResultDiff(id="a", before=GOOD, after=FIXABLE),
+        ResultDiff(id="b", before=GOOD, after=FIXABLE),
+        ResultDiff(id="d", before=None, after=GOOD),
+    ]
+
+
+def test_export_csv_writes_a_run(store, tmp_path):
+    assert store.export_csv("after", tmp_path / "after.csv", expected=True) == 3
+
+    with (tmp_path / "after.csv").open(newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows == [
+        ["id", "category", "description", "expected"],
+        ["a", "Fixable", "a is Fixable", "Good"],
+        ["b", "Fixable", "b is Fixable", "Fixable"],
+        ["d", "Good", "d is Good", ""],
+    ]
+
+
+def test_index_is_rebuilt_from_partitions(tmp_path):
+    with ResultStore(tmp_path / "store") as store:
+        store.append(result("run", "a", GOOD))
+
+    (tmp_path / "store" / "index.sqlite").unlink()
+    with ResultStore(tmp_path / "store") as store:
+        assert [record.id for record in store.lookup("a")] == ["a"]
+
+
+def test_results_share_calls_between_their_images():
+    calls = [
+        CallRecord(
+            started_at=0.0,
+            operation="categorise",
+            image_ids=["a", "b"],
+            model="gpt-5-nano",
+            prompt_hash="group",
+            latency=2.0,
+            input_tokens=100,
+        ),
+        CallRecord(
+            started_at=0.0,
+            operation="categorise",
+            image_ids=["a"],
+            model="gpt-5",
+            prompt_hash="single",
+            latency=1.0,
+            input_tokens=30,
+        ),
+    ]
+    analysis = LensFitAnalysis(category=GOOD, description="Escalated")
+    record = ResultRecord.from_analysis("run", "a", analysis, calls)
+
+    assert (record.model, record.prompt_hash, record.latency, record.input_tokens) == ("gpt-5", "single", 2.0, 80)
+
+
+def test_run_names_must_be_safe_filenames(tmp_path):
+    with ResultStore(tmp_path / "store") as store, pytest.raises(ValueError):
+        store.append(result("../escape", "a", GOOD))
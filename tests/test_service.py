@@ -0,0 +1,85 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from aggregator_agent.budget import CATEGORISE, Job, prior_cost
+from aggregator_agent.schema import Category, LensFitAnalysis
+from aggregator_agent.service import Service, ServiceClient
+from aggregator_agent.stub_model import stub_model
+from aggregator_agent.telemetry import PRICES
+
+
+def make_images(directory: Path, count: int) -> list[Path]:
+    paths = []
+    for i in range(count):
+        paths.append(directory / f"image_{i}.png")
+        Image.new("RGB", (8, 2)).save(paths[-1])
+    return paths
+
+
+def serve_and_run(service: Service, socket_path: Path, clients):
+    """
+    Serve on a Unix socket while the clients coroutine runs with a client connected to it, returning its result.
+    """
+
+    async def run():
+        server = asyncio.create_task(service.serve(socket_path=socket_path))
+        while not socket_path.exists():
+            await asyncio.sleep(0.01)
+        client = ServiceClient(socket_path=socket_path, timeout=10.0)
+        try:
+            return await clients(client)
+        finally:
+            await client.aclose()
+            await asyncio.to_thread(client.close)
+            server.cancel()
+
+    return asyncio.run(run())
+
+
+def test_categorises_concurrent_jobs_in_one_grouped_request(tmp_path):
+    images = make_images(tmp_path, 3)
+    service = Service(model=stub_model(0.0, category=Category.Fixable), max_batch=4, max_wait=0.5)
+
+    async def clients(client: ServiceClient):
+        results = await asyncio.gather(*(client.categorise_async(path) for path in images + images[:1]))
+        return results, await asyncio.to_thread(client.status)
+
+    results, status = serve_and_run(service, tmp_path / "service.sock", clients)
+
+    assert all(isinstance(result, LensFitAnalysis) for result in results)
+    assert {result.category for result in results} == {Category.Fixable}
+    assert status["jobs"]["categorise"] == 4
+    assert status["batches"] == 1
+    assert status["coalesced"] == 1
+
+
+def test_reports_errors_to_the_client(tmp_path):
+    service = Service(model=stub_model(0.0))
+
+    async def clients(client: ServiceClient):
+        with pytest.raises(RuntimeError, match="404"):
+            await client.categorise_async(tmp_path / "missing.png")
+
+    serve_and_run(service, tmp_path / "service.sock", clients)
+
+
+def test_refuses_jobs_past_the_budget(tmp_path, monkeypatch):
+    monkeypatch.setitem(PRICES, "stub", (1.0, 1.0))
+    images = make_images(tmp_path, 2)
+    estimate = prior_cost(Job(operation=CATEGORISE, path=images[0]), "stub")
+    service = Service(model=stub_model(0.0), budget=estimate)
+
+    async def clients(client: ServiceClient):
+        first = await client.categorise_async(images[0])
+        with pytest.raises(RuntimeError, match="402"):
+            await client.categorise_async(images[1])
+        return first, await asyncio.to_thread(client.status)
+
+    first, status = serve_and_run(service, tmp_path / "service.sock", clients)
+
+    assert first.category == Category.Good
+    assert 0 < status["spent"] <= estimate
+    assert (status["refused"], status["errors"], status["batches"]) == (1, 0, 2)
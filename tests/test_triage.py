@@ -0,0 +1,31 @@
+from aggregator_agent.schema import Category
+from aggregator_agent.triage import ResidualStatistics, calibrate, cross_validate
+
+
+def statistics(edge_brightness: float) -> ResidualStatistics:
+    return ResidualStatistics(
+        masked_flux=0.1,
+        residual_rms=0.1,
+        edge_brightness=edge_brightness,
+        saturation_fraction=0.0,
+    )
+
+
+def test_cross_validation_decides_each_image_without_it():
+    images = [statistics(0.1)] * 9 + [statistics(0.9)] * 3
+    categories = [Category.Good] * 9 + [Category.Fixable] * 3
+
+    in_sample = calibrate(images, categories, min_support=3)
+    held_out = cross_validate(images, categories, folds=3, min_support=3, seed=0)
+
+    assert [in_sample.categorise(image) for image in images] == categories
+    # Each fold leaves two Fixable images to calibrate on, too few to support a Fixable threshold
+    assert held_out == [Category.Good] * 9 + [None] * 3
+
+
+def test_folds_are_stratified():
+    images = [statistics(0.1)] * 6 + [statistics(0.9)] * 6
+    categories = [Category.Good] * 6 + [Category.Fixable] * 6
+
+    # Every training set holds four images of each category, enough for both decisions
+    assert cross_validate(images, categories, folds=3, min_support=4, seed=1) == categories
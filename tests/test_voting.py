@@ -0,0 +1,27 @@
+from aggregator_agent.schema import Category, LensFitAnalysis
+from aggregator_agent.voting import VoteOutcome, Voting
+
+
+def outcome(category: Category, runs: int) -> VoteOutcome:
+    analysis = LensFitAnalysis(category=category, description="")
+    return VoteOutcome(analysis=analysis, first=analysis, votes={category: runs}, runs=runs)
+
+
+def test_only_borderline_images_count_towards_runs_avoided():
+    voting = Voting(votes=5, borderline=(Category.MightBeLensBadModel,))
+
+    voting.record(outcome(Category.Good, 1))
+    voting.record(outcome(Category.Good, 1))
+    voting.record(outcome(Category.MightBeLensBadModel, 3))
+
+    assert (voting.images, voting.runs, voting.voted, voting.avoided) == (3, 5, 1, 2)
+    assert "1 voted on, 2 avoided by stopping early" in voting.summary()
+
+
+def test_every_image_is_voted_on_without_borderline_categories():
+    voting = Voting(votes=3)
+
+    voting.record(outcome(Category.Good, 2))
+    voting.record(outcome(Category.MightBeLensBadModel, 3))
+
+    assert (voting.voted, voting.avoided) == (2, 1)
@@ -0,0 +1,98 @@
+from pathlib import Path
+
+import pytest
+
+from aggregator_agent import work_queue
+from aggregator_agent.schema import Category, LensFitAnalysis
+from aggregator_agent.work_queue import WorkQueue
+
+GOOD = LensFitAnalysis(category=Category.Good, description="A good fit")
+FIXABLE = LensFitAnalysis(category=Category.Fixable, description="Needs a better mask")
+
+
+class Clock:
+    """
+    Stands in for time.time in the queue, moved on by the test.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(work_queue.time, "time", clock)
+    return clock
+
+
+def make_queue(tmp_path: Path, count: int, **kwargs) -> WorkQueue:
+    queue = WorkQueue(tmp_path / "queue.sqlite", lease_seconds=10.0, **kwargs)
+    queue.enqueue(tmp_path / f"image_{i}.png" for i in range(count))
+    return queue
+
+
+def test_images_are_leased_to_one_worker_at_a_time(tmp_path, clock):
+    with make_queue(tmp_path, 3) as queue:
+        first = queue.claim("first", batch_size=2)
+        second = queue.claim("second", batch_size=2)
+
+        assert [path.stem for path in first] == ["image_0", "image_1"]
+        assert [path.stem for path in second] == ["image_2"]
+        assert queue.claim("third", batch_size=2) == []
+        assert queue.progress() == {"pending": 0, "leased": 3, "done": 0, "failed": 0}
+        # Enqueueing again adds nothing
+        assert queue.enqueue(first) == 0
+
+
+def test_expired_leases_are_reclaimed_and_heartbeats_keep_them(tmp_path, clock):
+    with make_queue(tmp_path, 2) as queue:
+        queue.claim("alive", batch_size=1)
+        queue.claim("dead", batch_size=1)
+
+        clock.now += 8
+        assert queue.heartbeat("alive") == 1
+        clock.now += 8
+
+        assert [path.stem for path in queue.claim("other", batch_size=2)] == ["image_1"]
+        # The dead worker's failure arrives after its lease passed to another worker, so is not recorded
+        queue.fail("dead", "image_1", "Too late")
+        assert queue.progress() == {"pending": 0, "leased": 2, "done": 0, "failed": 0}
+        assert queue.heartbeat("dead") == 0
+
+
+def test_images_fail_after_max_attempts(tmp_path, clock):
+    with make_queue(tmp_path, 2, max_attempts=2) as queue:
+        queue.claim("worker", batch_size=2)
+        queue.fail("worker", "image_0", "Bad response")
+        clock.now += 11
+
+        # image_1's expired lease is its first failed attempt
+        assert sorted(path.stem for path in queue.claim("worker", batch_size=2)) == ["image_0", "image_1"]
+        queue.fail("worker", "image_0", "Bad response")
+        clock.now += 11
+
+        assert queue.claim("worker", batch_size=2) == []
+        assert queue.progress() == {"pending": 0, "leased": 0, "done": 0, "failed": 2}
+        errors = dict(queue._connection.execute("SELECT id, error FROM items").fetchall())
+        assert errors == {"image_0": "Bad response", "image_1": "Lease expired"}
+
+
+def test_an_image_completed_twice_keeps_its_first_result(tmp_path, clock):
+    with make_queue(tmp_path, 1) as queue:
+        queue.claim("slow", batch_size=1)
+        clock.now += 11
+        queue.claim("fast", batch_size=1)
+
+        queue.complete("fast", "image_0", GOOD)
+        queue.complete("slow", "image_0", FIXABLE)
+
+        assert queue.progress()["done"] == 1
+        assert queue.export(tmp_path / "results.csv") == 1
+        assert (tmp_path / "results.csv").read_text().splitlines() == [
+            "id,category,description",
+            "image_0,Good,A good fit",
+        ]